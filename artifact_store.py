@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+import time
+
+from structure_cache import content_hash
+
+ARTIFACT_DIRECTORY = os.environ.get("CRYSTALPRINTER_ARTIFACT_DIR", "artifacts")
+MAX_ARTIFACT_BYTES = int(os.environ.get("CRYSTALPRINTER_ARTIFACT_BYTES", 2 * 1024 * 1024 * 1024))
+ARTIFACT_TTL_SECONDS = int(os.environ.get("CRYSTALPRINTER_ARTIFACT_TTL", 7 * 24 * 60 * 60))
+SESSION_TTL_SECONDS = int(os.environ.get("CRYSTALPRINTER_SESSION_TTL", 24 * 60 * 60))
+
+
+class ArtifactStore:
+    def __init__(self, directory=ARTIFACT_DIRECTORY, max_bytes=MAX_ARTIFACT_BYTES, ttl=ARTIFACT_TTL_SECONDS,
+                 session_ttl=SESSION_TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.session_ttl = session_ttl
+        self._lock = threading.Lock()
+        for kind in ("uploads", "meshes", "sessions"):
+            os.makedirs(os.path.join(directory, kind), exist_ok=True)
+
+    def put_upload(self, content, session_id=None):
+        key = content_hash(b"upload", content)
+        path = self.upload_path(key)
+        if not os.path.exists(path):
+            temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as fp:
+                fp.write(content)
+            os.replace(temporary_path, path)
+        self.touch(path)
+        if session_id:
+            self.reference(session_id, key)
+        self.evict()
+        return key
+
+    def upload_path(self, key):
+        return os.path.join(self.directory, "uploads", f"{key}.cif")
+
+    def mesh_key(self, upload_key, params):
+        return content_hash(b"mesh", upload_key.encode("ascii"), params)
+
+    def mesh_path(self, key, extension=".stl"):
+        return os.path.join(self.directory, "meshes", f"{key}{extension}")
+
+    def lookup(self, path, session_id=None):
+        # Existing artifacts are refreshed on every hit so eviction is least recently used
+        if not os.path.exists(path):
+            return None
+        self.touch(path)
+        if session_id:
+            self.reference(session_id, os.path.basename(path).split(".", 1)[0])
+        return path
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def reference(self, session_id, key):
+        path = self._session_path(session_id)
+        with self._lock:
+            keys = set(self._session_keys(path))
+            keys.add(key)
+            temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "w") as fp:
+                json.dump(sorted(keys), fp)
+            os.replace(temporary_path, path)
+
+    def referenced_keys(self):
+        keys = set()
+        cutoff = time.time() - self.session_ttl
+        sessions = os.path.join(self.directory, "sessions")
+        for filename in os.listdir(sessions):
+            path = os.path.join(sessions, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            keys.update(self._session_keys(path))
+        return keys
+
+    def evict(self):
+        now = time.time()
+        referenced = self.referenced_keys()
+        entries = []
+        for kind in ("uploads", "meshes"):
+            folder = os.path.join(self.directory, kind)
+            for filename in os.listdir(folder):
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(folder, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                key = filename.split(".", 1)[0]
+                entries.append((key in referenced, stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, _, size, _ in entries)
+        # Expired files go first, then unreferenced before referenced, oldest first
+        for is_referenced, mtime, size, path in sorted(entries, key=lambda entry: (entry[1] >= now - self.ttl,
+                                                                                   entry[0], entry[1])):
+            if total <= self.max_bytes and mtime >= now - self.ttl:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _session_path(self, session_id):
+        return os.path.join(self.directory, "sessions", f"{content_hash(b'session', session_id.encode('utf8'))}.json")
+
+    def _session_keys(self, path):
+        try:
+            with open(path) as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return []
+
+
+artifact_store = ArtifactStore()
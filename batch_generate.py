@@ -0,0 +1,226 @@
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+
+from cif_reader import load_bonding_graph, load_cif_structure
+from instrumentation import capture
+from mesh_export import export_extension
+from tessellation import DEFAULT_NOZZLE_DIAMETER, tessellation_params
+from web_stl_generator import generate_stl_from_params
+
+BATCH_WORKERS = int(os.environ.get("CRYSTALPRINTER_BATCH_WORKERS", os.cpu_count() or 1))
+BATCH_TIMEOUT_SECONDS = float(os.environ.get("CRYSTALPRINTER_BATCH_TIMEOUT", 600))
+BATCH_MEMORY_MB = int(os.environ.get("CRYSTALPRINTER_BATCH_MEMORY_MB", 4096))
+
+logger = logging.getLogger(__name__)
+
+
+def parse_vector(value, default):
+    if value in (None, ""):
+        return default
+    if isinstance(value, str):
+        value = [part for part in re.split(r"[\s,;]+", value.strip("[]() ")) if part]
+    return [float(part) for part in value]
+
+
+def parse_flag(value, default=False):
+    if value in (None, ""):
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y", "on")
+    return bool(value)
+
+
+def parse_number(value, default=None):
+    return default if value in (None, "") else float(value)
+
+
+def parse_spins(value):
+    # {"0": [0, 0, 1]} in JSON, or the Dash form syntax 0:[0,0,1],1:[1,0,0]
+    if value in (None, ""):
+        return None
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            value = dict(re.findall(r"(\d+)\s*:\s*(\[[^\]]*\])", value))
+    return {int(index): parse_vector(spin, None) for index, spin in value.items()}
+
+
+def load_manifest(manifest_path):
+    # A CSV with a header row, or a JSON list of objects, with one generation per row and a required "cif" column
+    with open(manifest_path, newline="") as fp:
+        if manifest_path.lower().endswith(".json"):
+            entries = json.load(fp)
+        else:
+            entries = list(csv.DictReader(fp))
+    base_directory = os.path.dirname(os.path.abspath(manifest_path))
+    for entry in entries:
+        if not entry.get("cif"):
+            raise ValueError(f"Manifest entry without a cif: {entry}")
+        entry["cif"] = os.path.join(base_directory, entry["cif"])
+    return entries
+
+
+def job_arguments(entry, index, output_directory):
+    # "format" is stl, 3mf, ply or glb; "compress" wraps the model in a zip archive
+    extension = export_extension(entry.get("format") or "stl", parse_flag(entry.get("compress")))
+    output_path = entry.get("output") or os.path.join(
+        output_directory, f"{index:04d}_{os.path.splitext(os.path.basename(entry['cif']))[0]}{extension}")
+    target_atoms = entry.get("target_atoms")
+    if isinstance(target_atoms, str):
+        target_atoms = [atom.strip() for atom in target_atoms.split(",") if atom.strip()] or None
+
+    args = (entry["cif"], parse_vector(entry.get("num_unit_cells"), [1, 1, 1]),
+            parse_vector(entry.get("rotation_angles"), [0, 0, 0]),
+            parse_vector(entry.get("translation_vector"), [0, 0, 0]), parse_number(entry.get("base_level"), 0.0),
+            parse_flag(entry.get("is_primitive")), target_atoms, parse_spins(entry.get("site_index_spin")),
+            parse_number(entry.get("tolerance"), 0.1), parse_flag(entry.get("add_supports")))
+    kwargs = {
+        "bonding": entry.get("bonding") or "nearest",
+        "boundary": entry.get("boundary") or "keep",
+        "tessellation": tessellation_params(
+            entry.get("lod") or "export", print_size=parse_number(entry.get("print_size")),
+            nozzle_diameter=parse_number(entry.get("nozzle_diameter"), DEFAULT_NOZZLE_DIAMETER),
+            triangle_budget=parse_number(entry.get("triangle_budget"))),
+        "solidify_flag": parse_flag(entry.get("solidify")),
+        "symmetry_flag": parse_flag(entry.get("symmetry")),
+        "output_path": output_path,
+    }
+    if entry.get("voxel_size") not in (None, ""):
+        kwargs["voxel_size"] = float(entry["voxel_size"])
+    return args, kwargs
+
+
+def warm_structure_cache(jobs):
+    # Parse every distinct CIF (and build every distinct bonding graph) once up front, so workers only read
+    # the shared structure cache instead of repeating the same work in parallel
+    seen = set()
+    for args, kwargs in jobs:
+        key = (args[0], args[5], kwargs["bonding"])
+        if key in seen:
+            continue
+        seen.add(key)
+        try:
+            structure, structure_key = load_cif_structure(args[0], args[5])
+            if kwargs["bonding"] != "nearest":
+                load_bonding_graph(structure, structure_key, kwargs["bonding"])
+        except Exception as e:
+            logger.warning("Could not pre-parse %s: %s", args[0], e)
+
+
+def run_batch_job(args, kwargs, memory_limit_mb, connection):
+    # Runs in its own process so a stuck or oversized job can be killed without touching the others
+    if memory_limit_mb:
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    with capture() as runs:
+        try:
+            output_path = generate_stl_from_params(*args, **kwargs)
+            result = {"status": "done", "output": output_path, "bytes": os.path.getsize(output_path)}
+        except MemoryError:
+            result = {"status": "memory", "error": f"memory limit of {memory_limit_mb} MB exceeded"}
+        except Exception as e:
+            result = {"status": "failed", "error": str(e), "traceback": traceback.format_exc()}
+    # Top-level stage times for the summary line; the full per-stage records go into the report
+    result["stages"] = {stage["stage"]: stage["seconds"] for run in runs for stage in run["stages"]
+                        if "/" not in stage["stage"]}
+    result["metrics"] = runs
+    connection.send(result)
+    connection.close()
+
+
+def run_batch(jobs, workers=BATCH_WORKERS, timeout=BATCH_TIMEOUT_SECONDS, memory_limit_mb=BATCH_MEMORY_MB):
+    context = multiprocessing.get_context("fork" if hasattr(os, "fork") else "spawn")
+    results = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < workers:
+            index = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_batch_job, args=(*jobs[index], memory_limit_mb, sender), daemon=True)
+            process.start()
+            sender.close()
+            running[receiver] = (index, process, time.perf_counter())
+
+        now = time.perf_counter()
+        deadline = min(started + timeout for _, _, started in running.values()) if timeout else None
+        ready = wait(list(running), timeout=None if deadline is None else max(deadline - now, 0.0))
+
+        for receiver in ready:
+            index, process, started = running.pop(receiver)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                # The worker died without reporting, e.g. killed by the kernel's out-of-memory handler
+                process.join()
+                result = {"status": "failed", "error": f"worker exited with code {process.exitcode}"}
+            process.join()
+            results[index] = dict(result, seconds=time.perf_counter() - started)
+
+        if timeout:
+            now = time.perf_counter()
+            for receiver, (index, process, started) in list(running.items()):
+                if now - started >= timeout:
+                    process.kill()
+                    process.join()
+                    del running[receiver]
+                    results[index] = {"status": "timeout", "error": f"timed out after {timeout:g} s",
+                                      "seconds": now - started}
+    return results
+
+
+def write_report(report_path, entries, jobs, results):
+    report = []
+    for entry, (args, kwargs), result in zip(entries, jobs, results):
+        report.append(dict(result, cif=entry["cif"], output_path=kwargs["output_path"]))
+    summary = {status: sum(1 for result in results if result["status"] == status)
+               for status in ("done", "failed", "timeout", "memory")}
+    with open(report_path, "w") as fp:
+        json.dump({"summary": summary, "jobs": report}, fp, indent=2)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate printable models for every entry of a CSV or JSON manifest.")
+    parser.add_argument("manifest", help="CSV or JSON manifest, one generation per row")
+    parser.add_argument("--output-dir", default="batch_output", help="directory for outputs without an explicit path")
+    parser.add_argument("--report", default=None, help="summary report path (default: <output-dir>/report.json)")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--timeout", type=float, default=BATCH_TIMEOUT_SECONDS, help="seconds per job, 0 for none")
+    parser.add_argument("--memory-mb", type=int, default=BATCH_MEMORY_MB, help="address space cap per job, 0 for none")
+    options = parser.parse_args(argv)
+    logging.basicConfig(level=os.environ.get("CRYSTALPRINTER_LOG_LEVEL", "WARNING").upper(),
+                        format="%(levelname)s %(name)s: %(message)s")
+
+    os.makedirs(options.output_dir, exist_ok=True)
+    entries = load_manifest(options.manifest)
+    jobs = [job_arguments(entry, index, options.output_dir) for index, entry in enumerate(entries)]
+    warm_structure_cache(jobs)
+
+    started = time.perf_counter()
+    results = run_batch(jobs, max(1, options.workers), options.timeout, options.memory_mb)
+    report_path = options.report or os.path.join(options.output_dir, "report.json")
+    summary = write_report(report_path, entries, jobs, results)
+
+    for entry, result in zip(entries, results):
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in result.get("stages", {}).items())
+        print(f"{result['status']:>8} {result['seconds']:7.2f}s {entry['cif']} {result.get('error') or stages}")
+    print(f"{len(results)} jobs in {time.perf_counter() - started:.1f}s: {summary}; report written to {report_path}")
+    return 0 if summary["done"] == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
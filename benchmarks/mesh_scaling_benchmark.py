@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from instrumentation import capture, run
+from parallel_mesher import AVAILABLE_CPUS, parallel_write_binary_stl
+from stl_writer import write_binary_stl
+from tessellation import tessellation_params
+from web_stl_generator import generate_parts_from_params
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CIF_PATH = os.path.join(ROOT, "Yb2Si2O7.cif")
+RESULTS_DIRECTORY = os.path.join(ROOT, "benchmarks", "results")
+# 17^3 conventional Yb2Si2O7 cells are a little over 100k atoms
+DEFAULT_CELLS = 17
+
+
+def worker_counts(limit):
+    counts = [1]
+    while counts[-1] * 2 <= limit:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != limit:
+        counts.append(limit)
+    return counts
+
+
+def timed(function, repeat):
+    # Fastest of repeat runs, with the seconds of every stage the run recorded
+    best = None
+    for _ in range(repeat):
+        with capture() as runs:
+            with run("mesh_scaling"):
+                start = time.perf_counter()
+                result = function()
+                elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, result, {entry["stage"]: entry["seconds"] for entry in runs[0]["stages"]})
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scaling of the parallel binary STL export writer with the number of workers.")
+    parser.add_argument("--cells", type=int, default=DEFAULT_CELLS, help="supercell edge length in unit cells")
+    parser.add_argument("--workers", default=None, help=f"comma separated worker counts, default 1 to {AVAILABLE_CPUS}")
+    parser.add_argument("--lod", default="export")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=os.path.join(RESULTS_DIRECTORY, "mesh_scaling.json"))
+    options = parser.parse_args(argv)
+    cpus = AVAILABLE_CPUS
+    workers = [int(count) for count in options.workers.split(",")] if options.workers else worker_counts(cpus)
+    if max(workers) > cpus:
+        print(f"Only {cpus} CPUs are available: runs with more workers are oversubscribed and show no scaling")
+
+    start = time.perf_counter()
+    parts = generate_parts_from_params(CIF_PATH, [options.cells] * 3, [0, 0, 0], [0, 0, 0], 0, False, None, None,
+                                       0.1, False, tessellation=tessellation_params(options.lod))
+    atoms = int(sum(len(part[3]) for part in parts if part[2] is None))
+    print(f"{options.cells}^3 cells: {atoms:,} atoms, {len(parts)} parts in {time.perf_counter() - start:.2f}s")
+
+    os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+    stl_path = os.path.join(RESULTS_DIRECTORY, f"mesh_scaling.{os.getpid()}.stl")
+    try:
+        serial_seconds, triangles, _ = timed(lambda: write_binary_stl(stl_path, parts), max(1, options.repeat))
+        print(f"{'serial':>8} {serial_seconds:8.2f}s {triangles / serial_seconds:>14,.0f} tri/s")
+        results = []
+        for count in workers:
+            seconds, written, phases = timed(lambda: parallel_write_binary_stl(stl_path, parts, workers=count),
+                                             max(1, options.repeat))
+            if written != triangles:
+                raise RuntimeError(f"{count} workers wrote {written} triangles, expected {triangles}")
+            # Speedup and efficiency are against the single worker run, so they show the scaling alone
+            speedup = (results[0]["seconds"] if results else seconds) / seconds
+            # The parallel_fill phase is the part spread over the workers; spatial_order and write stay serial
+            results.append({"workers": count, "oversubscribed": count > cpus, "seconds": seconds,
+                            "speedup": speedup, "efficiency": speedup / count,
+                            "triangles_per_second": triangles / seconds, "phases": phases})
+            print(f"{count:>8} {seconds:8.2f}s {triangles / seconds:>14,.0f} tri/s  x{speedup:5.2f} "
+                  f"{100 * speedup / count:5.0f}%  " + " ".join(f"{name} {phases[name]:.2f}s" for name in phases))
+    finally:
+        if os.path.exists(stl_path):
+            os.remove(stl_path)
+
+    report = {"environment": {"python": platform.python_version(), "numpy": np.__version__,
+                              "platform": platform.platform(), "cpus": cpus, "time": time.time()},
+              "cells": options.cells, "lod": options.lod, "atoms": atoms, "triangles": triangles,
+              "serial_seconds": serial_seconds, "results": results}
+    temporary_path = f"{options.output}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as fp:
+        json.dump(report, fp, indent=2)
+    os.replace(temporary_path, options.output)
+    print(f"Results written to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymatgen.core import Lattice, Structure
+from pymatgen.io.cif import CifWriter
+
+from batch_generate import run_batch, warm_structure_cache
+from stage_cache import stage_cache
+from tessellation import tessellation_params
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIRECTORY = os.path.join(ROOT, "benchmarks", "results")
+STRUCTURES = ("Yb2Si2O7", "simple_cubic", "rock_salt", "low_symmetry")
+QUICK_SIZES = (1, 2, 4)
+FULL_SIZES = (1, 2, 4, 8, 12, 16, 20)
+# Each variant switches on one pipeline option over the plain run; "all" switches on every one.
+# There is no spin variant: the web pipeline benchmarked here never meshes spin arrows
+VARIANTS = {
+    "plain": {},
+    "supports": {"supports": True},
+    "primitive": {"primitive": True},
+    "all": {"supports": True, "primitive": True},
+}
+# A case regresses when it is this much slower (or larger) than the baseline, and by more than the noise floor
+REGRESSION_THRESHOLD = 0.25
+NOISE_SECONDS = 0.05
+NOISE_MB = 20.0
+LOW_SYMMETRY_SITES = 48
+LOW_SYMMETRY_SEED = 7
+
+
+def low_symmetry_structure():
+    # A fixed-seed triclinic P1 cell, with atoms kept at least 1.6 A apart
+    rng = np.random.default_rng(LOW_SYMMETRY_SEED)
+    lattice = Lattice.from_parameters(9.1, 10.3, 11.7, 81.0, 97.0, 104.0)
+    species, coords = [], []
+    while len(coords) < LOW_SYMMETRY_SITES:
+        candidate = rng.random(3)
+        if coords:
+            distances = lattice.get_all_distances([candidate], coords)[0]
+            if distances.min() < 1.6:
+                continue
+        coords.append(candidate)
+        species.append(("Mg", "Si", "O", "O")[len(coords) % 4])
+    return Structure(lattice, species, coords)
+
+
+def benchmark_cifs(directory):
+    os.makedirs(directory, exist_ok=True)
+    structures = {
+        "simple_cubic": Structure(Lattice.cubic(2.5), ["Cu"], [[0, 0, 0]]),
+        "rock_salt": Structure.from_spacegroup("Fm-3m", Lattice.cubic(5.64), ["Na", "Cl"],
+                                               [[0, 0, 0], [0.5, 0.5, 0.5]]),
+        "low_symmetry": low_symmetry_structure(),
+    }
+    paths = {"Yb2Si2O7": os.path.join(ROOT, "Yb2Si2O7.cif")}
+    for name, structure in structures.items():
+        paths[name] = os.path.join(directory, f"{name}.cif")
+        CifWriter(structure).write_file(paths[name])
+    return paths
+
+
+def benchmark_cases(cif_paths, structures, sizes, variants, lod, output_directory):
+    cases = []
+    for structure in structures:
+        for size in sizes:
+            for variant in variants:
+                options = VARIANTS[variant]
+                name = f"{structure}/{size}^3/{variant}"
+                output_path = os.path.join(output_directory, name.replace("/", "_").replace("^", "") + ".stl")
+                args = (cif_paths[structure], [size] * 3, [0, 0, 0], [0, 0, 0], 0.0, options.get("primitive", False),
+                        None, None, 0.1, options.get("supports", False))
+                kwargs = {"bonding": "nearest", "tessellation": tessellation_params(lod),
+                          "output_path": output_path}
+                cases.append((name, (args, kwargs)))
+    return cases
+
+
+def case_result(name, result):
+    # Throughput is over the whole run; stage entries keep their own counts and times
+    summary = {"case": name, "status": result["status"], "seconds": result["seconds"]}
+    if result["status"] != "done":
+        summary["error"] = result.get("error")
+        return summary
+
+    run = result["metrics"][0]
+    stages = {stage["stage"]: stage for stage in run["stages"]}
+    atoms = stages.get("bonding", {}).get("atoms", 0)
+    triangles = stages.get("export", {}).get("triangles", 0)
+    summary.update(
+        seconds=run["seconds"], peak_rss_mb=run["peak_rss_mb"], atoms=atoms,
+        bonds=stages.get("bonding", {}).get("bonds", 0), triangles=triangles, bytes=result["bytes"],
+        atoms_per_second=atoms / run["seconds"], triangles_per_second=triangles / run["seconds"],
+        stages={stage_name: stage["seconds"] for stage_name, stage in stages.items()})
+    return summary
+
+
+def run_cases(cases, repeat, timeout, memory_limit_mb):
+    # One forked worker per run so every case reports its own peak memory; the fastest repeat is kept
+    results = []
+    for name, job in cases:
+        best = None
+        for _ in range(repeat):
+            result = case_result(name, run_batch([job], 1, timeout, memory_limit_mb)[0])
+            if os.path.exists(job[1]["output_path"]):
+                os.remove(job[1]["output_path"])
+            if best is None or result["status"] != "done" or result["seconds"] < best["seconds"]:
+                best = result
+            if result["status"] != "done":
+                break
+        results.append(best)
+        line = f"{best['status']:>8} {best['seconds']:8.2f}s {name}"
+        if best["status"] == "done":
+            line += (f"  {best['atoms']:>9,} atoms {best['triangles']:>13,} tri  {best['atoms_per_second']:>11,.0f} at/s "
+                     f"{best['triangles_per_second']:>13,.0f} tri/s  {best['peak_rss_mb']:8.1f} MB")
+        else:
+            line += f"  {best.get('error')}"
+        print(line, flush=True)
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold=REGRESSION_THRESHOLD):
+    previous = {result["case"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result["case"])
+        if before is None or before["status"] != "done":
+            continue
+        if result["status"] != "done":
+            regressions.append(f"{result['case']}: {result['status']} (baseline done in {before['seconds']:.2f}s)")
+            continue
+        for key, noise, unit in (("seconds", NOISE_SECONDS, "s"), ("peak_rss_mb", NOISE_MB, " MB")):
+            if result[key] > before[key] * (1 + threshold) and result[key] - before[key] > noise:
+                regressions.append(f"{result['case']}: {key} {before[key]:.2f}{unit} -> {result[key]:.2f}{unit}")
+    return regressions
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpus": os.cpu_count(), "time": time.time()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the STL pipeline over real and synthetic crystals.")
+    parser.add_argument("--structures", default=",".join(STRUCTURES))
+    parser.add_argument("--sizes", default=None, help="comma separated supercell edge lengths")
+    parser.add_argument("--full", action="store_true", help=f"supercells {FULL_SIZES[0]}^3 to {FULL_SIZES[-1]}^3")
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    parser.add_argument("--lod", default="export")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600, help="seconds per run, 0 for none")
+    parser.add_argument("--memory-mb", type=int, default=0, help="address space cap per run, 0 for none")
+    parser.add_argument("--output", default=os.path.join(RESULTS_DIRECTORY, "pipeline.json"))
+    parser.add_argument("--baseline", default=None, help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--stage-cache", action="store_true", help="reuse memoized stages between runs")
+    options = parser.parse_args(argv)
+    # Every case measures the full pipeline unless memoized stages are asked for
+    stage_cache.enabled = options.stage_cache
+
+    sizes = [int(size) for size in options.sizes.split(",")] if options.sizes else \
+        FULL_SIZES if options.full else QUICK_SIZES
+    structures = [name for name in options.structures.split(",") if name]
+    variants = [name for name in options.variants.split(",") if name]
+    for name in structures + variants:
+        if name not in STRUCTURES and name not in VARIANTS:
+            parser.error(f"unknown structure or variant: {name}")
+
+    work_directory = os.path.join(os.path.dirname(os.path.abspath(options.output)), "work")
+    cases = benchmark_cases(benchmark_cifs(work_directory), structures, sizes, variants, options.lod, work_directory)
+    # Parsing is cached across runs, so every case measures the steady state
+    warm_structure_cache([job for _, job in cases])
+    results = run_cases(cases, max(1, options.repeat), options.timeout, options.memory_mb)
+
+    report = {"environment": environment(), "lod": options.lod, "results": results}
+    temporary_path = f"{options.output}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as fp:
+        json.dump(report, fp, indent=2)
+    os.replace(temporary_path, options.output)
+    print(f"Results written to {options.output}")
+
+    if options.baseline:
+        with open(options.baseline) as fp:
+            regressions = compare_to_baseline(results, json.load(fp), options.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regressions against {options.baseline}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from solidify import solidify
+from mesh_assembler import assemble_mesh
+from web_stl_generator import generate_parts_from_params
+
+CIF_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Yb2Si2O7.cif")
+SUPERCELLS = ([1, 1, 1], [2, 2, 2], [3, 3, 3])
+VOXEL_SIZES = (0.2, 0.1, 0.05)
+
+
+def main():
+    # Raw soup against the signed distance remesh: triangle count, build time and the number of separate
+    # shells a slicer has to merge. Solid times are on top of building the soup's parts
+    print(f"{'cells':>8} {'mesh':>10} {'triangles':>10} {'seconds':>8} {'shells':>10}")
+    for cells in SUPERCELLS:
+        label = "x".join(map(str, cells))
+
+        start = time.perf_counter()
+        parts = generate_parts_from_params(CIF_PATH, cells, [0, 0, 0], [0, 0, 0], 0, True, None, None, 0.1, True)
+        soup = assemble_mesh(parts)
+        elapsed = time.perf_counter() - start
+        print(f"{label:>8} {'soup':>10} {len(soup.faces):>10} {elapsed:>8.2f} {soup.body_count:>10}")
+
+        for voxel_size in VOXEL_SIZES:
+            start = time.perf_counter()
+            solid = solidify(parts, voxel_size)
+            elapsed = time.perf_counter() - start
+            print(f"{label:>8} {f'solid {voxel_size}':>10} {len(solid.faces):>10} {elapsed:>8.2f} "
+                  f"{solid.body_count:>10}")
+
+
+if __name__ == "__main__":
+    main()
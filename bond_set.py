@@ -0,0 +1,54 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from structure_frame import StructureFrame
+
+# What happens to a bond whose far end is a periodic image outside the supercell:
+# keep the full bond, clip it at its midpoint, or omit it
+BOUNDARY_POLICIES = ("keep", "clip", "omit")
+# Bond ends closer than this to an atom are that atom
+MATCH_TOLERANCE = 1e-6
+
+
+def bond_target_atoms(frame):
+    # Atom at the far end of every bond, or -1 when that end is an image outside the supercell
+    targets = frame.bond_targets.copy()
+    unknown = targets < 0
+    if unknown.any() and len(frame):
+        distances, nearest = cKDTree(frame.positions).query(frame.bond_ends[unknown],
+                                                            distance_upper_bound=MATCH_TOLERANCE)
+        targets[unknown] = np.where(np.isfinite(distances), nearest, -1)
+    return targets
+
+
+def canonical_bonds(frame, boundary="keep"):
+    # Every undirected bond is kept once, on its first listed endpoint. Bonds between two atoms of the
+    # supercell are identified by that atom pair; bonds to an outside image by their source atom and end point,
+    # which the frame's site index and fractional end of the bond pin to one periodic image
+    if not isinstance(frame, StructureFrame):
+        raise TypeError("canonical_bonds expects a StructureFrame")
+    boundary = (boundary or "keep").lower()
+    if boundary not in BOUNDARY_POLICIES:
+        raise ValueError(f"Unknown boundary policy: {boundary}")
+    if frame.bond_count == 0:
+        return frame
+
+    sources = frame.bond_sources()
+    targets = bond_target_atoms(frame)
+    internal = targets >= 0
+
+    keep = internal & (sources != targets)
+    pairs = np.stack([np.minimum(sources, targets), np.maximum(sources, targets)], axis=1)[keep]
+    _, first = np.unique(pairs, axis=0, return_index=True)
+    keep_index = np.nonzero(keep)[0][first]
+
+    if boundary != "omit":
+        keep_index = np.concatenate([keep_index, np.nonzero(~internal)[0]])
+    mask = np.zeros(frame.bond_count, dtype=bool)
+    mask[keep_index] = True
+
+    bond_ends = frame.bond_ends
+    if boundary == "clip":
+        bond_ends = np.where(internal[:, np.newaxis], bond_ends, (frame.positions[sources] + bond_ends) / 2)
+    frame = frame.replace(bond_targets=targets)
+    return frame.select_bonds(mask, bond_ends[mask])
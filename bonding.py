@@ -0,0 +1,72 @@
+import numpy as np
+from pymatgen.analysis.graphs import StructureGraph
+from pymatgen.analysis.local_env import CrystalNN
+from pymatgen.analysis.molecule_structure_comparator import CovalentRadius
+
+BONDING_STRATEGIES = ("crystalnn", "covalent", "cutoff", "none")
+DEFAULT_COVALENT_RADIUS = 1.5
+
+
+def bonding_params(bonding="crystalnn", cutoff=3.0, tolerance=0.1):
+    # Normalised description of a strategy, also used as its cache key
+    bonding = (bonding or "none").lower()
+    if bonding not in BONDING_STRATEGIES:
+        raise ValueError(f"Unknown bonding strategy: {bonding}")
+    if bonding == "covalent":
+        return {"strategy": bonding, "tolerance": float(tolerance)}
+    if bonding == "cutoff":
+        return {"strategy": bonding, "cutoff": float(cutoff)}
+    return {"strategy": bonding}
+
+
+def covalent_radii(structure):
+    return np.array([
+        max(CovalentRadius.radius.get(element.symbol, DEFAULT_COVALENT_RADIUS) for element in site.species.elements)
+        for site in structure
+    ])
+
+
+def unique_periodic_edges(center_indices, neighbor_indices, images):
+    # Neighbour lists hold each bond from both ends; keep the copy with i < j, or the positive image for i == j
+    images = images.astype(np.int64)
+    self_image = center_indices == neighbor_indices
+    first_nonzero = np.argmax(images != 0, axis=1)
+    positive_image = images[np.arange(len(images)), first_nonzero] > 0
+    return (center_indices < neighbor_indices) | (self_image & positive_image)
+
+
+def graph_from_neighbor_list(structure, center_indices, neighbor_indices, images, distances):
+    keep = unique_periodic_edges(center_indices, neighbor_indices, images)
+    edges = {
+        (from_index, to_index, (0, 0, 0), tuple(to_jimage)): {"weight": distance}
+        for from_index, to_index, to_jimage, distance in zip(
+            center_indices[keep].tolist(), neighbor_indices[keep].tolist(),
+            images[keep].astype(np.int64).tolist(), distances[keep].tolist())
+    }
+    return StructureGraph.from_edges(structure, edges)
+
+
+def covalent_bonding_graph(structure, tolerance=0.1):
+    radii = covalent_radii(structure)
+    if len(radii) == 0:
+        return StructureGraph.from_empty_graph(structure, name="bonds")
+    center_indices, neighbor_indices, images, distances = structure.get_neighbor_list(
+        2 * radii.max() * (1 + tolerance))
+    keep = distances <= (radii[center_indices] + radii[neighbor_indices]) * (1 + tolerance)
+    return graph_from_neighbor_list(structure, center_indices[keep], neighbor_indices[keep], images[keep],
+                                    distances[keep])
+
+
+def cutoff_bonding_graph(structure, cutoff=3.0):
+    return graph_from_neighbor_list(structure, *structure.get_neighbor_list(cutoff))
+
+
+def build_bonding_graph(structure, params):
+    strategy = params["strategy"]
+    if strategy == "crystalnn":
+        return StructureGraph.from_local_env_strategy(structure, CrystalNN())
+    if strategy == "covalent":
+        return covalent_bonding_graph(structure, params["tolerance"])
+    if strategy == "cutoff":
+        return cutoff_bonding_graph(structure, params["cutoff"])
+    return None
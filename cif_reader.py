@@ -1,63 +1,223 @@
+import asyncio
+import json
+import logging
+
+from monty.json import MontyEncoder
 from pymatgen.io.cif import CifParser
-from pymatgen.analysis.local_env import CrystalNN
-from pymatgen.analysis.graphs import StructureGraph
-from mp_api.client import MPRester
 import numpy as np
+from bonding import bonding_params, build_bonding_graph
+from instrumentation import stage
+from materials_source import STRUCTURE_FIELDS, MaterialDocument, materials_source
+from neighbor_search import nearest_neighbor_bonds
+from structure_cache import graph_key, structure_cache, structure_key
+from structure_file import write_structure_file
+from structure_frame import StructureFrame, concatenated_ranges
+
+logger = logging.getLogger(__name__)
+
+def expand_supercell(structure, num_unit_cells):
+    num_unit_cells = np.asarray(num_unit_cells, dtype=np.float64)
+    repeats = np.ceil(num_unit_cells).astype(int)
+    lattice = structure.lattice.matrix
+
+    # Image translations in nx, ny, nz order, broadcast against every site
+    translations = np.indices(repeats).reshape(3, -1).T
+    frac_coords = structure.frac_coords[np.newaxis, :, :] + translations[:, np.newaxis, :]
+    mask = np.all(frac_coords < num_unit_cells, axis=2)
+    image_indices, site_indices = np.nonzero(mask)
+
+    translations = translations[image_indices]
+    cartesian_coords = structure.cart_coords[site_indices] + translations @ lattice
+    return site_indices, translations, frac_coords[mask], cartesian_coords
+
+
+def connected_sites_by_index(structure, graph):
+    connections = []
+    for idx in range(len(structure)):
+        connected_sites = graph.get_connected_sites(idx) if graph is not None else []
+        connections.append({
+            "connected_to": [connected_site.site.species_string for connected_site in connected_sites],
+            "bond_length": [connected_site.weight for connected_site in connected_sites],
+            "fractional_position": np.array([connected_site.site.frac_coords for connected_site in connected_sites]
+                                            ).reshape(-1, 3),
+            "cartesian_position": np.array([connected_site.site.coords for connected_site in connected_sites]
+                                           ).reshape(-1, 3),
+            "site_index": [connected_site.index for connected_site in connected_sites]
+        })
+    return connections
+
+
+def build_connected_atoms(connections, translation, lattice):
+    connected_fractional_coords = (connections["fractional_position"] + translation).tolist()
+    connected_cartesian_coords = (connections["cartesian_position"] + np.dot(translation, lattice)).tolist()
+    return [
+        {
+            "connected_to": connected_to,
+            "bond_length": bond_length,
+            "connected_fractional_position": fractional_position,
+            "connected_cartesian_position": cartesian_position,
+            "site_index": site_index
+        }
+        for connected_to, bond_length, fractional_position, cartesian_position, site_index in zip(
+            connections["connected_to"], connections["bond_length"], connected_fractional_coords,
+            connected_cartesian_coords, connections["site_index"])
+    ]
+
+
+def build_structure_frame(structure, connections, num_unit_cells, atom_labels, oxi_labels=None, target_atoms=None):
+    lattice = structure.lattice.matrix
+    site_indices, translations, frac_coords, cartesian_coords = expand_supercell(structure, num_unit_cells)
+
+    if target_atoms is not None:
+        keep = np.isin(np.array(atom_labels, dtype=object)[site_indices], list(target_atoms))
+        site_indices, translations = site_indices[keep], translations[keep]
+        frac_coords, cartesian_coords = frac_coords[keep], cartesian_coords[keep]
+
+    # One species code per distinct site label; bonds point back into the same codebook
+    code_labels = oxi_labels if oxi_labels is not None else atom_labels
+    codes = {}
+    for label in code_labels:
+        codes.setdefault(label, len(codes))
+    species = [None] * len(codes)
+    for atom_label, code_label in zip(atom_labels, code_labels):
+        species[codes[code_label]] = atom_label
+    site_codes = np.array([codes[label] for label in code_labels], dtype=np.int32)
+
+    # Flatten the per-site neighbour tables, then gather them for every kept image
+    site_bond_counts = np.array([len(connection["site_index"]) for connection in connections], dtype=np.int64)
+    site_bond_offsets = np.cumsum(site_bond_counts) - site_bond_counts
+    counts = site_bond_counts[site_indices]
+    bond_index = concatenated_ranges(site_bond_offsets[site_indices], counts)
+    bond_translations = np.repeat(translations, counts, axis=0)
+    bond_offsets = np.zeros(len(site_indices) + 1, dtype=np.int64)
+    np.cumsum(counts, out=bond_offsets[1:])
+
+    def flat(key, shape):
+        values = [connection[key] for connection in connections]
+        return np.concatenate([np.asarray(value, dtype=np.float64).reshape(shape) for value in values])
+
+    bond_fractional_ends = flat("fractional_position", (-1, 3))[bond_index] + bond_translations
+    bond_ends = flat("cartesian_position", (-1, 3))[bond_index] + bond_translations @ lattice
+    bond_lengths = flat("bond_length", (-1,))[bond_index]
+    bond_site_indices = np.concatenate([np.asarray(connection["site_index"], dtype=np.int64)
+                                        for connection in connections])[bond_index]
+
+    return StructureFrame(
+        positions=cartesian_coords,
+        species_codes=site_codes[site_indices],
+        species=species,
+        oxi_species=list(codes) if oxi_labels is not None else None,
+        fractional_positions=frac_coords,
+        site_indices=site_indices if oxi_labels is not None else None,
+        bond_offsets=bond_offsets,
+        bond_ends=bond_ends,
+        bond_fractional_ends=bond_fractional_ends,
+        bond_lengths=bond_lengths,
+        bond_site_indices=bond_site_indices,
+        bond_species_codes=site_codes[bond_site_indices],
+    )
+
+
+def load_cif_structure(file_path, is_primitive=False):
+    with open(file_path, "rb") as fp:
+        cif_content = fp.read()
+
+    key = structure_key(cif_content, is_primitive)
+    structure = structure_cache.structure(key)
+    if structure is None:
+        with stage("parse_cif") as record:
+            parser = CifParser(file_path)
+            structure = parser.parse_structures(primitive=is_primitive)[0]
+            record.update(sites=len(structure))
+        structure_cache.store_structure(key, structure)
+    return structure, key
+
+
+def load_bonding_graph(structure, key=None, bonding="crystalnn", **bonding_options):
+    params = bonding_params(bonding, **bonding_options)
+    if params["strategy"] == "none":
+        return None
+    if key is None:
+        with stage("bonding_graph", strategy=params["strategy"]):
+            return build_bonding_graph(structure, params)
+
+    bonding_key = graph_key(key, params)
+    graph = structure_cache.graph(bonding_key, structure)
+    if graph is None:
+        with stage("bonding_graph", strategy=params["strategy"]):
+            graph = build_bonding_graph(structure, params)
+        structure_cache.store_graph(bonding_key, graph)
+    return graph
+
 
 def get_structure_with_cif(file_path, num_unit_cells=None, is_primitive=False, target_atoms=None,
-                           magnetic_spin_atoms=None, site_index_spin=None):
+                           magnetic_spin_atoms=None, site_index_spin=None, as_frame=False, bonding="crystalnn",
+                           bonding_options=None, structure_path=None):
+    # structure_path additionally saves the expanded structure as a memory-mappable structure file
     if num_unit_cells is None:
         num_unit_cells = [1, 1, 1]
 
-    parser = CifParser(file_path)
-    structure = parser.parse_structures(primitive=is_primitive)[0]
+    structure, key = load_cif_structure(file_path, is_primitive)
+    graph = load_bonding_graph(structure, key, bonding, **(bonding_options or {}))
 
-    x_unit_cell, y_unit_cell, z_unit_cell = map(int, np.ceil(num_unit_cells))
+    lattice = structure.lattice.matrix
+    connections = connected_sites_by_index(structure, graph)
+    oxi_labels = [site.species_string for site in structure]
+    atom_labels = [label[:-2] for label in oxi_labels]
+
+    if as_frame or structure_path:
+        with stage("expand_supercell") as record:
+            frame = build_structure_frame(structure, connections, num_unit_cells, atom_labels, oxi_labels, target_atoms)
+            record.update(atoms=len(frame), bonds=frame.bond_count)
+        if magnetic_spin_atoms or site_index_spin:
+            frame = add_magnetic_spin_info(frame, magnetic_spin_atoms, site_index_spin)
+        if structure_path:
+            write_structure_file(structure_path, frame, {"cif": file_path, "num_unit_cells": list(num_unit_cells),
+                                                         "is_primitive": bool(is_primitive)})
+        if as_frame:
+            return frame
+
+    site_indices, translations, frac_coords, cartesian_coords = expand_supercell(structure, num_unit_cells)
 
     unique_atoms = []
-    lattice = structure.lattice.matrix
-    nn = CrystalNN()
-    graph = StructureGraph.from_local_env_strategy(structure, nn)
-
-    for nx in range(x_unit_cell):
-        for ny in range(y_unit_cell):
-            for nz in range(z_unit_cell):
-                for idx, site in enumerate(structure):
-                    fractional_coords = site.frac_coords + np.array([nx, ny, nz])
-                    if all(fractional_coords[i] < num_unit_cells[i] for i in range(3)):
-                        atom_label = site.species_string[:-2]
-                        if target_atoms is None or atom_label in target_atoms:
-                            atom_info = {
-                                "atom_label": atom_label,
-                                "oxi_atom_label": site.species_string,
-                                "fractional_position": fractional_coords.tolist(),
-                                "cartesian_position": (site.coords + np.dot([nx, ny, nz], lattice)).tolist(),
-                                "connected_atoms": [],
-                                "magnetic_spin": {},
-                                "site_index": idx
-                            }
-                            connected_sites = graph.get_connected_sites(idx)
-                            for connected_site in connected_sites:
-                                connected_fractional_coords = connected_site.site.frac_coords + np.array([nx, ny, nz])
-                                connection = {
-                                    "connected_to": connected_site.site.species_string,
-                                    "bond_length": connected_site.weight,
-                                    "connected_fractional_position": connected_fractional_coords.tolist(),
-                                    "connected_cartesian_position": (
-                                            connected_site.site.coords + np.dot([nx, ny, nz], lattice)).tolist(),
-                                    "site_index": connected_site.index
-                                }
-                                atom_info["connected_atoms"].append(connection)
-                            unique_atoms.append(atom_info)
+    for idx, translation, fractional_position, cartesian_position in zip(
+            site_indices.tolist(), translations, frac_coords.tolist(), cartesian_coords.tolist()):
+        atom_label = atom_labels[idx]
+        if target_atoms is None or atom_label in target_atoms:
+            unique_atoms.append({
+                "atom_label": atom_label,
+                "oxi_atom_label": oxi_labels[idx],
+                "fractional_position": fractional_position,
+                "cartesian_position": cartesian_position,
+                "connected_atoms": build_connected_atoms(connections[idx], translation, lattice),
+                "magnetic_spin": {},
+                "site_index": idx
+            })
 
     if magnetic_spin_atoms or site_index_spin:
         unique_atoms = add_magnetic_spin_info(unique_atoms, magnetic_spin_atoms, site_index_spin)
 
-    print(unique_atoms)
+    logger.debug("Expanded structure: %s", unique_atoms)
 
     return unique_atoms
 
 def add_magnetic_spin_info(unique_atoms, magnetic_spin_atoms=None, site_index_spin=None):
+    if isinstance(unique_atoms, StructureFrame):
+        # Per-species and per-site direction tables gathered in one pass each; site directions take precedence
+        species_spins = np.zeros((len(unique_atoms.species), 3))
+        for code, atom_label in enumerate(unique_atoms.species):
+            if magnetic_spin_atoms and atom_label in magnetic_spin_atoms:
+                species_spins[code] = magnetic_spin_atoms[atom_label]
+        spins = species_spins[unique_atoms.species_codes]
+
+        if site_index_spin and unique_atoms.site_indices is not None:
+            site_keys = np.array(sorted(site_index_spin), dtype=np.int64)
+            site_spins = np.array([site_index_spin[key] for key in site_keys.tolist()], dtype=np.float64).reshape(-1, 3)
+            lookup = np.minimum(np.searchsorted(site_keys, unique_atoms.site_indices), len(site_keys) - 1)
+            matched = site_keys[lookup] == unique_atoms.site_indices
+            spins[matched] = site_spins[lookup[matched]]
+        return unique_atoms.replace(spins=spins)
+
     for atom in unique_atoms:
         atom_label = atom['atom_label']
         site_index = atom['site_index']
@@ -69,83 +229,78 @@ def add_magnetic_spin_info(unique_atoms, magnetic_spin_atoms=None, site_index_sp
             atom['magnetic_spin'] = {"direction": [0, 0, 0]}  # No spin
     return unique_atoms
 
-async def fetch_materials(**kwargs):
-    api_key = "cSFVj0Awg9nQlro7yWhYacD4TRst78YZ"
-
+async def fetch_materials(fields=STRUCTURE_FIELDS, material_ids=None, **kwargs):
+    # Runs on the shared materials source: one pooled client, structure fields only, cached structures by id
     try:
-        with MPRester(api_key) as mpr:
-            results = mpr.summary.search(**kwargs)
-            if not results:
-                return "No data found with the given search parameters."
-            return results
+        if material_ids is not None and set(fields) <= set(STRUCTURE_FIELDS):
+            structures = await materials_source.structures(material_ids)
+            results = [MaterialDocument(material_id, structure) for material_id, structure in structures.items()]
+        else:
+            results = await materials_source.search(fields=fields, material_ids=material_ids, **kwargs)
+        if not results:
+            return "No data found with the given search parameters."
+        return results
     except Exception as e:
         return f"Failed to fetch data: {str(e)}"
 
-async def get_structure_with_api(structure, num_unit_cells=None, target_atoms=None):
+async def get_structure_with_api(structure, num_unit_cells=None, target_atoms=None, as_frame=False,
+                                 bonding="crystalnn", bonding_options=None):
+    # Bonding and expansion run off the event loop
+    return await asyncio.to_thread(structure_from_api, structure, num_unit_cells, target_atoms, as_frame, bonding,
+                                   bonding_options)
+
+def structure_from_api(structure, num_unit_cells=None, target_atoms=None, as_frame=False, bonding="crystalnn",
+                       bonding_options=None):
     if num_unit_cells is None:
         num_unit_cells = [1, 1, 1]
 
-    x_unit_cell, y_unit_cell, z_unit_cell = map(int, np.ceil(num_unit_cells))
-
-    unique_atoms = []
-    structure = structure[0].structure
+    # Accepts fetch_materials results, one document or a Structure
+    if isinstance(structure, (list, tuple)):
+        structure = structure[0]
+    structure = getattr(structure, "structure", structure)
     lattice = structure.lattice.matrix
 
-    nn = CrystalNN()
-    graph = StructureGraph.from_local_env_strategy(structure, nn)
-
-    for nx in range(x_unit_cell):
-        for ny in range(y_unit_cell):
-            for nz in range(z_unit_cell):
-                for idx, site in enumerate(structure):
-                    fractional_coords = site.frac_coords + np.array([nx, ny, nz])
-                    if all(fractional_coords[i] < num_unit_cells[i] for i in range(3)):
-                        atom_label = site.species_string
-                        if target_atoms is None or atom_label in target_atoms:
-                            atom_info = {
-                                "atom_label": atom_label,
-                                "fractional_position": fractional_coords.tolist(),
-                                "cartesian_position": (site.coords + np.dot([nx, ny, nz], lattice)).tolist(),
-                                "connected_atoms": []
-                            }
-                            connected_sites = graph.get_connected_sites(idx)
-                            for connected_site in connected_sites:
-                                connected_fractional_coords = connected_site.site.frac_coords + np.array([nx, ny, nz])
-                                connection = {
-                                    "connected_to": connected_site.site.species_string,
-                                    "bond_length": connected_site.weight,
-                                    "connected_fractional_position": connected_fractional_coords.tolist(),
-                                    "connected_cartesian_position": (
-                                            connected_site.site.coords + np.dot([nx, ny, nz], lattice)).tolist(),
-                                    "site_index": connected_site.index
-                                }
-                                atom_info["connected_atoms"].append(connection)
-
-                            unique_atoms.append(atom_info)
+    # Keyed on the structure's content, so bonding graphs are shared with the CIF path and across requests
+    key = structure_key(json.dumps(structure.as_dict(), cls=MontyEncoder, sort_keys=True).encode("utf8"), False)
+    graph = load_bonding_graph(structure, key, bonding, **(bonding_options or {}))
+    connections = connected_sites_by_index(structure, graph)
+    atom_labels = [site.species_string for site in structure]
+
+    if as_frame:
+        return build_structure_frame(structure, connections, num_unit_cells, atom_labels, target_atoms=target_atoms)
+
+    site_indices, translations, frac_coords, cartesian_coords = expand_supercell(structure, num_unit_cells)
+
+    unique_atoms = []
+    for idx, translation, fractional_position, cartesian_position in zip(
+            site_indices.tolist(), translations, frac_coords.tolist(), cartesian_coords.tolist()):
+        atom_label = atom_labels[idx]
+        if target_atoms is None or atom_label in target_atoms:
+            unique_atoms.append({
+                "atom_label": atom_label,
+                "fractional_position": fractional_position,
+                "cartesian_position": cartesian_position,
+                "connected_atoms": build_connected_atoms(connections[idx], translation, lattice)
+            })
 
     return unique_atoms
 
 def bond_by_nearest_neighbors(data, tolerance=0.1):
+    if isinstance(data, StructureFrame):
+        rows, cols = nearest_neighbor_bonds(data.positions, tolerance=tolerance)
+        return data.with_bond_pairs(rows, cols)
+
     positions = np.array([atom['cartesian_position'] for atom in data])
-    distance_matrix = np.linalg.norm(positions[:, np.newaxis] - positions, axis=2)
-    np.fill_diagonal(distance_matrix, np.inf)
-    min_distances = np.min(distance_matrix, axis=1)
-    nearest_neighbors_indices = np.argmin(distance_matrix, axis=1)
+    rows, cols = nearest_neighbor_bonds(positions, tolerance=tolerance)
 
     for atom in data:
         atom['connected_atoms'] = []
 
-    for index, atom in enumerate(data):
-        nearest_distance = min_distances[index]
-        close_indices = np.where((distance_matrix[index] <= nearest_distance * (1 + tolerance)) &
-                                 (distance_matrix[index] >= nearest_distance * (1 - tolerance)))[0]
-
-        for close_index in close_indices:
-            if close_index != index:
-                connection = {
-                    'nearest_neighbor_index': close_index,
-                    'connected_cartesian_position': data[close_index]['cartesian_position']
-                }
-                atom['connected_atoms'].append(connection)
+    for index, close_index in zip(rows.tolist(), cols.tolist()):
+        connection = {
+            'nearest_neighbor_index': close_index,
+            'connected_cartesian_position': data[close_index]['cartesian_position']
+        }
+        data[index]['connected_atoms'].append(connection)
 
     return data
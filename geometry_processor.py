@@ -1,109 +1,137 @@
 import numpy as np
 import trimesh
-
-
-def create_base_cylinder(position, base_radius, height, small_cylinder_height=0.5, small_cylinder_radius=0.5):
-    main_height = height - small_cylinder_height
-    base = trimesh.creation.cylinder(radius=base_radius, height=main_height, sections=32)
-    base_translation = np.array([position[0], position[1], position[2] - main_height / 2 - small_cylinder_height])
-    base.apply_translation(base_translation)
-    small_cylinder = trimesh.creation.cylinder(radius=small_cylinder_radius, height=small_cylinder_height, sections=32)
-    small_translation = np.array([position[0], position[1], position[2] - small_cylinder_height / 2])
-    small_cylinder.apply_translation(small_translation)
-    combined_cylinder = base + small_cylinder
-    return combined_cylinder
-
-
-def create_small_cylinder(position, height, radius):
-    cylinder = trimesh.creation.cylinder(radius=radius, height=height, sections=32)
-    cylinder.apply_translation([position[0], position[1], position[2] - height / 2])
-    return cylinder
-
-
-def check_atom_between(atom_position, support_position, atom_radius, support_height):
-    # Check if there is any atom in the path of the vertical support
-    z1 = support_position[2]
-    z2 = support_position[2] - support_height
-    return z1 > atom_position[2] > z2 and np.linalg.norm(
-        np.array(support_position[:2]) - np.array(atom_position[:2])) < atom_radius
-
-
-def add_supports(atoms_and_bonds_mesh, structure, atomic_radii, base_level=0.0):
-    for atom in structure:
-        atom_radius = atomic_radii[atom['atom_label']]
-        height_to_base = float(atom['cartesian_position'][2]) - float(base_level)
-
-        if height_to_base > 0:
-            support_position = atom['cartesian_position']
-            support_height = height_to_base
-
-            # Check if any atom is between the support
-            atoms_between = [a for a in structure if
-                             a != atom and check_atom_between(a['cartesian_position'], support_position,
-                                                              atomic_radii[a['atom_label']], support_height)]
-
-            if atoms_between:
-                for between_atom in atoms_between:
-                    between_position = between_atom['cartesian_position']
-                    between_radius = atomic_radii[between_atom['atom_label']]
-
-                    # Add base cylinder up to just before the between_atom
-                    base_cylinder = create_base_cylinder(position=support_position,
-                                                         base_radius=atom_radius * 0.2,
-                                                         height=support_position[2] - between_position[
-                                                             2] - between_radius - 0.05,
-                                                         small_cylinder_height=atom_radius + 0.03,
-                                                         small_cylinder_radius=atom_radius * 0.2)
-                    atoms_and_bonds_mesh += base_cylinder
-
-                    # Add small cylinder on top of the between_atom
-                    top_small_cylinder = create_small_cylinder(position=[between_position[0], between_position[1], between_position[2]+between_radius+0.05],
-                                                               height=0.7,
-                                                               radius=between_radius * 0.2)
-                    atoms_and_bonds_mesh += top_small_cylinder
-
-                    # Adjust the support position and height for the remaining support
-                    support_position = [between_position[0], between_position[1],
-                                        between_position[2] - between_radius - 0.01]
-                    support_height = support_position[2] - base_level
-
-                # Finally, add the remaining base cylinder from the last adjusted position
-                base_cylinder = create_base_cylinder(position=support_position,
-                                                     base_radius=atom_radius * 0.2,
-                                                     height=support_height,
-                                                     small_cylinder_height=atom_radius + 0.03,
-                                                     small_cylinder_radius=atom_radius * 0.2)
-                atoms_and_bonds_mesh += base_cylinder
-            else:
-                base_cylinder = create_base_cylinder(position=support_position,
-                                                     base_radius=atom_radius * 0.2,
-                                                     height=support_height,
-                                                     small_cylinder_height=atom_radius + 0.03,
-                                                     small_cylinder_radius=atom_radius * 0.2)
-                atoms_and_bonds_mesh += base_cylinder
-
-    return atoms_and_bonds_mesh
-
-
-
-
-def translate_structure(atoms_data, translation):
-    translated_atoms = []
-    for atom in atoms_data:
-        new_atom = atom.copy()
-        new_atom['cartesian_position'] = [
-            atom['cartesian_position'][0] + translation[0],
-            atom['cartesian_position'][1] + translation[1],
-            atom['cartesian_position'][2] + translation[2]
-        ]
-        for connected_atom in new_atom['connected_atoms']:
-            connected_atom['connected_cartesian_position'] = [
-                connected_atom['connected_cartesian_position'][0] + translation[0],
-                connected_atom['connected_cartesian_position'][1] + translation[1],
-                connected_atom['connected_cartesian_position'][2] + translation[2]
-            ]
-        translated_atoms.append(new_atom)
-    return translated_atoms
+from mesh_assembler import assemble_mesh, vertical_cylinder_parts
+from structure_frame import StructureFrame, concatenated_ranges
+
+
+def base_cylinder_segments(positions, base_radii, heights, small_cylinder_heights, small_cylinder_radii):
+    # A main column ending small_cylinder_height below each position, capped by a thinner neck up to it
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    main_heights = heights - small_cylinder_heights
+
+    main_centers = positions - np.stack([np.zeros_like(heights), np.zeros_like(heights),
+                                         main_heights / 2 + small_cylinder_heights], axis=1)
+    small_centers = positions - np.stack([np.zeros_like(heights), np.zeros_like(heights),
+                                          small_cylinder_heights / 2], axis=1)
+    return (np.concatenate([main_centers, small_centers]),
+            np.concatenate([base_radii, small_cylinder_radii]),
+            np.concatenate([main_heights, small_cylinder_heights]))
+
+
+def find_blockers(positions, radii, base_level=0.0, chunk_size=2048):
+    # Pairs (supported atom, blocking atom) where the blocker sits between the atom and the base
+    # and overlaps the vertical line below it; blockers come out sorted top to bottom per atom
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    n_atoms = len(positions)
+    empty = np.empty(0, dtype=np.int64)
+    if n_atoms == 0:
+        return empty, empty.copy()
+
+    # Bin into an XY grid no finer than the largest blocker radius, padded so neighbour cells never alias
+    cell_size = max(float(radii.max()), 1e-9)
+    cells = np.floor(positions[:, :2] / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    n_rows = int(cells[:, 1].max()) + 2
+    cell_keys = cells[:, 0] * n_rows + cells[:, 1]
+
+    # Sort once by (cell, z); integer z ranks keep the composite key exact
+    z = positions[:, 2]
+    sorted_z = np.sort(z)
+    z_ranks = np.searchsorted(sorted_z, z, side='left')
+    stride = n_atoms + 1
+    composite = cell_keys * stride + z_ranks
+    order = np.argsort(composite, kind='stable')
+    composite = composite[order]
+    base_rank = np.searchsorted(sorted_z, base_level, side='right')
+
+    supported = np.nonzero(z > base_level)[0]
+    offsets = np.array([dx * n_rows + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)], dtype=np.int64)
+    atom_pairs, blocker_pairs = [], []
+
+    for start in range(0, len(supported), chunk_size):
+        atoms = supported[start:start + chunk_size]
+        neighbour_keys = (cell_keys[atoms][:, np.newaxis] + offsets).ravel()
+        atom_ids = np.repeat(atoms, len(offsets))
+        lower = np.searchsorted(composite, neighbour_keys * stride + base_rank, side='left')
+        upper = np.searchsorted(composite, neighbour_keys * stride + z_ranks[atom_ids], side='left')
+
+        counts = np.maximum(upper - lower, 0)
+        candidates = order[concatenated_ranges(lower, counts)]
+        atom_ids = np.repeat(atom_ids, counts)
+
+        distances = np.linalg.norm(positions[candidates, :2] - positions[atom_ids, :2], axis=1)
+        keep = distances < radii[candidates]
+        atom_pairs.append(atom_ids[keep])
+        blocker_pairs.append(candidates[keep])
+
+    if not atom_pairs:
+        return empty, empty.copy()
+    atom_ids = np.concatenate(atom_pairs)
+    blockers = np.concatenate(blocker_pairs)
+    pair_order = np.lexsort((-z[blockers], atom_ids))
+    return atom_ids[pair_order], blockers[pair_order]
+
+
+def plan_supports(positions, radii, base_level=0.0):
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+    known = ~np.isnan(radii)
+    positions, radii = positions[known], radii[known]
+    atom_ids, blockers = find_blockers(positions, radii, base_level)
+
+    blocker_radii = radii[blockers]
+    blocker_tops = positions[blockers] + np.stack(
+        [np.zeros_like(blocker_radii), np.zeros_like(blocker_radii), blocker_radii + 0.05], axis=1)
+    blocker_bottoms = positions[blockers] - np.stack(
+        [np.zeros_like(blocker_radii), np.zeros_like(blocker_radii), blocker_radii + 0.01], axis=1)
+
+    # Each column segment starts at the atom itself or just under the previous blocker
+    first = np.ones(len(atom_ids), dtype=bool)
+    first[1:] = atom_ids[1:] != atom_ids[:-1]
+    segment_starts = np.empty_like(blocker_bottoms)
+    segment_starts[first] = positions[atom_ids[first]]
+    segment_starts[~first] = blocker_bottoms[np.nonzero(~first)[0] - 1]
+    segment_heights = segment_starts[:, 2] - positions[blockers, 2] - blocker_radii - 0.05
+
+    # The last segment of every supported atom runs down to the base
+    supported = np.nonzero(positions[:, 2] > base_level)[0]
+    final_starts = positions[supported].copy()
+    last = np.ones(len(atom_ids), dtype=bool)
+    last[:-1] = atom_ids[1:] != atom_ids[:-1]
+    final_starts[np.searchsorted(supported, atom_ids[last])] = blocker_bottoms[last]
+    final_heights = final_starts[:, 2] - base_level
+
+    column_atoms = np.concatenate([atom_ids, supported])
+    column_radii = radii[column_atoms] * 0.2
+    centers, cylinder_radii, heights = base_cylinder_segments(
+        np.concatenate([segment_starts, final_starts]), column_radii,
+        np.concatenate([segment_heights, final_heights]), radii[column_atoms] + 0.03, column_radii)
+
+    # Short pegs resting on top of every blocker
+    peg_heights = np.full(len(blockers), 0.7)
+    peg_centers = blocker_tops - np.stack([np.zeros_like(peg_heights), np.zeros_like(peg_heights),
+                                           peg_heights / 2], axis=1)
+
+    return (np.concatenate([centers, peg_centers]), np.concatenate([cylinder_radii, blocker_radii * 0.2]),
+            np.concatenate([heights, peg_heights]))
+
+
+def support_parts(structure, atomic_radii, base_level=0.0, tessellation=None):
+    if isinstance(structure, StructureFrame):
+        positions = structure.positions
+        radii = structure.species_values(atomic_radii)
+    else:
+        positions = np.array([atom['cartesian_position'] for atom in structure], dtype=np.float64).reshape(-1, 3)
+        radii = np.array([np.nan if atomic_radii.get(atom['atom_label']) is None else atomic_radii[atom['atom_label']]
+                          for atom in structure], dtype=np.float64)
+    return vertical_cylinder_parts(*plan_supports(positions, radii, float(base_level)), tessellation=tessellation)
+
+
+def add_supports(atoms_and_bonds_mesh, structure, atomic_radii, base_level=0.0, tessellation=None):
+    supports = assemble_mesh(support_parts(structure, atomic_radii, base_level, tessellation))
+    if len(supports.faces) == 0:
+        return atoms_and_bonds_mesh
+    return trimesh.util.concatenate([atoms_and_bonds_mesh, supports])
 
 
 def rotate_x(coord, theta):
@@ -130,32 +158,87 @@ def rotate_z(coord, theta):
     return np.dot(R, coord)
 
 
-def rotate_structure(atoms_data, angles):
-    rotated_atoms = []
-    for atom in atoms_data:
-        new_atom = atom.copy()
-        current_position = np.array(atom['cartesian_position'])
+def rotation_matrix(angles):
+    # Rotations in the order x, y, z as a homogeneous 4x4 matrix
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotate_z(rotate_y(rotate_x(np.eye(3), angles[0]), angles[1]), angles[2])
+    return matrix
 
-        # Apply rotations in the order: x, y, z
-        current_position = rotate_x(current_position, angles[0])
-        current_position = rotate_y(current_position, angles[1])
-        current_position = rotate_z(current_position, angles[2])
 
-        new_atom['cartesian_position'] = current_position.tolist()
+def translation_matrix(translation):
+    matrix = np.eye(4)
+    matrix[:3, 3] = translation
+    return matrix
 
-        for connected_atom in new_atom['connected_atoms']:
-            current_connected_position = np.array(connected_atom['connected_cartesian_position'])
 
-            # Apply rotations in the order: x, y, z
-            current_connected_position = rotate_x(current_connected_position, angles[0])
-            current_connected_position = rotate_y(current_connected_position, angles[1])
-            current_connected_position = rotate_z(current_connected_position, angles[2])
+def compose_transform(steps):
+    # steps is a sequence of ("rotate", angles) / ("translate", vector) applied first to last
+    matrix = np.eye(4)
+    for kind, value in steps:
+        if kind == "rotate":
+            step = rotation_matrix(value)
+        elif kind == "translate":
+            step = translation_matrix(value)
+        else:
+            raise ValueError(f"Unknown transform step: {kind}")
+        matrix = step @ matrix
+    return matrix
 
-            connected_atom['connected_cartesian_position'] = current_connected_position.tolist()
 
-        rotated_atoms.append(new_atom)
+def apply_transform(points, matrix):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
 
-    return rotated_atoms
+
+def transform_structure(atoms_data, matrix):
+    if isinstance(atoms_data, StructureFrame):
+        return atoms_data.replace(positions=apply_transform(atoms_data.positions, matrix),
+                                  bond_ends=apply_transform(atoms_data.bond_ends, matrix))
+
+    # Atom and bond-endpoint coordinates go through one batched product
+    points = [atom['cartesian_position'] for atom in atoms_data]
+    points += [connected_atom['connected_cartesian_position']
+               for atom in atoms_data for connected_atom in atom['connected_atoms']]
+    transformed = iter(apply_transform(points, matrix).tolist())
+    positions = [next(transformed) for _ in atoms_data]
+
+    transformed_atoms = []
+    for atom, position in zip(atoms_data, positions):
+        new_atom = atom.copy()
+        new_atom['cartesian_position'] = position
+        new_atom['connected_atoms'] = [dict(connected_atom, connected_cartesian_position=next(transformed))
+                                       for connected_atom in atom['connected_atoms']]
+        transformed_atoms.append(new_atom)
+    return transformed_atoms
+
+
+def is_sphere_template(vertices):
+    # Every vertex at the same distance from the origin, like the atom sphere templates
+    radii = np.linalg.norm(vertices, axis=1)
+    return len(radii) == 0 or np.ptp(radii) <= 1e-9 * max(radii.max(), 1.0)
+
+
+def transform_parts(parts, matrix):
+    # Moves instanced parts rigidly: offsets are transformed and rotations compose onto each instance's linear map.
+    # Sphere templates without a linear map only move with their offsets; any other part without one (a wrapped
+    # mesh, say) is given the rotation as its linear map
+    rotation = matrix[:3, :3]
+    transformed = []
+    for vertices, faces, linear, offsets in parts:
+        if linear is not None:
+            linear = rotation @ linear
+        elif not is_sphere_template(vertices):
+            linear = np.repeat(rotation[np.newaxis], len(offsets), axis=0)
+        transformed.append((vertices, faces, linear, apply_transform(offsets, matrix)))
+    return transformed
+
+
+def translate_structure(atoms_data, translation):
+    return transform_structure(atoms_data, translation_matrix(translation))
+
+
+def rotate_structure(atoms_data, angles):
+    return transform_structure(atoms_data, rotation_matrix(angles))
 
 
 def process_geometry(atoms, cell_parameters, magnetic_spins):
@@ -0,0 +1,114 @@
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+GLB_MAGIC = 0x46546C67
+JSON_CHUNK = 0x4E4F534A
+BIN_CHUNK = 0x004E4942
+FLOAT, UNSIGNED_INT = 5126, 5125
+ARRAY_BUFFER, ELEMENT_ARRAY_BUFFER = 34962, 34963
+INSTANCING_EXTENSION = "EXT_mesh_gpu_instancing"
+# glTF is y-up while the structures are z-up: a quarter turn about x on the root node
+Z_UP_ROTATION = [-0.7071067811865476, 0.0, 0.0, 0.7071067811865476]
+
+
+def decompose_linear(linear):
+    # Part transforms are a rotation times a per-axis scale, which maps directly onto glTF TRS
+    scales = np.linalg.norm(linear, axis=1)
+    # Mirrored transforms (e.g. supports with a negative height) keep the mirror in the z scale
+    scales[np.linalg.det(linear) < 0, 2] *= -1
+    rotations = linear / np.where(scales != 0, scales, 1.0)[:, np.newaxis, :]
+    return Rotation.from_matrix(rotations).as_quat(), scales
+
+
+class GlbBuilder:
+    def __init__(self):
+        self.document = {"asset": {"version": "2.0", "generator": "CrystalPrinter"}, "scene": 0,
+                         "scenes": [{"nodes": [0]}], "nodes": [{"rotation": Z_UP_ROTATION, "children": []}],
+                         "meshes": [], "accessors": [], "bufferViews": [], "buffers": []}
+        self.chunks = []
+        self.length = 0
+        self.materials = {}
+
+    def add_material(self, name, color):
+        if name not in self.materials:
+            self.document.setdefault("materials", []).append(
+                {"name": name, "pbrMetallicRoughness": {"baseColorFactor": [*color, 1.0], "metallicFactor": 0.0}})
+            self.materials[name] = len(self.document["materials"]) - 1
+        return self.materials[name]
+
+    def add_accessor(self, values, component_type, accessor_type, target=None, bounds=False):
+        data = np.ascontiguousarray(values).tobytes()
+        view = {"buffer": 0, "byteOffset": self.length, "byteLength": len(data)}
+        if target is not None:
+            view["target"] = target
+        self.document["bufferViews"].append(view)
+        self.chunks.append(data)
+        self.length += len(data)
+
+        accessor = {"bufferView": len(self.document["bufferViews"]) - 1, "componentType": component_type,
+                    "count": len(values), "type": accessor_type}
+        if bounds:
+            accessor["min"] = values.min(axis=0).tolist()
+            accessor["max"] = values.max(axis=0).tolist()
+        self.document["accessors"].append(accessor)
+        return len(self.document["accessors"]) - 1
+
+    def add_part(self, part, material=None):
+        vertices, faces, linear, offsets = part
+        position = self.add_accessor(np.asarray(vertices, dtype=np.float32), FLOAT, "VEC3", ARRAY_BUFFER, bounds=True)
+        indices = self.add_accessor(np.asarray(faces, dtype=np.uint32).reshape(-1), UNSIGNED_INT, "SCALAR",
+                                    ELEMENT_ARRAY_BUFFER)
+        primitive = {"attributes": {"POSITION": position}, "indices": indices}
+        if material is not None:
+            primitive["material"] = material
+        self.document["meshes"].append({"primitives": [primitive]})
+
+        # The template is stored once; every instance is a translation, rotation and scale
+        attributes = {"TRANSLATION": self.add_accessor(np.asarray(offsets, dtype=np.float32), FLOAT, "VEC3")}
+        if linear is not None:
+            rotations, scales = decompose_linear(linear)
+            attributes["ROTATION"] = self.add_accessor(rotations.astype(np.float32), FLOAT, "VEC4")
+            attributes["SCALE"] = self.add_accessor(scales.astype(np.float32), FLOAT, "VEC3")
+        self.document["nodes"].append({"mesh": len(self.document["meshes"]) - 1,
+                                       "extensions": {INSTANCING_EXTENSION: {"attributes": attributes}}})
+        self.document["nodes"][0]["children"].append(len(self.document["nodes"]) - 1)
+
+    def to_bytes(self):
+        self.document["buffers"] = [{"byteLength": self.length}]
+        if self.document["meshes"]:
+            self.document["extensionsUsed"] = [INSTANCING_EXTENSION]
+            self.document["extensionsRequired"] = [INSTANCING_EXTENSION]
+        json_chunk = json.dumps(self.document, separators=(",", ":")).encode("utf8")
+        json_chunk += b" " * (-len(json_chunk) % 4)
+        bin_chunk = b"".join(self.chunks)
+        bin_chunk += b"\0" * (-len(bin_chunk) % 4)
+
+        total = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+        return b"".join([struct.pack("<III", GLB_MAGIC, 2, total),
+                         struct.pack("<II", len(json_chunk), JSON_CHUNK), json_chunk,
+                         struct.pack("<II", len(bin_chunk), BIN_CHUNK), bin_chunk])
+
+
+def write_glb(file_path, parts, materials=None, material_color=None):
+    # Instanced glTF: output size follows the number of distinct templates plus a few floats per instance.
+    # materials optionally names each part; material_color maps a name to its RGB base color
+    builder = GlbBuilder()
+    for index, part in enumerate(parts):
+        if len(part[3]):
+            material = None
+            if materials is not None:
+                color = material_color(materials[index]) if material_color else (0.8, 0.8, 0.8)
+                material = builder.add_material(materials[index], [float(channel) for channel in color])
+            builder.add_part(part, material)
+
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as fp:
+        fp.write(builder.to_bytes())
+    os.replace(temporary_path, file_path)
+
+    return sum(len(part[1]) * len(part[3]) for part in parts)
@@ -0,0 +1,133 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+INSTRUMENTATION_ENABLED = os.environ.get("CRYSTALPRINTER_INSTRUMENT", "").lower() in ("1", "true", "yes", "on")
+INSTRUMENTATION_LOG = os.environ.get("CRYSTALPRINTER_INSTRUMENT_LOG")
+
+_sinks = []
+_local = threading.local()
+
+
+class JsonLinesSink:
+    # Appends one JSON object per finished run
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock, open(self.path, "a") as fp:
+            fp.write(line + "\n")
+
+
+class MemorySink:
+    # Keeps the most recent runs, e.g. for an in-app panel
+    def __init__(self, max_runs=20):
+        self.runs = deque(maxlen=max_runs)
+
+    def __call__(self, record):
+        self.runs.append(record)
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def set_enabled(enabled=True):
+    global INSTRUMENTATION_ENABLED
+    INSTRUMENTATION_ENABLED = enabled
+
+
+def is_enabled():
+    return INSTRUMENTATION_ENABLED or bool(getattr(_local, "captures", None))
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS; it is the process peak so far
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+@contextmanager
+def run(name, **metadata):
+    # Groups the stages of one pipeline invocation; the finished run goes to every sink and capture
+    if not is_enabled() or getattr(_local, "run", None) is not None:
+        yield getattr(_local, "run", None)
+        return
+
+    record = {"run": name, "id": uuid.uuid4().hex, "metadata": metadata, "started": time.time(), "stages": []}
+    _local.run, _local.stack = record, []
+    start = time.perf_counter()
+    try:
+        yield record
+        record["status"] = "done"
+    except BaseException as e:
+        record["status"] = "failed"
+        record["error"] = str(e)
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        record["peak_rss_mb"] = peak_rss_mb()
+        _local.run, _local.stack = None, []
+        for sink in list(_sinks) + list(getattr(_local, "captures", None) or []):
+            sink(record)
+
+
+@contextmanager
+def stage(name, **counts):
+    # Yields the stage record so callers can add atom, bond or triangle counts; a plain dict when disabled
+    record = getattr(_local, "run", None)
+    if record is None or not is_enabled():
+        yield {}
+        return
+
+    _local.stack.append(name)
+    entry = dict(counts, stage="/".join(_local.stack))
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        entry["seconds"] = time.perf_counter() - start
+        entry["rss_mb"] = current_rss_mb()
+        entry["peak_rss_mb"] = peak_rss_mb()
+        _local.stack.pop()
+        record["stages"].append(entry)
+
+
+@contextmanager
+def capture():
+    # Collects the runs finished inside the block, instrumented even when instrumentation is globally off
+    runs = []
+    captures = getattr(_local, "captures", None)
+    if captures is None:
+        captures = _local.captures = []
+    captures.append(runs.append)
+    try:
+        yield runs
+    finally:
+        captures.remove(runs.append)
+
+
+if INSTRUMENTATION_LOG:
+    add_sink(JsonLinesSink(INSTRUMENTATION_LOG))
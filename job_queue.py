@@ -0,0 +1,182 @@
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+from instrumentation import capture
+
+JOB_DIRECTORY = os.environ.get("CRYSTALPRINTER_JOB_DIR", "jobs")
+MAX_CONCURRENT_JOBS = int(os.environ.get("CRYSTALPRINTER_MAX_JOBS", 2))
+JOB_TTL_SECONDS = int(os.environ.get("CRYSTALPRINTER_JOB_TTL", 24 * 60 * 60))
+# Per-stage timings and memory of every job, stored in its record for the UI
+JOB_METRICS = os.environ.get("CRYSTALPRINTER_JOB_METRICS", "1").lower() in ("1", "true", "yes", "on")
+
+FINISHED_STATES = ("done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _record_path(directory, job_id):
+    return os.path.join(directory, f"{job_id}.json")
+
+
+def _cancel_path(directory, job_id):
+    return os.path.join(directory, f"{job_id}.cancel")
+
+
+def _remove_cancel(directory, job_id):
+    try:
+        os.remove(_cancel_path(directory, job_id))
+    except FileNotFoundError:
+        pass
+
+
+def _write_record(directory, job_id, **fields):
+    path = _record_path(directory, job_id)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w") as fp:
+        json.dump(dict(fields, job_id=job_id, updated=time.time()), fp)
+    os.replace(temporary_path, path)
+
+
+def read_job(directory, job_id):
+    try:
+        with open(_record_path(directory, job_id)) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def run_job(directory, job_id, function, args, kwargs):
+    # Runs inside a pool worker; progress and the outcome go through the job record so any server process can poll it
+    cancel_path = _cancel_path(directory, job_id)
+
+    def report(stage, fraction=None):
+        if os.path.exists(cancel_path):
+            raise JobCancelled(job_id)
+        _write_record(directory, job_id, state="running", stage=stage, progress=fraction)
+
+    try:
+        with capture() if JOB_METRICS else nullcontext([]) as runs:
+            try:
+                report("starting", 0.0)
+                result = function(*args, progress=report, **kwargs)
+                # A cancel that arrived during the last stage still wins over the finished result
+                if os.path.exists(cancel_path):
+                    raise JobCancelled(job_id)
+            except JobCancelled:
+                _write_record(directory, job_id, state="cancelled")
+                return None
+            except Exception as e:
+                _write_record(directory, job_id, state="failed", error=str(e), traceback=traceback.format_exc(),
+                              metrics=runs)
+                return None
+
+        _write_record(directory, job_id, state="done", progress=1.0, result=result, metrics=runs)
+        return result
+    finally:
+        _remove_cancel(directory, job_id)
+
+
+class JobQueue:
+    def __init__(self, directory=JOB_DIRECTORY, max_workers=MAX_CONCURRENT_JOBS, ttl=JOB_TTL_SECONDS):
+        self.directory = directory
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self._executor = None
+        self._futures = {}
+        self._keyed_jobs = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args, job_key=None, job_owner=None, **kwargs):
+        # Jobs submitted with the same job_key while one is still pending share that job; job_owner (a session)
+        # is remembered so one owner's cancel does not stop the job while others still wait for it
+        os.makedirs(self.directory, exist_ok=True)
+        self._prune()
+
+        with self._lock:
+            if job_key is not None and job_key in self._keyed_jobs:
+                job_id = self._keyed_jobs[job_key]
+                self._owners.setdefault(job_id, set()).add(job_owner)
+                return job_id
+
+            job_id = uuid.uuid4().hex
+            _write_record(self.directory, job_id, state="queued", submitted=time.time())
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            future = self._executor.submit(run_job, self.directory, job_id, function, args, kwargs)
+            self._futures[job_id] = future
+            self._owners[job_id] = {job_owner}
+            if job_key is not None:
+                self._keyed_jobs[job_key] = job_id
+        future.add_done_callback(lambda done: self._finish(job_id, done))
+        return job_id
+
+    def status(self, job_id):
+        record = read_job(self.directory, job_id)
+        if record is None:
+            return {"job_id": job_id, "state": "unknown"}
+        return record
+
+    def cancel(self, job_id, job_owner=None):
+        # Withdraws job_owner from the job, which only stops once no other owner is left
+        record = read_job(self.directory, job_id)
+        if record is None or record["state"] in FINISHED_STATES:
+            return False
+
+        with self._lock:
+            owners = self._owners.get(job_id)
+            if owners is not None:
+                owners.discard(job_owner)
+                if owners:
+                    return True
+                # New submits of the same request must not join a job that is being stopped
+                for job_key in [key for key, keyed_id in self._keyed_jobs.items() if keyed_id == job_id]:
+                    del self._keyed_jobs[job_key]
+            future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            _write_record(self.directory, job_id, state="cancelled")
+            return True
+
+        # Running (or owned by another server process): the worker stops at its next stage boundary
+        with open(_cancel_path(self.directory, job_id), "w"):
+            pass
+        return True
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _finish(self, job_id, future):
+        with self._lock:
+            self._futures.pop(job_id, None)
+            self._owners.pop(job_id, None)
+            for job_key in [key for key, keyed_id in self._keyed_jobs.items() if keyed_id == job_id]:
+                del self._keyed_jobs[job_key]
+        # A cancel that raced the end of the job leaves a flag run_job could not see
+        _remove_cancel(self.directory, job_id)
+        # run_job records its own outcome; this only catches workers that died mid-job
+        if not future.cancelled() and future.exception() is not None:
+            _write_record(self.directory, job_id, state="failed", error=str(future.exception()))
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+job_queue = JobQueue()
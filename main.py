@@ -1,24 +1,23 @@
-from dash import Dash, html, dcc, Input, Output, State, callback_context
+from dash import Dash, html, dcc, Input, Output, State, callback_context, no_update
 import dash_vtk
 from dash_vtk.utils import to_mesh_state
+from dash_vtk.utils.vtk import b64_encode_numpy
 import base64
+import logging
 import os
-from web_stl_generator import generate_stl_from_params
-from vtkmodules.vtkIOGeometry import vtkSTLReader
+import uuid
+import numpy as np
+from artifact_store import artifact_store
+from job_queue import job_queue
+from mesh_export import export_extension
+from mesh_preview import PREVIEW_EXTENSION, load_preview
+from tessellation import DEFAULT_NOZZLE_DIAMETER, tessellation_params
+from mesh_assembler import PARTS_EXTENSION
+from web_stl_generator import export_parts, generate_preview_from_params
 from vtkmodules.vtkFiltersSources import vtkPlaneSource
 
-# Create a temporary directory to store uploaded files
-UPLOAD_DIRECTORY = "uploads"
-if not os.path.exists(UPLOAD_DIRECTORY):
-    os.makedirs(UPLOAD_DIRECTORY)
-
-
-# Function to clear the upload directory
-def clear_upload_directory():
-    for filename in os.listdir(UPLOAD_DIRECTORY):
-        file_path = os.path.join(UPLOAD_DIRECTORY, filename)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
+# Bundled structure used by the "Test Print" button
+TEST_PRINT_CIF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Yb2Si2O7.cif")
 
 
 # Dash setup
@@ -34,6 +33,7 @@ app.layout = html.Div(
         "padding": "20px"
     },
     children=[
+        dcc.Store(id="session-id", storage_type="session"),
         html.Div([
             html.H1("Crystal Lattice & Reciprocal Lattice Generator",
                     style={"textAlign": "center", "color": "#343a40"}),
@@ -79,6 +79,7 @@ def display_feature(rec_lattice_clicks, cry_lattice_clicks):
                 multiple=False,
             ),
             html.Div(id="output-upload", style={"margin": "10px 0", "color": "#495057"}),
+            dcc.Store(id="upload-key"),
             html.Div([
                 html.Label("Number of Unit Cells (x, y, z):", style={"display": "block", "marginTop": "10px"}),
                 dcc.Input(id="num-unit-cells-x", type="number", value=1,
@@ -150,16 +151,48 @@ def display_feature(rec_lattice_clicks, cry_lattice_clicks):
                 dcc.Checklist(id="add-supports-flag", options=[{'label': '', 'value': 'addSupports'}], value=[],
                               style={"margin": "5px", "padding": "5px"}),
             ]),
+            html.Div([
+                html.Label("Solidify (single watertight mesh):", style={"display": "block", "marginTop": "10px"}),
+                dcc.Checklist(id="solidify-flag", options=[{'label': '', 'value': 'solidify'}], value=[],
+                              style={"margin": "5px", "padding": "5px"}),
+            ]),
+            html.Div([
+                html.Label("Print Size (mm, longest side) and Nozzle Diameter (mm):",
+                           style={"display": "block", "marginTop": "10px"}),
+                dcc.Input(id="print-size", type="number", value=None, placeholder="full detail",
+                          style={"margin": "5px", "padding": "5px", "borderRadius": "5px",
+                                 "border": "1px solid #ced4da", "width": "100px"}),
+                dcc.Input(id="nozzle-diameter", type="number", value=DEFAULT_NOZZLE_DIAMETER,
+                          style={"margin": "5px", "padding": "5px", "borderRadius": "5px",
+                                 "border": "1px solid #ced4da", "width": "80px"}),
+            ]),
             html.Button("Generate STL", id="generate-stl", n_clicks=0,
                         style={"margin": "10px 0", "padding": "10px 20px", "backgroundColor": "#17a2b8",
                                "color": "white", "border": "none", "borderRadius": "5px"}),
             html.Button("Test Print", id="test-print-btn", n_clicks=0,
                         style={"margin": "10px 0", "padding": "10px 20px", "backgroundColor": "#ffc107",
                                "color": "black", "border": "none", "borderRadius": "5px"}),
+            html.Button("Cancel", id="cancel-stl-btn", n_clicks=0,
+                        style={"margin": "10px 5px", "padding": "10px 20px", "backgroundColor": "#dc3545",
+                               "color": "white", "border": "none", "borderRadius": "5px"}),
+            html.Div(id="stl-job-status", style={"margin": "10px 0", "color": "#495057"}),
+            html.Div(id="stl-metrics", style={"margin": "10px 0", "fontSize": "12px", "color": "#495057"}),
+            dcc.Store(id="stl-job"),
+            dcc.Interval(id="stl-job-interval", interval=1000, disabled=True),
             dcc.Download(id="download-stl"),
-            html.Div(id="output-stl-path", style={"display": "none"}),
+            dcc.Store(id="mesh-key"),
             html.Div(id="output-stl", style={"margin": "10px 0", "height": "400px"}),
-            html.Button("Download STL", id="download-stl-btn", n_clicks=0,
+            html.Div([
+                html.Label("Download Format (3MF and GLB keep one material per species):",
+                           style={"display": "block", "marginTop": "10px"}),
+                dcc.Dropdown(id="export-format", value="stl", clearable=False,
+                             options=[{'label': 'STL', 'value': 'stl'}, {'label': '3MF', 'value': '3mf'},
+                                      {'label': 'PLY', 'value': 'ply'}, {'label': 'GLB', 'value': 'glb'}],
+                             style={"margin": "5px", "width": "150px"}),
+                dcc.Checklist(id="export-compress", options=[{'label': ' Zip compressed', 'value': 'zip'}],
+                              value=[], style={"margin": "5px", "padding": "5px"}),
+            ]),
+            html.Button("Download", id="download-stl-btn", n_clicks=0,
                         style={"margin": "10px 0", "padding": "10px 20px", "backgroundColor": "#6c757d",
                                "color": "white", "border": "none", "borderRadius": "5px", "display": "none"}),
         ]
@@ -170,29 +203,38 @@ def display_feature(rec_lattice_clicks, cry_lattice_clicks):
 
 
 @app.callback(
-    Output("output-upload", "children"),
+    [Output("output-upload", "children"),
+     Output("upload-key", "data"),
+     Output("session-id", "data")],
     Input("upload-cif", "contents"),
-    State("upload-cif", "filename"),
+    [State("upload-cif", "filename"),
+     State("session-id", "data")],
 )
-def save_upload(contents, filename):
+def save_upload(contents, filename, session_id):
+    session_id = session_id or uuid.uuid4().hex
     if contents is not None:
-        clear_upload_directory()
         data = contents.encode("utf8").split(b";base64,")[1]
-        cif_path = os.path.join(UPLOAD_DIRECTORY, filename)
-        with open(cif_path, "wb") as fp:
-            fp.write(base64.decodebytes(data))
-        return f"Uploaded file: {filename}"
-    return "No file uploaded yet."
+        upload_key = artifact_store.put_upload(base64.decodebytes(data), session_id)
+        return f"Uploaded file: {filename}", upload_key, session_id
+    return "No file uploaded yet.", None, session_id
+
+
+DOWNLOAD_BUTTON_STYLE = {"display": "block", "margin": "10px 0", "padding": "10px 20px",
+                         "backgroundColor": "#6c757d", "color": "white", "border": "none", "borderRadius": "5px"}
 
 
 @app.callback(
-    [Output("output-stl-path", "children"),
+    [Output("mesh-key", "data"),
      Output("download-stl-btn", "style"),
-     Output("download-stl", "data")],
+     Output("download-stl", "data"),
+     Output("stl-job", "data"),
+     Output("stl-job-interval", "disabled"),
+     Output("stl-job-status", "children")],
     [Input("generate-stl", "n_clicks"),
      Input("test-print-btn", "n_clicks"),
      Input("download-stl-btn", "n_clicks")],
-    [State("upload-cif", "filename"),
+    [State("upload-key", "data"),
+     State("session-id", "data"),
      State("num-unit-cells-x", "value"),
      State("num-unit-cells-y", "value"),
      State("num-unit-cells-z", "value"),
@@ -208,20 +250,28 @@ def save_upload(contents, filename):
      State("site-index-spin", "value"),
      State("tolerance", "value"),
      State("add-supports-flag", "value"),
-     State("output-stl-path", "children")]
+     State("solidify-flag", "value"),
+     State("print-size", "value"),
+     State("nozzle-diameter", "value"),
+     State("mesh-key", "data"),
+     State("export-format", "value"),
+     State("export-compress", "value")]
 )
-def handle_stl_operations(generate_clicks, test_print_clicks, download_clicks, filename, num_x, num_y, num_z, rot_x,
+def handle_stl_operations(generate_clicks, test_print_clicks, download_clicks, upload_key, session_id, num_x, num_y, num_z, rot_x,
                           rot_y, rot_z, trans_x, trans_y, trans_z, base_level, is_primitive, target_atoms,
-                          site_index_spin, tolerance, add_supports_flag, stl_path):
+                          site_index_spin, tolerance, add_supports_flag, solidify_flag, print_size, nozzle_diameter,
+                          current_mesh_key, output_format, compress_flag):
     ctx = callback_context
     if not ctx.triggered:
-        return "", {"display": "none"}, None
+        return None, {"display": "none"}, None, None, True, ""
 
     button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-    if button_id == "generate-stl" and filename:
-        cif_path = os.path.join(UPLOAD_DIRECTORY, filename)
+    if button_id == "generate-stl" and upload_key:
+        cif_path = artifact_store.upload_path(upload_key)
     elif button_id == "test-print-btn":
-        cif_path = os.path.join(UPLOAD_DIRECTORY, "Yb2Si2O7.cif")
+        with open(TEST_PRINT_CIF, "rb") as fp:
+            upload_key = artifact_store.put_upload(fp.read(), session_id)
+        cif_path = artifact_store.upload_path(upload_key)
         num_x, num_y, num_z = 1, 1, 1
         rot_x, rot_y, rot_z = 0, 0, 0
         trans_x, trans_y, trans_z = 0, 0, 0
@@ -231,6 +281,8 @@ def handle_stl_operations(generate_clicks, test_print_clicks, download_clicks, f
         site_index_spin = None
         tolerance = 0.1
         add_supports_flag = []
+        solidify_flag = []
+        print_size = None
 
     if button_id in ["generate-stl", "test-print-btn"]:
         num_unit_cells = [num_x, num_y, num_z]
@@ -239,6 +291,10 @@ def handle_stl_operations(generate_clicks, test_print_clicks, download_clicks, f
         is_primitive = True if 'isPrimitive' in is_primitive else False
         target_atoms = target_atoms.split(',') if target_atoms else None
         add_supports_flag = True if 'addSupports' in add_supports_flag else False
+        solidify_flag = True if 'solidify' in solidify_flag else False
+        # Without a print size the export keeps the full level of detail
+        tessellation = tessellation_params(print_size=print_size,
+                                           nozzle_diameter=nozzle_diameter or DEFAULT_NOZZLE_DIAMETER)
 
         # Parse site_index_spin
         site_index_spin_dict = {}
@@ -248,9 +304,23 @@ def handle_stl_operations(generate_clicks, test_print_clicks, download_clicks, f
                     index, spin = item.split(':')
                     site_index_spin_dict[int(index)] = list(map(float, spin.strip('[]').split(',')))
             except Exception as e:
-                return f"Error parsing site_index_spin: {e}", {"display": "none"}, None
-
-        stl_file_path = generate_stl_from_params(
+                return None, {"display": "none"}, None, None, True, f"Error parsing site_index_spin: {e}"
+
+        # Identical requests share one artifact, whichever session generated it first
+        mesh_key = artifact_store.mesh_key(upload_key, {
+            "num_unit_cells": num_unit_cells, "rotation_angles": rotation_angles,
+            "translation_vector": translation_vector, "base_level": base_level, "is_primitive": is_primitive,
+            "target_atoms": target_atoms, "site_index_spin": site_index_spin_dict, "tolerance": tolerance,
+            "add_supports": add_supports_flag, "tessellation": tessellation, "solidify": solidify_flag,
+        })
+        parts_path = artifact_store.mesh_path(mesh_key, PARTS_EXTENSION)
+        preview_path = artifact_store.mesh_path(mesh_key, PREVIEW_EXTENSION)
+        if artifact_store.lookup(preview_path, session_id) and artifact_store.lookup(parts_path, session_id):
+            return mesh_key, DOWNLOAD_BUTTON_STYLE, None, None, True, "Mesh served from cache."
+
+        # Generation runs in the background job pool; poll_stl_job picks up the result
+        job_id = job_queue.submit(
+            generate_preview_from_params,
             cif_path,
             num_unit_cells,
             rotation_angles,
@@ -260,46 +330,122 @@ def handle_stl_operations(generate_clicks, test_print_clicks, download_clicks, f
             target_atoms,
             site_index_spin_dict,
             tolerance,
-            add_supports_flag
+            add_supports_flag,
+            output_path=parts_path,
+            tessellation=tessellation,
+            solidify_flag=solidify_flag,
+            preview_path=preview_path,
+            job_key=mesh_key,
+            job_owner=session_id
         )
+        return None, {"display": "none"}, None, {"job_id": job_id, "mesh_key": mesh_key}, False, "Queued..."
+
+    if button_id == "download-stl-btn" and current_mesh_key:
+        # The full resolution model is written from the saved parts the first time each format is downloaded
+        extension = export_extension(output_format or "stl", 'zip' in (compress_flag or []))
+        stl_file_path = artifact_store.mesh_path(current_mesh_key, extension)
+        if not artifact_store.lookup(stl_file_path, session_id):
+            parts_path = artifact_store.lookup(artifact_store.mesh_path(current_mesh_key, PARTS_EXTENSION), session_id)
+            if parts_path is None:
+                return None, {"display": "none"}, None, no_update, no_update, "Mesh expired, please generate it again."
+            export_parts(parts_path, stl_file_path)
+            artifact_store.evict()
+        return no_update, DOWNLOAD_BUTTON_STYLE, dcc.send_file(stl_file_path), no_update, no_update, no_update
+
+    return None, {"display": "none"}, None, no_update, no_update, no_update
+
+
+def metrics_table(runs):
+    # Per-stage wall time, memory and sizes of the finished generation
+    cell_style = {"padding": "2px 8px", "textAlign": "right"}
+    rows = [html.Tr([html.Th(title, style=cell_style) for title in
+                     ("Stage", "Seconds", "RSS MB", "Peak MB", "Atoms", "Bonds", "Triangles")])]
+    for run in runs:
+        for stage in run["stages"] + [dict(run, stage="total")]:
+            values = [stage["stage"], f"{stage['seconds']:.2f}"] + [
+                "" if stage.get(key) is None else f"{stage[key]:,.0f}"
+                for key in ("rss_mb", "peak_rss_mb", "atoms", "bonds", "triangles")]
+            rows.append(html.Tr([html.Td(value, style=cell_style) for value in values]))
+    return html.Table(rows) if len(rows) > 1 else None
 
-        if os.path.exists(stl_file_path):
-            return stl_file_path, {"display": "block", "margin": "10px 0", "padding": "10px 20px",
-                                   "backgroundColor": "#6c757d", "color": "white", "border": "none",
-                                   "borderRadius": "5px"}, None
-        else:
-            return "Failed to generate STL file.", {"display": "none"}, None
-
-    if button_id == "download-stl-btn" and stl_path and os.path.exists(stl_path):
-        return stl_path, {"display": "block", "margin": "10px 0", "padding": "10px 20px", "backgroundColor": "#6c757d",
-                          "color": "white", "border": "none", "borderRadius": "5px"}, dcc.send_file(stl_path)
 
-    return "", {"display": "none"}, None
+@app.callback(
+    [Output("mesh-key", "data", allow_duplicate=True),
+     Output("download-stl-btn", "style", allow_duplicate=True),
+     Output("stl-job-interval", "disabled", allow_duplicate=True),
+     Output("stl-job-status", "children", allow_duplicate=True),
+     Output("stl-metrics", "children")],
+    Input("stl-job-interval", "n_intervals"),
+    [State("stl-job", "data"),
+     State("session-id", "data")],
+    prevent_initial_call=True
+)
+def poll_stl_job(n_intervals, stl_job, session_id):
+    if not stl_job:
+        return no_update, no_update, True, no_update, no_update
+
+    job = job_queue.status(stl_job["job_id"])
+    state = job["state"]
+    if state == "done":
+        mesh_key = stl_job["mesh_key"]
+        if artifact_store.lookup(artifact_store.mesh_path(mesh_key, PREVIEW_EXTENSION), session_id) and \
+                artifact_store.lookup(job["result"], session_id):
+            artifact_store.evict()
+            return mesh_key, DOWNLOAD_BUTTON_STYLE, True, "Mesh generated.", metrics_table(job.get("metrics") or [])
+        return None, {"display": "none"}, True, "Failed to generate mesh.", None
+    if state == "failed":
+        return None, {"display": "none"}, True, f"Generation failed: {job.get('error')}", \
+            metrics_table(job.get("metrics") or [])
+    if state in ("cancelled", "unknown"):
+        return None, {"display": "none"}, True, f"Job {state}.", None
+
+    if state == "running":
+        progress = job.get("progress") or 0.0
+        return no_update, no_update, False, f"Running: {job.get('stage')} ({progress:.0%})", None
+    return no_update, no_update, False, "Queued...", None
 
 
 @app.callback(
-    Output("output-stl", "children"),
-    Input("output-stl-path", "children"),
-    State("base-level", "value"),
+    [Output("stl-job-status", "children", allow_duplicate=True),
+     Output("stl-job", "data", allow_duplicate=True),
+     Output("stl-job-interval", "disabled", allow_duplicate=True)],
+    Input("cancel-stl-btn", "n_clicks"),
+    [State("stl-job", "data"),
+     State("session-id", "data")],
+    prevent_initial_call=True
 )
-def render_stl(stl_file_path, base_level):
-    if stl_file_path and os.path.exists(stl_file_path):
-        stl_reader = vtkSTLReader()
-        stl_reader.SetFileName(stl_file_path)
-        stl_reader.Update()
+def cancel_stl_job(n_clicks, stl_job, session_id):
+    # This session stops following the job; the job itself only stops if no other session shares it
+    if stl_job and job_queue.cancel(stl_job["job_id"], session_id):
+        return "Job cancelled.", None, True
+    return no_update, no_update, no_update
+
+
+def preview_mesh_state(vertices, faces):
+    # Same layout as to_mesh_state produces, built straight from the arrays: polys is [3, a, b, c, 3, ...]
+    polys = np.empty((len(faces), 4), dtype=np.int32)
+    polys[:, 0] = 3
+    polys[:, 1:] = faces
+    return {"mesh": {"points": b64_encode_numpy(vertices.astype(np.float32)), "polys": b64_encode_numpy(polys.ravel())}}
 
-        dataset = stl_reader.GetOutput()
 
-        if dataset is None:
-            return "Failed to read STL file."
+@app.callback(
+    Output("output-stl", "children"),
+    Input("mesh-key", "data"),
+    [State("base-level", "value"),
+     State("session-id", "data")],
+)
+def render_stl(mesh_key, base_level, session_id):
+    preview_path = mesh_key and artifact_store.lookup(artifact_store.mesh_path(mesh_key, PREVIEW_EXTENSION), session_id)
+    if preview_path:
+        vertices, faces, bounds = load_preview(preview_path)
+        if len(faces) == 0:
+            return "The generated mesh is empty."
 
-        mesh_state = to_mesh_state(dataset)
+        mesh_state = preview_mesh_state(vertices, faces)
 
-        # Compute the bounds of the STL model
-        bounds = dataset.GetBounds()
-        x_min, x_max, y_min, y_max, z_min, z_max = bounds
-        x_size = x_max - x_min
-        y_size = y_max - y_min
+        # Bounds of the full resolution model, kept with the preview
+        (x_min, y_min, _), (x_max, y_max, _) = bounds
 
         # Create the plane with the computed size
         plane_source = vtkPlaneSource()
@@ -326,4 +472,6 @@ def render_stl(stl_file_path, base_level):
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("CRYSTALPRINTER_LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     app.run_server(debug=True)
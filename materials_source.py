@@ -0,0 +1,194 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from monty.json import MontyEncoder
+from mp_api.client import MPRester
+from pymatgen.core import Structure
+
+from structure_cache import content_hash, evict_files
+
+# No key is bundled; the Materials Project client's own MP_API_KEY variable is honoured as well
+MP_API_KEY = os.environ.get("CRYSTALPRINTER_MP_API_KEY") or os.environ.get("MP_API_KEY")
+MP_CONCURRENCY = int(os.environ.get("CRYSTALPRINTER_MP_CONCURRENCY", 4))
+MP_BATCH_SIZE = int(os.environ.get("CRYSTALPRINTER_MP_BATCH_SIZE", 100))
+MP_CACHE_TTL_SECONDS = int(os.environ.get("CRYSTALPRINTER_MP_CACHE_TTL", 7 * 24 * 60 * 60))
+# A directory of <material_id>.cif files to serve instead of the Materials Project, e.g. for offline tests
+MP_LOCAL_DIRECTORY = os.environ.get("CRYSTALPRINTER_MP_LOCAL_DIR")
+# Downloaded structures get their own directory, swept for expired entries and capped in size on every write
+MATERIALS_CACHE_DIRECTORY = os.environ.get("CRYSTALPRINTER_MP_CACHE_DIR", "materials_cache")
+MP_CACHE_BYTES = int(os.environ.get("CRYSTALPRINTER_MP_CACHE_BYTES", 64 * 1024 * 1024))
+# Only what the pipeline needs is requested, not the full summary documents
+STRUCTURE_FIELDS = ("material_id", "structure")
+
+MaterialDocument = namedtuple("MaterialDocument", STRUCTURE_FIELDS)
+
+
+class MaterialsProjectBackend:
+    name = "materials-project"
+
+    def __init__(self, api_key=MP_API_KEY):
+        self.api_key = api_key
+        self._stack = None
+        self._rester = None
+        self._lock = threading.Lock()
+
+    def rester(self):
+        # One client, and so one pooled HTTP session, for every request of this backend
+        with self._lock:
+            if self._rester is None:
+                if not self.api_key:
+                    raise RuntimeError("No Materials Project API key: set CRYSTALPRINTER_MP_API_KEY, or serve "
+                                       "structures offline with CRYSTALPRINTER_MP_LOCAL_DIR")
+                self._stack = ExitStack()
+                self._rester = self._stack.enter_context(MPRester(self.api_key))
+            return self._rester
+
+    def search(self, fields=STRUCTURE_FIELDS, **criteria):
+        return self.rester().summary.search(fields=list(fields), **criteria)
+
+    def structures(self, material_ids):
+        documents = self.search(fields=STRUCTURE_FIELDS, material_ids=list(material_ids))
+        return {str(document.material_id): document.structure for document in documents}
+
+    def close(self):
+        with self._lock:
+            stack, self._stack, self._rester = self._stack, None, None
+        if stack is not None:
+            stack.close()
+
+
+class LocalBackend:
+    # Offline stand-in: structures from a {material_id: Structure} mapping or a directory of <material_id>.cif
+    name = "local"
+
+    def __init__(self, structures=None, directory=None):
+        self._structures = dict(structures or {})
+        self.directory = directory
+
+    def structure(self, material_id):
+        if material_id not in self._structures and self.directory is not None:
+            path = os.path.join(self.directory, f"{material_id}.cif")
+            if os.path.exists(path):
+                self._structures[material_id] = Structure.from_file(path)
+        return self._structures.get(material_id)
+
+    def material_ids(self):
+        material_ids = set(self._structures)
+        if self.directory is not None:
+            material_ids.update(filename[:-4] for filename in os.listdir(self.directory) if filename.endswith(".cif"))
+        return sorted(material_ids)
+
+    def search(self, fields=STRUCTURE_FIELDS, material_ids=None, formula=None, elements=None, **criteria):
+        documents = []
+        for material_id in material_ids or self.material_ids():
+            structure = self.structure(material_id)
+            if structure is None:
+                continue
+            if formula is not None and structure.composition.reduced_formula != formula:
+                continue
+            if elements is not None and not set(elements) <= {element.symbol for element in structure.composition}:
+                continue
+            documents.append(MaterialDocument(material_id, structure))
+        return documents
+
+    def structures(self, material_ids):
+        structures = {}
+        for material_id in material_ids:
+            structure = self.structure(material_id)
+            if structure is not None:
+                structures[material_id] = structure
+        return structures
+
+    def close(self):
+        pass
+
+
+class MaterialsSource:
+    def __init__(self, backend=None, directory=MATERIALS_CACHE_DIRECTORY, ttl=MP_CACHE_TTL_SECONDS,
+                 concurrency=MP_CONCURRENCY, batch_size=MP_BATCH_SIZE, max_bytes=MP_CACHE_BYTES):
+        self.backend = backend or MaterialsProjectBackend()
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        # Blocking client calls run on this pool, which also bounds how many run at once
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="materials")
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: function(*args, **kwargs))
+
+    def _search(self, fields, criteria):
+        documents = self.backend.search(fields=fields, **criteria)
+        if set(fields) >= set(STRUCTURE_FIELDS):
+            for document in documents:
+                if document.structure is not None:
+                    self._write(str(document.material_id), document.structure)
+        return documents
+
+    def _fetch(self, material_ids):
+        structures = self.backend.structures(material_ids)
+        for material_id, structure in structures.items():
+            self._write(material_id, structure)
+        return structures
+
+    def _cached(self, material_ids):
+        structures = {}
+        for material_id in material_ids:
+            structure = self._read(material_id)
+            if structure is not None:
+                structures[material_id] = structure
+        return structures
+
+    async def search(self, fields=STRUCTURE_FIELDS, **criteria):
+        return await self._run(self._search, fields, criteria)
+
+    async def structures(self, material_ids):
+        # Cached structures first; the rest are fetched in concurrent batches of batch_size ids
+        material_ids = [str(material_id) for material_id in material_ids]
+        found = await self._run(self._cached, list(dict.fromkeys(material_ids)))
+        missing = [material_id for material_id in dict.fromkeys(material_ids) if material_id not in found]
+        batches = [missing[start:start + self.batch_size] for start in range(0, len(missing), self.batch_size)]
+        for fetched in await asyncio.gather(*(self._run(self._fetch, batch) for batch in batches)):
+            found.update(fetched)
+        return {material_id: found[material_id] for material_id in material_ids if material_id in found}
+
+    async def structure(self, material_id):
+        return (await self.structures([material_id])).get(str(material_id))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.backend.close()
+
+    def _path(self, material_id):
+        return os.path.join(self.directory, f"{content_hash(b'material', self.backend.name, material_id)}.material.json")
+
+    def _read(self, material_id):
+        path = self._path(material_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as fp:
+                return Structure.from_dict(json.load(fp))
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, material_id, structure):
+        if self.ttl <= 0 or self.max_bytes <= 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(material_id)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w") as fp:
+            json.dump(structure.as_dict(), fp, cls=MontyEncoder)
+        os.replace(temporary_path, path)
+        evict_files(self.directory, self.max_bytes, ".material.json", self.ttl)
+
+
+materials_source = MaterialsSource(LocalBackend(directory=MP_LOCAL_DIRECTORY) if MP_LOCAL_DIRECTORY else None)
@@ -0,0 +1,248 @@
+import os
+import threading
+from functools import lru_cache
+
+import numpy as np
+import trimesh
+
+from tessellation import cylinder_sections, sphere_subdivisions
+
+PARTS_EXTENSION = ".parts.npz"
+
+
+@lru_cache(maxsize=None)
+def sphere_template(radius, subdivisions=3):
+    sphere = trimesh.creation.icosphere(subdivisions=subdivisions, radius=radius)
+    return sphere.vertices.copy(), sphere.faces.copy()
+
+
+@lru_cache(maxsize=None)
+def cylinder_template(sections=32):
+    # Unit cylinder along z, centered at the origin: radius 1, height 1
+    cylinder = trimesh.creation.cylinder(radius=1.0, height=1.0, sections=sections)
+    return cylinder.vertices.copy(), cylinder.faces.copy()
+
+
+@lru_cache(maxsize=None)
+def bond_template(length, radius, sections=32):
+    # A cylinder tessellated once at its final size, so its instances only need a rotation and an offset
+    vertices, faces = cylinder_template(sections)
+    return vertices * np.array([radius, radius, length]), faces
+
+
+@lru_cache(maxsize=None)
+def arrow_template(length, shaft_radius, tip_radius, tip_length, sections=32):
+    # An arrow along +z from the origin: a shaft of the full length with the cone tip starting at 90% of it
+    cylinder = trimesh.creation.cylinder(radius=shaft_radius, height=length, sections=sections)
+    cylinder.apply_translation([0, 0, length / 2])
+    cone = trimesh.creation.cone(radius=tip_radius, height=tip_length, sections=sections)
+    cone.apply_translation([0, 0, length * 0.9 + tip_length / 2])
+    arrow = trimesh.util.concatenate(cylinder, cone)
+    return arrow.vertices.copy(), arrow.faces.copy()
+
+
+def cylinder_groups(linear, offsets, radii, tessellation):
+    # One template per section count, so thin and thick cylinders can be tessellated differently
+    sections = cylinder_sections(tessellation, radii)
+    parts = []
+    for count in np.unique(sections):
+        vertices, faces = cylinder_template(int(count))
+        selected = sections == count
+        parts.append((vertices, faces, linear[selected], offsets[selected]))
+    return parts
+
+
+def align_z_to(directions):
+    # Batched rotation matrices taking +z onto each unit direction (Rodrigues' formula)
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    x, y, z = directions[:, 0], directions[:, 1], directions[:, 2]
+    rotations = np.zeros((len(directions), 3, 3))
+
+    flipped = z < -1 + 1e-12
+    scale = np.zeros_like(z)
+    scale[~flipped] = 1.0 / (1.0 + z[~flipped])
+
+    rotations[:, 0, 0] = 1 - x * x * scale
+    rotations[:, 0, 1] = -x * y * scale
+    rotations[:, 0, 2] = x
+    rotations[:, 1, 0] = -x * y * scale
+    rotations[:, 1, 1] = 1 - y * y * scale
+    rotations[:, 1, 2] = y
+    rotations[:, 2, 0] = -x
+    rotations[:, 2, 1] = -y
+    rotations[:, 2, 2] = z
+
+    # Anti-parallel case: half turn about x
+    rotations[flipped] = np.diag([1.0, -1.0, -1.0])
+    return rotations
+
+
+def sphere_parts(centers, radii, tessellation=None):
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+    parts = []
+    for radius in np.unique(radii):
+        vertices, faces = sphere_template(float(radius), sphere_subdivisions(tessellation, float(radius)))
+        parts.append((vertices, faces, None, centers[radii == radius]))
+    return parts
+
+
+def cylinder_parts(starts, ends, radius, tessellation=None):
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+    vectors = ends - starts
+    lengths = np.linalg.norm(vectors, axis=1)
+    keep = lengths > 0
+    if not keep.any():
+        return []
+
+    vectors, lengths = vectors[keep], lengths[keep]
+    radii = np.broadcast_to(np.asarray(radius, dtype=np.float64), keep.shape)[keep]
+    rotations = align_z_to(vectors / lengths[:, np.newaxis])
+    linear = rotations * np.stack([radii, radii, lengths], axis=1)[:, np.newaxis, :]
+    midpoints = (starts[keep] + ends[keep]) / 2
+    return cylinder_groups(linear, midpoints, radii, tessellation)
+
+
+def motif_cylinder_parts(starts, ends, radius, motifs, tessellation=None):
+    # One template per bond motif; every bond of a motif shares its length, so instances are rigid transforms
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+    motifs = np.asarray(motifs).reshape(-1)
+    vectors = ends - starts
+    lengths = np.linalg.norm(vectors, axis=1)
+    keep = lengths > 0
+    if not keep.any():
+        return []
+
+    starts, ends, vectors, lengths, motifs = starts[keep], ends[keep], vectors[keep], lengths[keep], motifs[keep]
+    sections = int(cylinder_sections(tessellation, radius))
+    rotations = align_z_to(vectors / lengths[:, np.newaxis])
+    midpoints = (starts + ends) / 2
+    parts = []
+    for motif in np.unique(motifs):
+        selected = motifs == motif
+        vertices, faces = bond_template(float(lengths[selected].mean()), float(radius), sections)
+        parts.append((vertices, faces, rotations[selected], midpoints[selected]))
+    return parts
+
+
+def vertical_cylinder_parts(centers, radii, heights, tessellation=None):
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+    heights = np.asarray(heights, dtype=np.float64).reshape(-1)
+    if len(centers) == 0:
+        return []
+
+    linear = np.zeros((len(centers), 3, 3))
+    linear[:, 0, 0] = radii
+    linear[:, 1, 1] = radii
+    linear[:, 2, 2] = heights
+    return cylinder_groups(linear, centers, radii, tessellation)
+
+
+def arrow_parts(starts, directions, lengths, shaft_radii, tip_radii, tip_lengths, tessellation=None):
+    # One template per arrow size; every arrow of a size is that template rotated onto its direction
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    norms = np.linalg.norm(directions, axis=1)
+    keep = norms > 0
+    if not keep.any():
+        return []
+
+    sizes = np.stack([np.broadcast_to(np.asarray(value, dtype=np.float64), norms.shape)
+                      for value in (lengths, shaft_radii, tip_radii, tip_lengths)], axis=1)[keep]
+    rotations = align_z_to(directions[keep] / norms[keep, np.newaxis])
+    starts = starts[keep]
+    size_classes, inverse = np.unique(sizes, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    parts = []
+    for index, (length, shaft_radius, tip_radius, tip_length) in enumerate(size_classes.tolist()):
+        sections = int(cylinder_sections(tessellation, tip_radius))
+        vertices, faces = arrow_template(length, shaft_radius, tip_radius, tip_length, sections)
+        selected = inverse == index
+        parts.append((vertices, faces, rotations[selected], starts[selected]))
+    return parts
+
+
+def mesh_parts(mesh):
+    # Wrap an already built mesh as a single instance so it can travel with templated parts
+    if len(mesh.faces) == 0:
+        return []
+    return [(np.asarray(mesh.vertices, dtype=np.float64), np.asarray(mesh.faces, dtype=np.int64), None,
+             np.zeros((1, 3)))]
+
+
+def part_size(part):
+    vertices, faces, _, offsets = part
+    return len(offsets) * len(vertices), len(offsets) * len(faces)
+
+
+def instance_vertices(part, start=0, stop=None):
+    template_vertices, _, linear, offsets = part
+    offsets = offsets[start:stop]
+    if linear is None:
+        instanced = template_vertices[np.newaxis, :, :] + offsets[:, np.newaxis, :]
+    else:
+        instanced = np.matmul(template_vertices, linear[start:stop].transpose(0, 2, 1))
+        instanced += offsets[:, np.newaxis, :]
+    return instanced.reshape(-1, 3)
+
+
+def instance_faces(part, vertex_offset=0, start=0, stop=None):
+    template_vertices, template_faces, _, offsets = part
+    count = len(offsets[start:stop])
+    shifts = vertex_offset + np.arange(count, dtype=np.int64) * len(template_vertices)
+    return (template_faces[np.newaxis, :, :] + shifts[:, np.newaxis, np.newaxis]).reshape(-1, 3)
+
+
+def assemble_mesh(parts):
+    parts = [part for part in parts if len(part[3])]
+    if not parts:
+        return trimesh.Trimesh()
+
+    sizes = [part_size(part) for part in parts]
+    vertices = np.empty((sum(size[0] for size in sizes), 3), dtype=np.float64)
+    faces = np.empty((sum(size[1] for size in sizes), 3), dtype=np.int64)
+
+    vertex_offset, face_offset = 0, 0
+    for part, (n_vertices, n_faces) in zip(parts, sizes):
+        vertices[vertex_offset:vertex_offset + n_vertices] = instance_vertices(part)
+        faces[face_offset:face_offset + n_faces] = instance_faces(part, vertex_offset)
+        vertex_offset += n_vertices
+        face_offset += n_faces
+
+    return trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+
+def save_parts(file_path, parts, materials=None):
+    # The instanced parts are a compact recipe for the full mesh; any export can be rebuilt from them later
+    arrays = {}
+    if materials is not None:
+        arrays["materials"] = np.array(materials, dtype=np.str_)
+    for index, (vertices, faces, linear, offsets) in enumerate(parts):
+        arrays[f"vertices_{index}"] = vertices
+        arrays[f"faces_{index}"] = faces
+        arrays[f"offsets_{index}"] = offsets
+        if linear is not None:
+            arrays[f"linear_{index}"] = linear
+
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as fp:
+        np.savez(fp, count=len(parts), **arrays)
+    os.replace(temporary_path, file_path)
+
+
+def load_parts(file_path):
+    with np.load(file_path) as data:
+        return [
+            (data[f"vertices_{index}"], data[f"faces_{index}"],
+             data[f"linear_{index}"] if f"linear_{index}" in data else None, data[f"offsets_{index}"])
+            for index in range(int(data["count"]))
+        ]
+
+
+def load_part_materials(file_path):
+    # The material name of every saved part, or None when they were saved without materials
+    with np.load(file_path) as data:
+        return data["materials"].tolist() if "materials" in data else None
@@ -0,0 +1,200 @@
+import colorsys
+import io
+import os
+import threading
+import zipfile
+import zlib
+
+import numpy as np
+
+from gltf_writer import write_glb
+from mesh_assembler import instance_faces, instance_vertices, part_size
+from parallel_mesher import parallel_mesh_arrays, parallel_write_binary_stl, use_parallel
+from stl_writer import write_binary_stl
+
+EXPORT_FORMATS = ("stl", "3mf", "ply", "glb")
+COMPRESSED_SUFFIX = ".zip"
+ZIP_LEVEL = int(os.environ.get("CRYSTALPRINTER_ZIP_LEVEL", 6))
+# Vertices and triangles are formatted this many at a time when writing XML
+XML_ROWS = 1 << 16
+MATERIAL_COLORS = {"bond": (0.6, 0.6, 0.6), "support": (0.85, 0.85, 0.85), "solid": (0.8, 0.8, 0.8)}
+THREEMF_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'
+    '</Types>')
+THREEMF_RELS = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Target="/3D/3dmodel.model" Id="rel0" '
+    'Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'
+    '</Relationships>')
+THREEMF_NAMESPACE = "http://schemas.microsoft.com/3dmanufacturing/core/2015/02"
+
+
+def export_extension(output_format, compress=False):
+    output_format = output_format.lower()
+    if output_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {output_format}")
+    return f".{output_format}" + (COMPRESSED_SUFFIX if compress else "")
+
+
+def export_format(file_path):
+    # The format an export path asks for, and whether it is zip compressed; unknown extensions get STL
+    path = file_path.lower()
+    compress = path.endswith(COMPRESSED_SUFFIX)
+    if compress:
+        path = path[:-len(COMPRESSED_SUFFIX)]
+    extension = os.path.splitext(path)[1].lstrip(".")
+    return (extension if extension in EXPORT_FORMATS else "stl"), compress
+
+
+def material_color(name):
+    # Fixed colors for the non-atom materials; species get a stable hue from their name
+    if name in MATERIAL_COLORS:
+        return MATERIAL_COLORS[name]
+    hue = zlib.crc32(name.encode("utf8")) % 360 / 360.0
+    return colorsys.hsv_to_rgb(hue, 0.55, 0.9)
+
+
+def material_groups(parts, materials):
+    # Part indices per material name, in first-seen order
+    groups = {}
+    for index, part in enumerate(parts):
+        if len(part[3]):
+            name = materials[index] if materials is not None else "model"
+            groups.setdefault(name, []).append(index)
+    return groups
+
+
+def write_ply(file_path, parts, materials=None):
+    # Binary PLY: every instance keeps its own indexed vertices, and faces carry their material's color
+    parts = list(parts)
+    keep = [index for index, part in enumerate(parts) if len(part[3])]
+    sizes = [part_size(parts[index]) for index in keep]
+    vertex_count = sum(size[0] for size in sizes)
+    face_count = sum(size[1] for size in sizes)
+
+    face_fields = [("count", "u1"), ("indices", "<i4", (3,))]
+    if materials is not None:
+        face_fields += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+    face_dtype = np.dtype(face_fields)
+    header = ["ply", "format binary_little_endian 1.0", "comment CrystalPrinter",
+              f"element vertex {vertex_count}", "property float x", "property float y", "property float z",
+              f"element face {face_count}", "property list uchar int vertex_indices"]
+    if materials is not None:
+        header += ["property uchar red", "property uchar green", "property uchar blue"]
+    header.append("end_header")
+
+    # Large models are expanded by the parallel export writer; part order is kept, so faces still follow their parts
+    if use_parallel(parts):
+        vertices, faces = parallel_mesh_arrays([parts[index] for index in keep])
+        vertex_blocks = [vertices]
+        face_blocks = np.split(faces, np.cumsum([size[1] for size in sizes])[:-1])
+    else:
+        vertex_blocks = (instance_vertices(parts[index]) for index in keep)
+        face_blocks = None
+
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as fp:
+        fp.write(("\n".join(header) + "\n").encode("ascii"))
+        for vertices in vertex_blocks:
+            fp.write(vertices.astype("<f4").tobytes())
+        vertex_offset = 0
+        for block, (index, (n_vertices, n_faces)) in enumerate(zip(keep, sizes)):
+            records = np.empty(n_faces, dtype=face_dtype)
+            records["count"] = 3
+            records["indices"] = face_blocks[block] if face_blocks is not None else \
+                instance_faces(parts[index], vertex_offset)
+            if materials is not None:
+                color = np.round(np.array(material_color(materials[index])) * 255).astype(np.uint8)
+                records["red"], records["green"], records["blue"] = color
+            fp.write(records.tobytes())
+            vertex_offset += n_vertices
+    os.replace(temporary_path, file_path)
+
+    return face_count
+
+
+def write_xml_rows(stream, row_format, values):
+    # One C-level string format per block of rows instead of one per row
+    for start in range(0, len(values), XML_ROWS):
+        block = values[start:start + XML_ROWS]
+        stream.write((row_format * len(block)) % tuple(block.ravel().tolist()))
+
+
+def write_3mf_model(stream, parts, materials):
+    groups = material_groups(parts, materials)
+    stream.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<model unit="millimeter" xml:lang="en-US" '
+                 f'xmlns="{THREEMF_NAMESPACE}">\n<resources>\n<basematerials id="1">\n')
+    for name in groups:
+        red, green, blue = (int(round(channel * 255)) for channel in material_color(name))
+        stream.write(f'<base name="{name}" displaycolor="#{red:02X}{green:02X}{blue:02X}"/>\n')
+    stream.write('</basematerials>\n')
+
+    # One object per material, so slicers can assign each species its own filament
+    for material_index, (name, indices) in enumerate(groups.items()):
+        stream.write(f'<object id="{material_index + 2}" name="{name}" type="model" pid="1" '
+                     f'pindex="{material_index}">\n<mesh>\n<vertices>\n')
+        for index in indices:
+            write_xml_rows(stream, '<vertex x="%.6g" y="%.6g" z="%.6g"/>\n', instance_vertices(parts[index]))
+        stream.write('</vertices>\n<triangles>\n')
+        vertex_offset = 0
+        for index in indices:
+            write_xml_rows(stream, '<triangle v1="%d" v2="%d" v3="%d"/>\n',
+                           instance_faces(parts[index], vertex_offset))
+            vertex_offset += part_size(parts[index])[0]
+        stream.write('</triangles>\n</mesh>\n</object>\n')
+
+    stream.write('</resources>\n<build>\n')
+    for material_index in range(len(groups)):
+        stream.write(f'<item objectid="{material_index + 2}"/>\n')
+    stream.write('</build>\n</model>\n')
+
+
+def write_3mf(file_path, parts, materials=None):
+    # 3MF is itself a deflated zip, with indexed meshes and one base material per species
+    parts = list(parts)
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with zipfile.ZipFile(temporary_path, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_LEVEL) as archive:
+        archive.writestr("[Content_Types].xml", THREEMF_CONTENT_TYPES)
+        archive.writestr("_rels/.rels", THREEMF_RELS)
+        with archive.open("3D/3dmodel.model", "w", force_zip64=True) as model:
+            with io.TextIOWrapper(model, encoding="utf8") as stream:
+                write_3mf_model(stream, parts, materials)
+    os.replace(temporary_path, file_path)
+
+    return sum(part_size(part)[1] for part in parts if len(part[3]))
+
+
+def write_compressed(file_path, parts, materials=None):
+    # The model is written under its own extension next to the archive, then deflated into it
+    inner_name = os.path.basename(file_path)[:-len(COMPRESSED_SUFFIX)]
+    inner_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}{os.path.splitext(inner_name)[1]}"
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        triangles = write_parts(inner_path, parts, materials)
+        with zipfile.ZipFile(temporary_path, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_LEVEL) as archive:
+            archive.write(inner_path, inner_name)
+        os.replace(temporary_path, file_path)
+    finally:
+        if os.path.exists(inner_path):
+            os.remove(inner_path)
+    return triangles
+
+
+def write_parts(file_path, parts, materials=None):
+    # The format follows the extension, with a trailing .zip for a deflated archive; materials name each part
+    output_format, compress = export_format(file_path)
+    if compress:
+        return write_compressed(file_path, parts, materials)
+    if output_format == "3mf":
+        return write_3mf(file_path, parts, materials)
+    if output_format == "ply":
+        return write_ply(file_path, parts, materials)
+    if output_format == "glb":
+        return write_glb(file_path, parts, materials, material_color)
+    if use_parallel(parts):
+        return parallel_write_binary_stl(file_path, parts)
+    return write_binary_stl(file_path, parts)
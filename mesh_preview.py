@@ -0,0 +1,110 @@
+import os
+import threading
+
+import numpy as np
+
+from mesh_assembler import assemble_mesh, part_size
+from stl_writer import iter_part_triangles
+
+PREVIEW_MAX_TRIANGLES = int(os.environ.get("CRYSTALPRINTER_PREVIEW_TRIANGLES", 200000))
+PREVIEW_EXTENSION = ".preview.npz"
+
+
+def parts_extent(parts):
+    # Bounds and surface area in one streaming pass, without building the full mesh
+    lower, upper = np.full(3, np.inf), np.full(3, -np.inf)
+    area = 0.0
+    for part in parts:
+        for triangles in iter_part_triangles(part):
+            lower = np.minimum(lower, triangles.reshape(-1, 3).min(axis=0))
+            upper = np.maximum(upper, triangles.reshape(-1, 3).max(axis=0))
+            normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+            area += np.linalg.norm(normals, axis=1).sum() / 2
+    return lower, upper, area
+
+
+def cell_totals(inverse, points, count):
+    return np.stack([np.bincount(inverse, weights=points[:, axis], minlength=count) for axis in range(3)], axis=1)
+
+
+def cluster_parts(parts, lower, cell_size, shape):
+    # Vertex clustering: every vertex snaps to the mean of its grid cell, collapsed triangles are dropped
+    cell_keys, cell_sums, cell_counts, triangle_keys = [], [], [], []
+    for part in parts:
+        for triangles in iter_part_triangles(part):
+            cells = np.floor((triangles - lower) / cell_size).astype(np.int64)
+            np.clip(cells, 0, np.asarray(shape) - 1, out=cells)
+            keys = np.ravel_multi_index((cells[..., 0], cells[..., 1], cells[..., 2]), shape)
+
+            keys_flat = keys.reshape(-1)
+            unique_keys, inverse = np.unique(keys_flat, return_inverse=True)
+            sums = cell_totals(inverse, triangles.reshape(-1, 3), len(unique_keys))
+            cell_keys.append(unique_keys)
+            cell_sums.append(sums)
+            cell_counts.append(np.bincount(inverse, minlength=len(unique_keys)))
+
+            kept = (keys[:, 0] != keys[:, 1]) & (keys[:, 1] != keys[:, 2]) & (keys[:, 0] != keys[:, 2])
+            triangle_keys.append(keys[kept])
+
+    if not triangle_keys:
+        return np.empty((0, 3), dtype=np.float32), np.empty((0, 3), dtype=np.int32)
+
+    unique_keys, inverse = np.unique(np.concatenate(cell_keys), return_inverse=True)
+    sums = cell_totals(inverse, np.concatenate(cell_sums), len(unique_keys))
+    counts = np.bincount(inverse, weights=np.concatenate(cell_counts), minlength=len(unique_keys))
+    vertices = sums / counts[:, np.newaxis]
+
+    # Rotate each triangle so its smallest key comes first (orientation kept), then drop duplicates
+    faces = np.searchsorted(unique_keys, np.concatenate(triangle_keys))
+    faces = faces[np.arange(len(faces))[:, np.newaxis], (np.argmin(faces, axis=1)[:, np.newaxis] + np.arange(3)) % 3]
+    faces = np.unique(faces, axis=0)
+
+    used, faces = np.unique(faces, return_inverse=True)
+    return vertices[used].astype(np.float32), faces.reshape(-1, 3).astype(np.int32)
+
+
+def preview_mesh(parts, max_triangles=PREVIEW_MAX_TRIANGLES):
+    # Returns float32 vertices, int32 faces and the bounds of the full mesh
+    parts = [part for part in parts if len(part[3])]
+    if not parts:
+        return np.empty((0, 3), dtype=np.float32), np.empty((0, 3), dtype=np.int32), np.zeros((2, 3))
+
+    if sum(part_size(part)[1] for part in parts) <= max_triangles:
+        mesh = assemble_mesh(parts)
+        bounds = np.array([mesh.vertices.min(axis=0), mesh.vertices.max(axis=0)])
+        return mesh.vertices.astype(np.float32), mesh.faces.astype(np.int32), bounds
+
+    lower, upper, area = parts_extent(parts)
+    # A clustered surface keeps roughly two triangles per occupied cell
+    cell_size = max(np.sqrt(2 * area / max_triangles), 1e-6)
+    while True:
+        shape = tuple(int(n) for n in np.floor((upper - lower) / cell_size) + 1)
+        vertices, faces = cluster_parts(parts, lower, cell_size, shape)
+        if len(faces) <= max_triangles:
+            return vertices, faces, np.array([lower, upper])
+        cell_size *= np.sqrt(len(faces) / max_triangles) * 1.1
+
+
+def merge_previews(previews):
+    # Concatenates (vertices, faces, bounds) previews; empty ones do not widen the bounds
+    previews = [preview for preview in previews if len(preview[1])]
+    if not previews:
+        return np.empty((0, 3), dtype=np.float32), np.empty((0, 3), dtype=np.int32), np.zeros((2, 3))
+    starts = np.cumsum([0] + [len(vertices) for vertices, _, _ in previews[:-1]])
+    vertices = np.concatenate([vertices for vertices, _, _ in previews]).astype(np.float32)
+    faces = np.concatenate([faces + start for (_, faces, _), start in zip(previews, starts)]).astype(np.int32)
+    bounds = np.array([np.min([bounds[0] for _, _, bounds in previews], axis=0),
+                       np.max([bounds[1] for _, _, bounds in previews], axis=0)])
+    return vertices, faces, bounds
+
+
+def save_preview(file_path, vertices, faces, bounds):
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as fp:
+        np.savez(fp, vertices=vertices, faces=faces, bounds=bounds)
+    os.replace(temporary_path, file_path)
+
+
+def load_preview(file_path):
+    with np.load(file_path) as data:
+        return data["vertices"], data["faces"], data["bounds"]
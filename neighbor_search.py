@@ -0,0 +1,39 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Slack on the search radius so tree round-off never drops a pair the exact distance check keeps
+RADIUS_SLACK = 1e-9
+
+
+def nearest_neighbor_bonds(positions, tolerance=0.1, chunk_size=4096):
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    empty = np.empty(0, dtype=np.int64)
+    if len(positions) < 2:
+        return empty, empty.copy()
+
+    tree = cKDTree(positions)
+    rows, cols = [], []
+
+    for start in range(0, len(positions), chunk_size):
+        chunk = positions[start:start + chunk_size]
+        # k=2 because the closest hit of every query point is the point itself
+        approximate_nearest = tree.query(chunk, k=2)[0][:, 1]
+        radii = approximate_nearest * (1 + max(tolerance, 0)) * (1 + RADIUS_SLACK) + RADIUS_SLACK
+        candidates = tree.query_ball_point(chunk, r=radii, return_sorted=True)
+
+        counts = np.fromiter((len(candidate) for candidate in candidates), dtype=np.int64, count=len(candidates))
+        chunk_rows = np.repeat(np.arange(start, start + len(chunk)), counts)
+        chunk_cols = np.concatenate([np.asarray(candidate, dtype=np.int64) for candidate in candidates])
+        distances = np.linalg.norm(positions[chunk_rows] - positions[chunk_cols], axis=1)
+
+        # Exact nearest distance per atom, ignoring the atom itself
+        others = np.where(chunk_rows != chunk_cols, distances, np.inf)
+        nearest = np.minimum.reduceat(others, np.cumsum(counts) - counts)
+        nearest = np.repeat(nearest, counts)
+
+        keep = ((chunk_rows != chunk_cols) & (distances <= nearest * (1 + tolerance)) &
+                (distances >= nearest * (1 - tolerance)))
+        rows.append(chunk_rows[keep])
+        cols.append(chunk_cols[keep])
+
+    return np.concatenate(rows), np.concatenate(cols)
@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+import struct
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from instrumentation import stage
+from mesh_assembler import instance_faces, instance_vertices, part_size
+from stl_writer import STL_HEADER, STL_TRIANGLE, triangle_records
+
+# CPUs this process may run on, which can be fewer than the machine has
+AVAILABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+# The parallel export writer: only the exports that expand every instance into full triangle lists (binary STL and
+# PLY) use the pool. Template instancing, bonding, supports and solidify stay serial, GLB keeps the instancing,
+# previews are capped by their triangle budget and 3MF is bound by formatting variable-length text.
+MESH_WORKERS = int(os.environ.get("CRYSTALPRINTER_MESH_WORKERS", AVAILABLE_CPUS))
+# Smaller models are written in-process, where forking and shared memory would cost more than they save
+PARALLEL_MIN_TRIANGLES = int(os.environ.get("CRYSTALPRINTER_PARALLEL_TRIANGLES", 1 << 21))
+WORK_TRIANGLES = int(os.environ.get("CRYSTALPRINTER_WORK_TRIANGLES", 1 << 18))
+# Edge of the grid cells (in Angstrom) that instances are sorted by before they are split into work items
+SPATIAL_CELL = float(os.environ.get("CRYSTALPRINTER_SPATIAL_CELL", 8.0))
+
+# Worker process state, set up once per worker by attach_worker
+worker_state = {}
+
+
+def spatial_order(points, cell_size=SPATIAL_CELL):
+    cells = np.floor(np.asarray(points, dtype=np.float64).reshape(-1, 3) / cell_size).astype(np.int64)
+    return np.lexsort((cells[:, 2], cells[:, 1], cells[:, 0]))
+
+
+def spatial_parts(parts, cell_size=SPATIAL_CELL):
+    # Instances sorted by grid cell, so every contiguous range of a part is a compact block of space
+    ordered = []
+    for vertices, faces, linear, offsets in parts:
+        if not len(offsets):
+            continue
+        order = spatial_order(offsets, cell_size)
+        ordered.append((vertices, faces, None if linear is None else linear[order], offsets[order]))
+    return ordered
+
+
+def work_items(parts, work_triangles=WORK_TRIANGLES):
+    # (part, first instance, end instance, first vertex, first face) per item, with offsets in output order;
+    # returns the items and the total vertex and face counts
+    items = []
+    vertex_offset, face_offset = 0, 0
+    for index, (vertices, faces, _, offsets) in enumerate(parts):
+        instances_per_item = max(1, work_triangles // max(len(faces), 1))
+        for start in range(0, len(offsets), instances_per_item):
+            stop = min(start + instances_per_item, len(offsets))
+            items.append((index, start, stop, vertex_offset, face_offset))
+            vertex_offset += (stop - start) * len(vertices)
+            face_offset += (stop - start) * len(faces)
+    return items, vertex_offset, face_offset
+
+
+def use_parallel(parts, workers=MESH_WORKERS):
+    # With a single CPU the pool only adds forking and copying to the serial work. Daemonic processes (batch
+    # workers) may not start a pool of their own, and a process running other threads (the web server) is not
+    # forked, since a child can inherit locks those threads hold and deadlock
+    if min(workers, AVAILABLE_CPUS) <= 1 or multiprocessing.current_process().daemon or \
+            threading.active_count() > 1:
+        return False
+    return sum(part_size(part)[1] for part in parts if len(part[3])) >= PARALLEL_MIN_TRIANGLES
+
+
+def shared_buffer(size):
+    return shared_memory.SharedMemory(create=True, size=max(int(size), 1))
+
+
+def release(memories):
+    for memory in memories:
+        memory.close()
+        memory.unlink()
+
+
+def attach_worker(parts, buffers):
+    # With fork the parts and the shared mappings are inherited as they are; nothing is pickled
+    worker_state["parts"] = parts
+    worker_state["arrays"] = [np.ndarray(shape, dtype=dtype, buffer=memory.buf) for memory, dtype, shape in buffers]
+    worker_state["memories"] = [memory for memory, _, _ in buffers]
+
+
+def fill_mesh(item):
+    index, start, stop, vertex_offset, face_offset = item
+    part = worker_state["parts"][index]
+    vertices, faces = worker_state["arrays"]
+    block = instance_vertices(part, start, stop)
+    vertices[vertex_offset:vertex_offset + len(block)] = block
+    block = instance_faces(part, vertex_offset, start, stop)
+    faces[face_offset:face_offset + len(block)] = block
+
+
+def fill_stl(item):
+    index, start, stop, _, face_offset = item
+    part = worker_state["parts"][index]
+    records, = worker_state["arrays"]
+    triangles = instance_vertices(part, start, stop).reshape(stop - start, -1, 3)[:, part[1]].reshape(-1, 3, 3)
+    triangle_records(triangles, records[face_offset:face_offset + len(triangles)])
+
+
+def run_workers(task, parts, items, buffers, workers):
+    if not items:
+        return
+    context = multiprocessing.get_context("fork" if hasattr(os, "fork") else "spawn")
+    with context.Pool(min(workers, len(items)), initializer=attach_worker, initargs=(parts, buffers)) as pool:
+        for _ in pool.imap_unordered(task, items):
+            pass
+
+
+def parallel_mesh_arrays(parts, workers=MESH_WORKERS):
+    # Vertices and faces of the whole model, written by the workers straight into shared memory at
+    # precomputed offsets; instances come out in spatial order rather than part order
+    with stage("spatial_order"):
+        parts = spatial_parts(parts)
+        items, vertex_count, face_count = work_items(parts)
+    vertex_memory = shared_buffer(vertex_count * 3 * 8)
+    face_memory = shared_buffer(face_count * 3 * 8)
+    try:
+        with stage("parallel_fill", workers=workers, items=len(items), triangles=face_count):
+            run_workers(fill_mesh, parts, items, [(vertex_memory, np.float64, (vertex_count, 3)),
+                                                  (face_memory, np.int64, (face_count, 3))], workers)
+        vertices = np.ndarray((vertex_count, 3), dtype=np.float64, buffer=vertex_memory.buf).copy()
+        faces = np.ndarray((face_count, 3), dtype=np.int64, buffer=face_memory.buf).copy()
+    finally:
+        release([vertex_memory, face_memory])
+    return vertices, faces
+
+
+def parallel_write_binary_stl(file_path, parts, workers=MESH_WORKERS):
+    # Workers fill one shared buffer of STL records, which is then written out in a single call
+    with stage("spatial_order"):
+        parts = spatial_parts(parts)
+        items, _, triangle_count = work_items(parts)
+    memory = shared_buffer(triangle_count * STL_TRIANGLE.itemsize)
+    try:
+        with stage("parallel_fill", workers=workers, items=len(items), triangles=triangle_count):
+            run_workers(fill_stl, parts, items, [(memory, STL_TRIANGLE, (triangle_count,))], workers)
+        with stage("write"):
+            temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as fp:
+                fp.write(STL_HEADER.ljust(80, b"\0"))
+                fp.write(struct.pack("<I", triangle_count))
+                fp.write(memory.buf[:triangle_count * STL_TRIANGLE.itemsize])
+            os.replace(temporary_path, file_path)
+    finally:
+        release([memory])
+    return triangle_count
@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import trimesh
+from skimage.measure import marching_cubes
+
+from mesh_assembler import instance_vertices, mesh_parts
+from structure_frame import concatenated_ranges
+
+SOLID_VOXEL_SIZE = float(os.environ.get("CRYSTALPRINTER_SOLID_VOXEL", 0.1))
+MAX_SOLID_VOXELS = int(os.environ.get("CRYSTALPRINTER_SOLID_MAX_VOXELS", 1 << 25))
+CHUNK_SAMPLES = 1 << 22
+# Distances are only computed this many voxels beyond each primitive; marching cubes never looks further
+BAND_VOXELS = 2
+
+
+def classify_part(part):
+    # Templated parts are recognised from their template: an origin-centred sphere without a linear map,
+    # or a z-aligned cylinder centred at the origin. Anything else is treated as a union of convex pieces
+    vertices, _, linear, _ = part
+    if linear is None:
+        norms = np.linalg.norm(vertices, axis=1)
+        if len(norms) and np.ptp(norms) <= 1e-6 * norms.max():
+            return "sphere"
+    elif len(vertices) and np.allclose(np.abs(vertices[:, 2]), np.abs(vertices[:, 2]).max()):
+        return "cylinder"
+    return "convex"
+
+
+def sphere_primitives(part):
+    vertices, _, _, centers = part
+    radius = np.linalg.norm(vertices, axis=1).max()
+
+    def distance(index, points):
+        return np.linalg.norm(points - centers[index], axis=1) - radius
+
+    return centers - radius, centers + radius, distance
+
+
+def cylinder_primitives(part):
+    vertices, _, linear, centers = part
+    radii = np.linalg.norm(linear[:, :, 0], axis=1) * np.linalg.norm(vertices[:, :2], axis=1).max()
+    heights = np.linalg.norm(linear[:, :, 2], axis=1) * 2 * np.abs(vertices[:, 2]).max()
+    axes = linear[:, :, 2] / heights[:, np.newaxis]
+    extent = np.abs(axes) * heights[:, np.newaxis] / 2 + radii[:, np.newaxis]
+
+    def distance(index, points):
+        # Exact signed distance to a capped cylinder
+        relative = points - centers[index]
+        axial = np.einsum("ij,ij->i", relative, axes[index])
+        radial = np.sqrt(np.maximum(np.einsum("ij,ij->i", relative, relative) - axial ** 2, 0.0))
+        d_radial = radial - radii[index]
+        d_axial = np.abs(axial) - heights[index] / 2
+        return np.minimum(np.maximum(d_radial, d_axial), 0.0) + np.hypot(np.maximum(d_radial, 0.0),
+                                                                         np.maximum(d_axial, 0.0))
+
+    return centers - extent, centers + extent, distance
+
+
+def convex_primitives(part):
+    # Each connected component of each instance becomes the intersection of its face planes.
+    # The distance is exact inside and a lower bound outside, which keeps the zero level set exact
+    _, faces, _, offsets = part
+    instances = instance_vertices(part).reshape(len(offsets), -1, 3)
+    lower, upper, planes = [], [], []
+    for vertices in instances:
+        mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+        for piece in mesh.split(only_watertight=False):
+            valid = piece.area_faces > 0
+            normals = piece.face_normals[valid]
+            lower.append(piece.bounds[0])
+            upper.append(piece.bounds[1])
+            planes.append((normals, np.einsum("ij,ij->i", normals, piece.triangles[valid, 0])))
+
+    def distance(index, points):
+        result = np.empty(len(points))
+        for piece in np.unique(index):
+            selected = index == piece
+            normals, heights = planes[piece]
+            result[selected] = (points[selected] @ normals.T - heights).max(axis=1)
+        return result
+
+    return np.array(lower).reshape(-1, 3), np.array(upper).reshape(-1, 3), distance
+
+
+PRIMITIVES = {"sphere": sphere_primitives, "cylinder": cylinder_primitives, "convex": convex_primitives}
+
+
+def splat_distances(field, origin, voxel_size, lower, upper, distance, chunk_samples=CHUNK_SAMPLES):
+    # Evaluates every primitive on the voxels of its own padded box and keeps the minimum (the union)
+    shape = np.array(field.shape)
+    first = np.clip(np.floor((lower - origin) / voxel_size).astype(np.int64) - BAND_VOXELS, 0, shape - 1)
+    last = np.clip(np.ceil((upper - origin) / voxel_size).astype(np.int64) + BAND_VOXELS, 0, shape - 1)
+    dims = last - first + 1
+    counts = dims.prod(axis=1)
+
+    flat_field = field.reshape(-1)
+    ends = np.cumsum(counts)
+    start = 0
+    while start < len(counts):
+        stop = max(int(np.searchsorted(ends, ends[start] - counts[start] + chunk_samples, side="right")), start + 1)
+        chunk = np.arange(start, stop)
+        start = stop
+
+        index = np.repeat(chunk, counts[chunk])
+        local = concatenated_ranges(np.zeros(len(chunk), dtype=np.int64), counts[chunk])
+        box = dims[index]
+        i, rest = np.divmod(local, box[:, 1] * box[:, 2])
+        j, k = np.divmod(rest, box[:, 2])
+        voxels = first[index] + np.stack([i, j, k], axis=1)
+        distances = distance(index, origin + voxels * voxel_size)
+        np.minimum.at(flat_field, np.ravel_multi_index(voxels.T, field.shape), distances)
+
+
+def solidify(parts, voxel_size=SOLID_VOXEL_SIZE, max_voxels=MAX_SOLID_VOXELS):
+    # Signed distance remesh: the union of all parts is sampled on a grid and one closed surface is extracted,
+    # with no hidden internal faces left for the slicer to repair
+    primitives = [PRIMITIVES[classify_part(part)](part) for part in parts if len(part[3])]
+    if not primitives:
+        return trimesh.Trimesh()
+
+    lower = np.min([bounds[0].min(axis=0) for bounds in primitives], axis=0)
+    upper = np.max([bounds[1].max(axis=0) for bounds in primitives], axis=0)
+    # Coarsen the grid rather than run out of memory on large models
+    voxel_size = max(voxel_size, (np.prod(upper - lower) / max_voxels) ** (1 / 3))
+    origin = lower - (BAND_VOXELS + 1) * voxel_size
+    shape = tuple(int(n) for n in np.ceil((upper - origin) / voxel_size) + BAND_VOXELS + 2)
+
+    field = np.full(shape, (BAND_VOXELS + 1) * voxel_size, dtype=np.float32)
+    for primitive_lower, primitive_upper, distance in primitives:
+        splat_distances(field, origin, voxel_size, primitive_lower, primitive_upper, distance)
+
+    vertices, faces, _, _ = marching_cubes(field, level=0.0, spacing=(voxel_size,) * 3, allow_degenerate=False)
+    mesh = trimesh.Trimesh(vertices=vertices + origin, faces=faces, process=False)
+    if mesh.volume < 0:
+        mesh.invert()
+    return mesh
+
+
+def solidify_parts(parts, voxel_size=SOLID_VOXEL_SIZE):
+    return mesh_parts(solidify(parts, voxel_size))
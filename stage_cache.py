@@ -0,0 +1,92 @@
+import os
+
+from mesh_assembler import PARTS_EXTENSION, load_parts, save_parts
+from mesh_preview import PREVIEW_EXTENSION, load_preview, save_preview
+from structure_cache import DiskCache, content_hash
+from structure_file import STRUCTURE_EXTENSION, read_structure_file, write_structure_file
+
+STAGE_DIRECTORY = os.environ.get("CRYSTALPRINTER_STAGE_DIR", "stage_cache")
+STAGE_CACHE_ENABLED = os.environ.get("CRYSTALPRINTER_STAGE_CACHE", "1").lower() in ("1", "true", "yes", "on")
+MAX_STAGE_ENTRIES = int(os.environ.get("CRYSTALPRINTER_STAGE_ENTRIES", 16))
+MAX_STAGE_BYTES = int(os.environ.get("CRYSTALPRINTER_STAGE_BYTES", 1024 * 1024 * 1024))
+
+
+def stage_key(stage_name, *inputs):
+    # A stage's key covers its own inputs plus the keys of the stages it depends on
+    return content_hash(b"stage", stage_name, *inputs)
+
+
+class StageCache(DiskCache):
+    # Outputs of the expensive pipeline stages, in memory for this process and on disk for every worker
+    def __init__(self, directory=STAGE_DIRECTORY, max_entries=MAX_STAGE_ENTRIES, max_bytes=MAX_STAGE_BYTES,
+                 enabled=STAGE_CACHE_ENABLED):
+        super().__init__(directory, max_entries, max_bytes)
+        self.enabled = enabled
+
+    def frame(self, key):
+        return self._lookup(key, STRUCTURE_EXTENSION, read_structure_file)
+
+    def store_frame(self, key, frame):
+        # Kept memory mapped afterwards, so large structures do not stay resident
+        stored = self._write(key, STRUCTURE_EXTENSION, write_structure_file, read_structure_file, frame)
+        return frame if stored is None else stored
+
+    def parts(self, key):
+        return self._lookup(key, PARTS_EXTENSION, load_parts)
+
+    def store_parts(self, key, parts):
+        self._write(key, PARTS_EXTENSION, save_parts, None, parts)
+        return parts
+
+    def preview(self, key):
+        return self._lookup(key, PREVIEW_EXTENSION, load_preview)
+
+    def store_preview(self, key, preview):
+        self._write(key, PREVIEW_EXTENSION, lambda path, value: save_preview(path, *value), None, preview)
+        return preview
+
+    def value(self, key):
+        # Small results that are cheap to recompute stay in memory only
+        return self._remember(key) if self.enabled else None
+
+    def store_value(self, key, value):
+        if self.enabled:
+            self._store(key, value)
+        return value
+
+    def _lookup(self, key, extension, reader):
+        if not self.enabled:
+            return None
+        cached = self._remember(key)
+        if cached is not None:
+            return cached
+        path = self._path(key, extension)
+        try:
+            value = reader(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        # Touch on read so eviction drops the least recently used files first
+        os.utime(path)
+        self._store(key, value)
+        return value
+
+    def _write(self, key, extension, writer, reader, value):
+        if not self.enabled:
+            return None
+        if self.max_bytes <= 0:
+            self._store(key, value)
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key, extension)
+        writer(path, value)
+        if reader is not None:
+            value = reader(path)
+        self._store(key, value)
+        self._evict()
+        return value
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, f"{key}{extension}")
+
+
+stage_cache = StageCache()
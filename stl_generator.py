@@ -1,7 +1,10 @@
-import trimesh
 import pyvista as pv
+from bond_set import canonical_bonds
 from cif_reader import get_structure_with_cif, bond_by_nearest_neighbors
-from geometry_processor import add_supports, rotate_structure, translate_structure
+from geometry_processor import add_supports, compose_transform, transform_structure
+from mesh_assembler import arrow_parts, assemble_mesh, cylinder_parts, sphere_parts
+from structure_frame import StructureFrame
+from tessellation import resolve_tessellation
 import numpy as np
 
 atomic_radii = {
@@ -43,69 +46,46 @@ def scale_radius(radius):
 atomic_radii = {atom: scale_radius(radius) if radius is not None else None for atom, radius in atomic_radii.items()}
 bond_radius = 0.25
 
-def create_sphere(position, radius=0.5, color=(0, 0, 0)):
-    sphere = trimesh.creation.icosphere(radius=radius)
-    sphere.apply_translation(position)
-    sphere.visual.vertex_colors = np.array([color] * len(sphere.vertices), dtype=np.uint8)
-    return sphere
-
-def create_cylinder(start, end, radius=0.1):
-    vec = np.array(end) - np.array(start)
-    length = np.linalg.norm(vec)
-    direction = vec / length
-    cylinder = trimesh.creation.cylinder(radius=radius, height=length)
-    align_matrix = trimesh.geometry.align_vectors([0, 0, 1], direction)
-    cylinder.apply_transform(align_matrix)
-    midpoint = (np.array(start) + np.array(end)) / 2
-    cylinder.apply_translation(midpoint)
-    return cylinder
-
-def create_arrow(start, direction, length=2.0, shaft_radius=0.2, tip_radius=0.4, tip_length=0.8):
-    direction = np.array(direction, dtype=float)
-    direction /= np.linalg.norm(direction)
-
-    cylinder = trimesh.creation.cylinder(radius=shaft_radius, height=length)
-    cylinder.apply_translation([0, 0, length / 2])
-
-    cone = trimesh.creation.cone(radius=tip_radius, height=tip_length)
-    cone.apply_translation([0, 0, length * 0.9 + tip_length / 2])
-
-    arrow = trimesh.util.concatenate(cylinder, cone)
-    align_matrix = trimesh.geometry.align_vectors([0, 0, 1], direction)
-    arrow.apply_transform(align_matrix)
-    arrow.apply_translation(start)
-    return arrow
-
-def atoms_and_bonds_to_mesh(structure):
-    atoms_and_bonds_mesh = trimesh.Trimesh()
-    magnetic_spins = []
-
-    for atom in structure:
-        atom_radius = atomic_radii[atom['atom_label']]
-        atom_sphere = create_sphere(position=atom['cartesian_position'], radius=atom_radius)
-        atoms_and_bonds_mesh += atom_sphere
-
-        for connection in atom['connected_atoms']:
-            start = atom['cartesian_position']
-            end = connection['connected_cartesian_position']
-            bond_cylinder = create_cylinder(start, end, radius=bond_radius)
-            atoms_and_bonds_mesh += bond_cylinder
-
-        if 'magnetic_spin' in atom and atom['magnetic_spin']['direction'] != [0, 0, 0]:
-            direction = np.array(atom['magnetic_spin']['direction'])
-            spin_length = atom_radius * 1.5
-            spin_shaft_radius = atom_radius * 0.15
-            spin_tip_radius = atom_radius * 0.3
-            spin_tip_length = atom_radius * 0.3
-            magnetic_spins.append((atom['cartesian_position'], direction, spin_length, spin_shaft_radius,
-                                   spin_tip_radius, spin_tip_length))
-
-    for pos, direction, length, shaft_radius, tip_radius, tip_length in magnetic_spins:
-        arrow = create_arrow(pos, direction, length=length, shaft_radius=shaft_radius, tip_radius=tip_radius,
-                             tip_length=tip_length)
-        atoms_and_bonds_mesh += arrow
-
-    return atoms_and_bonds_mesh
+def atoms_and_bonds_to_parts(structure, tessellation=None):
+    centers, radii = [], []
+    bond_starts, bond_ends = [], []
+    spin_starts, spin_directions, spin_radii = [], [], []
+
+    if isinstance(structure, StructureFrame):
+        structure = canonical_bonds(structure)
+        radii = structure.species_values(atomic_radii)
+        centers = structure.positions
+        bond_starts, bond_ends = structure.bond_starts(), structure.bond_ends
+        if structure.spins is not None:
+            spinning = np.any(structure.spins != 0, axis=1)
+            spin_starts, spin_directions = centers[spinning], structure.spins[spinning]
+            spin_radii = radii[spinning]
+    else:
+        for atom in structure:
+            atom_radius = atomic_radii[atom['atom_label']]
+            centers.append(atom['cartesian_position'])
+            radii.append(atom_radius)
+
+            for connection in atom['connected_atoms']:
+                bond_starts.append(atom['cartesian_position'])
+                bond_ends.append(connection['connected_cartesian_position'])
+
+            if 'magnetic_spin' in atom and atom['magnetic_spin']['direction'] != [0, 0, 0]:
+                spin_starts.append(atom['cartesian_position'])
+                spin_directions.append(atom['magnetic_spin']['direction'])
+                spin_radii.append(atom_radius)
+
+    tessellation = resolve_tessellation(tessellation, centers, radii, len(bond_starts))
+    parts = sphere_parts(centers, radii, tessellation) + cylinder_parts(bond_starts, bond_ends, bond_radius, tessellation)
+
+    # Arrow sizes follow the atom radius: a shaft 1.5 radii long with a tip 0.3 radii wide and long
+    spin_radii = np.asarray(spin_radii, dtype=np.float64)
+    parts += arrow_parts(spin_starts, spin_directions, spin_radii * 1.5, spin_radii * 0.15, spin_radii * 0.3,
+                         spin_radii * 0.3, tessellation)
+    return parts
+
+def atoms_and_bonds_to_mesh(structure, tessellation=None):
+    return assemble_mesh(atoms_and_bonds_to_parts(structure, tessellation))
 
 def export_to_stl(mesh, file_path):
     mesh.export(file_path)
@@ -114,13 +94,14 @@ unique_atoms = get_structure_with_cif(
     file_path='Yb2Si2O7.cif',
     num_unit_cells=[1.5, 1, 2],
     target_atoms=["Yb"],
-    site_index_spin={0: [0, 0, 1]}
+    site_index_spin={0: [0, 0, 1]},
+    as_frame=True,
+    bonding="none"
 )
 
 if unique_atoms is not None:
-    unique_atoms = rotate_structure(unique_atoms, [0, 0, 0])
-    unique_atoms = translate_structure(unique_atoms, [0, 0, 2])
-    unique_atoms = rotate_structure(unique_atoms, [10, 10, 0])
+    transform = compose_transform([("rotate", [0, 0, 0]), ("translate", [0, 0, 2]), ("rotate", [10, 10, 0])])
+    unique_atoms = transform_structure(unique_atoms, transform)
     unique_atoms = bond_by_nearest_neighbors(unique_atoms, tolerance=0.45)
     mesh = atoms_and_bonds_to_mesh(unique_atoms)
 
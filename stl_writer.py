@@ -0,0 +1,74 @@
+import os
+import struct
+import threading
+
+import numpy as np
+
+from mesh_assembler import instance_vertices, part_size
+
+STL_HEADER = b"CrystalPrinter binary STL"
+STL_TRIANGLE = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attributes", "<u2")])
+CHUNK_TRIANGLES = 1 << 18
+
+
+def iter_part_triangles(part, chunk_triangles=CHUNK_TRIANGLES):
+    _, faces, _, offsets = part
+    instances_per_chunk = max(1, chunk_triangles // max(len(faces), 1))
+    for start in range(0, len(offsets), instances_per_chunk):
+        stop = start + instances_per_chunk
+        vertices = instance_vertices(part, start, stop).reshape(len(offsets[start:stop]), -1, 3)
+        yield vertices[:, faces].reshape(-1, 3, 3)
+
+
+def triangle_records(triangles, records=None):
+    # records, when given, is filled in place, e.g. a slice of a shared output buffer
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, lengths, out=normals, where=lengths > 0)
+
+    if records is None:
+        records = np.zeros(len(triangles), dtype=STL_TRIANGLE)
+    else:
+        records["attributes"] = 0
+    records["normal"] = normals
+    records["vertices"] = triangles
+    return records
+
+
+def write_binary_stl(file_path, parts, chunk_triangles=CHUNK_TRIANGLES):
+    # The triangle count is known up front from the instance counts, so the file is written in one pass
+    parts = [part for part in parts if len(part[3])]
+    triangle_count = sum(part_size(part)[1] for part in parts)
+
+    # Written next to the target and renamed, so readers never see a half-written file
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as fp:
+        fp.write(STL_HEADER.ljust(80, b"\0"))
+        fp.write(struct.pack("<I", triangle_count))
+        for part in parts:
+            for triangles in iter_part_triangles(part, chunk_triangles):
+                fp.write(triangle_records(triangles).tobytes())
+    os.replace(temporary_path, file_path)
+
+    return triangle_count
+
+
+def write_binary_stl_stream(file_path, part_batches, chunk_triangles=CHUNK_TRIANGLES):
+    # For parts produced batch by batch: the triangle count is patched into the header at the end
+    triangle_count = 0
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as fp:
+        fp.write(STL_HEADER.ljust(80, b"\0"))
+        fp.write(struct.pack("<I", 0))
+        for parts in part_batches:
+            for part in parts:
+                if not len(part[3]):
+                    continue
+                for triangles in iter_part_triangles(part, chunk_triangles):
+                    fp.write(triangle_records(triangles).tobytes())
+                    triangle_count += len(triangles)
+        fp.seek(80)
+        fp.write(struct.pack("<I", triangle_count))
+    os.replace(temporary_path, file_path)
+
+    return triangle_count
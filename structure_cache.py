@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from monty.json import MontyEncoder
+from pymatgen.analysis.graphs import StructureGraph
+from pymatgen.core import Structure
+
+CACHE_DIRECTORY = os.environ.get("CRYSTALPRINTER_CACHE_DIR", "cache")
+MAX_MEMORY_ENTRIES = int(os.environ.get("CRYSTALPRINTER_CACHE_ENTRIES", 32))
+MAX_DISK_BYTES = int(os.environ.get("CRYSTALPRINTER_CACHE_BYTES", 512 * 1024 * 1024))
+
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True, default=str).encode("utf8")
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def evict_files(directory, max_bytes, extension=None, ttl=None):
+    # Drops files older than ttl, then the least recently used ones until the rest fit in max_bytes;
+    # with an extension only those files are counted, and temporary files are always left alone
+    entries = []
+    now = time.time()
+    for filename in os.listdir(directory):
+        if filename.endswith(".tmp") or (extension is not None and not filename.endswith(extension)):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            stat = os.stat(path)
+            if ttl is not None and now - stat.st_mtime > ttl:
+                os.remove(path)
+                continue
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def structure_key(cif_content, is_primitive):
+    return content_hash(b"structure", cif_content, bool(is_primitive))
+
+
+def graph_key(structure_cache_key, strategy_params):
+    return content_hash(b"graph", structure_cache_key.encode("ascii"), strategy_params)
+
+
+def graph_to_edges(graph):
+    edges = list(graph.graph.edges(data=True))
+    weights = [data.get("weight") for _, _, data in edges]
+    return {
+        "from_index": np.array([u for u, _, _ in edges], dtype=np.int64),
+        "to_index": np.array([v for _, v, _ in edges], dtype=np.int64),
+        "to_jimage": np.array([data["to_jimage"] for _, _, data in edges], dtype=np.int64).reshape(-1, 3),
+        "weight": np.array([np.nan if weight is None else weight for weight in weights], dtype=np.float64),
+    }
+
+
+def graph_from_edges(structure, edges):
+    bonds = {}
+    for from_index, to_index, to_jimage, weight in zip(edges["from_index"].tolist(), edges["to_index"].tolist(),
+                                                       edges["to_jimage"].tolist(), edges["weight"].tolist()):
+        weight = None if np.isnan(weight) else weight
+        bonds[(from_index, to_index, (0, 0, 0), tuple(to_jimage))] = {"weight": weight}
+    return StructureGraph.from_edges(structure, bonds)
+
+
+class DiskCache:
+    # A least recently used in-memory layer over a size-capped directory; subclasses read and write the files.
+    # Only files ending in extension count towards max_bytes, or every file when it is None
+    extension = None
+
+    def __init__(self, directory, max_entries, max_bytes):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, filename))
+
+    def _remember(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        return None
+
+    def _store(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _evict(self):
+        evict_files(self.directory, self.max_bytes, self.extension)
+
+
+class StructureCache(DiskCache):
+    extension = ".npz"
+
+    def __init__(self, directory=CACHE_DIRECTORY, max_entries=MAX_MEMORY_ENTRIES, max_bytes=MAX_DISK_BYTES):
+        super().__init__(directory, max_entries, max_bytes)
+
+    def structure(self, key):
+        cached = self._remember(key)
+        if cached is not None:
+            return cached
+        arrays = self._read(key)
+        if arrays is None:
+            return None
+        structure = Structure.from_dict(json.loads(str(arrays["structure"])))
+        self._store(key, structure)
+        return structure
+
+    def store_structure(self, key, structure):
+        self._store(key, structure)
+        self._write(key, structure=np.array(json.dumps(structure.as_dict(), cls=MontyEncoder)))
+
+    def graph(self, key, structure):
+        cached = self._remember(key)
+        if cached is not None:
+            return cached
+        arrays = self._read(key)
+        if arrays is None:
+            return None
+        graph = graph_from_edges(structure, arrays)
+        self._store(key, graph)
+        return graph
+
+    def store_graph(self, key, graph):
+        self._store(key, graph)
+        self._write(key, **graph_to_edges(graph))
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}{self.extension}")
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+        # Touch on read so eviction drops the least recently used files first
+        os.utime(path)
+        return arrays
+
+    def _write(self, key, **arrays):
+        if self.max_bytes <= 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as fp:
+            np.savez_compressed(fp, **arrays)
+        os.replace(temporary_path, path)
+        self._evict()
+
+
+structure_cache = StructureCache()
@@ -0,0 +1,120 @@
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+from bond_set import bond_target_atoms
+from structure_frame import StructureFrame, concatenated_ranges
+
+# Layout: magic, format version and header length, a JSON header, then every array at a 64 byte aligned offset.
+# The header lists each array's dtype, shape and offset, so readers can map them without parsing anything else
+STRUCTURE_MAGIC = b"CPSTRUCT"
+STRUCTURE_VERSION = 1
+STRUCTURE_EXTENSION = ".cpstruct"
+PREAMBLE = struct.Struct("<8sIQ")
+ALIGNMENT = 64
+CHUNK_ATOMS = int(os.environ.get("CRYSTALPRINTER_CHUNK_ATOMS", 1 << 16))
+
+# Frame arrays in file order with their on-disk dtypes; optional ones are only written when the frame has them
+ARRAY_FIELDS = (
+    ("positions", "<f8"),
+    ("species_codes", "<i4"),
+    ("bond_offsets", "<i8"),
+    ("bond_ends", "<f8"),
+    ("bond_targets", "<i8"),
+    ("spins", "<f8"),
+    ("site_indices", "<i8"),
+    ("fractional_positions", "<f8"),
+    ("bond_fractional_ends", "<f8"),
+    ("bond_lengths", "<f8"),
+    ("bond_site_indices", "<i8"),
+    ("bond_species_codes", "<i4"),
+)
+WRITE_ROWS = 1 << 20
+
+
+def aligned(offset):
+    return offset + (-offset % ALIGNMENT)
+
+
+def write_structure_file(file_path, frame, metadata=None):
+    # Bond targets are resolved against the whole structure first, so chunked readers can still tell
+    # which bonds join two atoms of the structure
+    frame = frame.replace(bond_targets=bond_target_atoms(frame))
+    arrays = [(name, np.asarray(getattr(frame, name)), dtype) for name, dtype in ARRAY_FIELDS
+              if getattr(frame, name) is not None]
+
+    header = {"atoms": len(frame), "bonds": frame.bond_count, "species": frame.species,
+              "oxi_species": frame.oxi_species, "metadata": metadata or {}, "arrays": {}}
+    # Offsets depend on the header length, which depends on the offsets; two passes settle it
+    for _ in range(2):
+        offset = aligned(PREAMBLE.size + len(json.dumps(header).encode("utf8")))
+        for name, values, dtype in arrays:
+            header["arrays"][name] = {"dtype": dtype, "shape": list(values.shape), "offset": offset}
+            offset = aligned(offset + values.size * np.dtype(dtype).itemsize)
+    header_bytes = json.dumps(header).encode("utf8")
+
+    temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as fp:
+        fp.write(PREAMBLE.pack(STRUCTURE_MAGIC, STRUCTURE_VERSION, len(header_bytes)))
+        fp.write(header_bytes)
+        for name, values, dtype in arrays:
+            fp.seek(header["arrays"][name]["offset"])
+            for start in range(0, len(values), WRITE_ROWS):
+                fp.write(np.ascontiguousarray(values[start:start + WRITE_ROWS], dtype=dtype).tobytes())
+        fp.truncate(aligned(fp.tell()))
+    os.replace(temporary_path, file_path)
+    return file_path
+
+
+def read_structure_header(file_path):
+    with open(file_path, "rb") as fp:
+        magic, version, header_length = PREAMBLE.unpack(fp.read(PREAMBLE.size))
+        if magic != STRUCTURE_MAGIC:
+            raise ValueError(f"Not a structure file: {file_path}")
+        if version > STRUCTURE_VERSION:
+            raise ValueError(f"Unsupported structure file version {version}: {file_path}")
+        return json.loads(fp.read(header_length))
+
+
+def read_structure_file(file_path, mmap_mode="r"):
+    # Arrays are memory mapped, so only the pages a stage touches are read from disk
+    header = read_structure_header(file_path)
+    fields = {}
+    for name, layout in header["arrays"].items():
+        shape = tuple(layout["shape"])
+        if 0 in shape:
+            fields[name] = np.empty(shape, dtype=layout["dtype"])
+        else:
+            fields[name] = np.memmap(file_path, dtype=layout["dtype"], mode=mmap_mode, offset=layout["offset"],
+                                     shape=shape)
+    return StructureFrame(species=header["species"], oxi_species=header["oxi_species"], **fields)
+
+
+def reverse_bond_exists(frame, sources, targets):
+    # Whether each bond target -> source is also listed, read from the targets' own bond ranges only
+    starts = np.asarray(frame.bond_offsets[targets])
+    counts = np.asarray(frame.bond_offsets[targets + 1]) - starts
+    bond_index = concatenated_ranges(starts, counts)
+    owners = np.repeat(np.arange(len(targets)), counts)
+    found = np.zeros(len(targets), dtype=bool)
+    found[owners[np.asarray(frame.bond_targets[bond_index]) == sources[owners]]] = True
+    return found
+
+
+def atom_chunks(frame, chunk_atoms=CHUNK_ATOMS):
+    # Consecutive atom ranges as standalone frames. A bond between two chunks listed in both directions is
+    # kept once, on the chunk of its lower atom; targets outside the chunk are marked -1
+    for start in range(0, len(frame), chunk_atoms):
+        stop = min(start + chunk_atoms, len(frame))
+        chunk = frame.atom_range(start, stop)
+        sources = chunk.bond_sources() + start
+        targets = np.asarray(frame.bond_targets[frame.bond_offsets[start]:frame.bond_offsets[stop]])
+        earlier = np.nonzero((targets >= 0) & (targets < start))[0]
+        if len(earlier):
+            keep = np.ones(len(targets), dtype=bool)
+            keep[earlier] = ~reverse_bond_exists(frame, sources[earlier], targets[earlier])
+            chunk = chunk.select_bonds(keep)
+        yield chunk
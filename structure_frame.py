@@ -0,0 +1,286 @@
+import numpy as np
+
+
+class StructureFrame:
+    def __init__(self, positions, species_codes, species, bond_offsets=None, bond_ends=None, bond_targets=None,
+                 fractional_positions=None, site_indices=None, oxi_species=None, bond_fractional_ends=None,
+                 bond_lengths=None, bond_site_indices=None, bond_species_codes=None, spins=None):
+        self.positions = np.ascontiguousarray(positions, dtype=np.float64).reshape(-1, 3)
+        self.species_codes = np.ascontiguousarray(species_codes, dtype=np.int32).reshape(-1)
+        self.species = list(species)
+        self.oxi_species = list(oxi_species) if oxi_species is not None else None
+        self.fractional_positions = _optional_array(fractional_positions, np.float64, (-1, 3))
+        self.site_indices = _optional_array(site_indices, np.int64, (-1,))
+
+        # Bonds in CSR layout: the bonds of atom i are bond_offsets[i]:bond_offsets[i + 1]
+        if bond_offsets is None:
+            bond_offsets = np.zeros(len(self.positions) + 1, dtype=np.int64)
+        self.bond_offsets = np.ascontiguousarray(bond_offsets, dtype=np.int64).reshape(-1)
+        n_bonds = int(self.bond_offsets[-1])
+        if bond_ends is None:
+            bond_ends = np.empty((0, 3))
+        self.bond_ends = np.ascontiguousarray(bond_ends, dtype=np.float64).reshape(-1, 3)
+        if bond_targets is None:
+            bond_targets = np.full(n_bonds, -1, dtype=np.int64)
+        self.bond_targets = np.ascontiguousarray(bond_targets, dtype=np.int64).reshape(-1)
+        self.bond_fractional_ends = _optional_array(bond_fractional_ends, np.float64, (-1, 3))
+        self.bond_lengths = _optional_array(bond_lengths, np.float64, (-1,))
+        self.bond_site_indices = _optional_array(bond_site_indices, np.int64, (-1,))
+        self.bond_species_codes = _optional_array(bond_species_codes, np.int32, (-1,))
+
+        self.spins = _optional_array(spins, np.float64, (-1, 3))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return f"StructureFrame(atoms={len(self)}, bonds={self.bond_count}, species={self.species})"
+
+    @property
+    def bond_count(self):
+        return int(self.bond_offsets[-1])
+
+    @property
+    def labels(self):
+        return np.array(self.species, dtype=object)[self.species_codes]
+
+    @property
+    def nbytes(self):
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    def species_values(self, values, default=np.nan):
+        # Per-atom lookup of a per-label table such as atomic radii
+        table = [default if values.get(label) is None else values[label] for label in self.species]
+        return np.asarray(table, dtype=np.float64)[self.species_codes]
+
+    def bond_sources(self):
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.bond_offsets))
+
+    def bond_starts(self):
+        return self.positions[self.bond_sources()]
+
+    def replace(self, **changes):
+        fields = dict(vars(self))
+        fields.update(changes)
+        return StructureFrame(**fields)
+
+    def without_bonds(self):
+        return self.replace(bond_offsets=None, bond_ends=None, bond_targets=None, bond_fractional_ends=None,
+                            bond_lengths=None, bond_site_indices=None, bond_species_codes=None)
+
+    def with_bond_pairs(self, rows, cols):
+        # rows must be sorted so each atom's bonds are contiguous
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        bond_offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self)), out=bond_offsets[1:])
+        return self.replace(bond_offsets=bond_offsets, bond_ends=self.positions[cols], bond_targets=cols,
+                            bond_fractional_ends=None, bond_lengths=None, bond_site_indices=None,
+                            bond_species_codes=None)
+
+    def select(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        index = np.nonzero(mask)[0]
+        counts = np.diff(self.bond_offsets)[index]
+        bond_offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(counts, out=bond_offsets[1:])
+        bond_index = concatenated_ranges(self.bond_offsets[index], counts)
+
+        remap = np.full(len(self), -1, dtype=np.int64)
+        remap[index] = np.arange(len(index))
+        bond_targets = self.bond_targets[bond_index]
+        bond_targets = np.where(bond_targets >= 0, remap[np.maximum(bond_targets, 0)], -1)
+
+        return StructureFrame(
+            positions=self.positions[index],
+            species_codes=self.species_codes[index],
+            species=self.species,
+            oxi_species=self.oxi_species,
+            fractional_positions=_take(self.fractional_positions, index),
+            site_indices=_take(self.site_indices, index),
+            bond_offsets=bond_offsets,
+            bond_ends=self.bond_ends[bond_index],
+            bond_targets=bond_targets,
+            bond_fractional_ends=_take(self.bond_fractional_ends, bond_index),
+            bond_lengths=_take(self.bond_lengths, bond_index),
+            bond_site_indices=_take(self.bond_site_indices, bond_index),
+            bond_species_codes=_take(self.bond_species_codes, bond_index),
+            spins=_take(self.spins, index),
+        )
+
+    def atom_range(self, start, stop):
+        # Atoms start:stop and their bonds as slices, so a memory-mapped frame is only read for that range;
+        # targets outside the range become -1
+        bond_start, bond_stop = int(self.bond_offsets[start]), int(self.bond_offsets[stop])
+        bond_targets = np.asarray(self.bond_targets[bond_start:bond_stop]) - start
+        bond_targets[(bond_targets < 0) | (bond_targets >= stop - start)] = -1
+
+        def bond_slice(values):
+            return None if values is None else values[bond_start:bond_stop]
+
+        def atom_slice(values):
+            return None if values is None else values[start:stop]
+
+        return StructureFrame(
+            positions=self.positions[start:stop],
+            species_codes=self.species_codes[start:stop],
+            species=self.species,
+            oxi_species=self.oxi_species,
+            fractional_positions=atom_slice(self.fractional_positions),
+            site_indices=atom_slice(self.site_indices),
+            bond_offsets=self.bond_offsets[start:stop + 1] - bond_start,
+            bond_ends=self.bond_ends[bond_start:bond_stop],
+            bond_targets=bond_targets,
+            bond_fractional_ends=bond_slice(self.bond_fractional_ends),
+            bond_lengths=bond_slice(self.bond_lengths),
+            bond_site_indices=bond_slice(self.bond_site_indices),
+            bond_species_codes=bond_slice(self.bond_species_codes),
+            spins=atom_slice(self.spins),
+        )
+
+    def select_bonds(self, mask, bond_ends=None):
+        # Keeps the masked bonds on their source atoms; bond_ends optionally replaces the kept ends
+        mask = np.asarray(mask, dtype=bool)
+        bond_offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.bond_sources()[mask], minlength=len(self)), out=bond_offsets[1:])
+        return self.replace(
+            bond_offsets=bond_offsets,
+            bond_ends=self.bond_ends[mask] if bond_ends is None else bond_ends,
+            bond_targets=self.bond_targets[mask],
+            bond_fractional_ends=_take(self.bond_fractional_ends, mask),
+            bond_lengths=_take(self.bond_lengths, mask),
+            bond_site_indices=_take(self.bond_site_indices, mask),
+            bond_species_codes=_take(self.bond_species_codes, mask),
+        )
+
+    @classmethod
+    def from_atoms(cls, atoms):
+        species, oxi_species = [], []
+        codes = {}
+        species_codes = np.empty(len(atoms), dtype=np.int32)
+        for i, atom in enumerate(atoms):
+            key = (atom['atom_label'], atom.get('oxi_atom_label'))
+            if key not in codes:
+                codes[key] = len(species)
+                species.append(key[0])
+                oxi_species.append(key[1])
+            species_codes[i] = codes[key]
+
+        connections = [connection for atom in atoms for connection in atom['connected_atoms']]
+        bond_offsets = np.zeros(len(atoms) + 1, dtype=np.int64)
+        np.cumsum([len(atom['connected_atoms']) for atom in atoms], out=bond_offsets[1:])
+
+        fields = dict(
+            positions=[atom['cartesian_position'] for atom in atoms],
+            species_codes=species_codes,
+            species=species,
+            bond_offsets=bond_offsets,
+            bond_ends=[connection['connected_cartesian_position'] for connection in connections],
+            bond_targets=[connection.get('nearest_neighbor_index', -1) for connection in connections],
+        )
+        if any(oxi_label is not None for oxi_label in oxi_species):
+            fields['oxi_species'] = oxi_species
+        if atoms and 'fractional_position' in atoms[0]:
+            fields['fractional_positions'] = [atom['fractional_position'] for atom in atoms]
+        if atoms and 'site_index' in atoms[0]:
+            fields['site_indices'] = [atom['site_index'] for atom in atoms]
+        if any(atom.get('magnetic_spin') for atom in atoms):
+            fields['spins'] = [atom['magnetic_spin'].get('direction', [0, 0, 0]) for atom in atoms]
+
+        if connections and 'bond_length' in connections[0]:
+            oxi_codes = {oxi_label: code for code, oxi_label in enumerate(oxi_species)}
+            for connection in connections:
+                if connection['connected_to'] not in oxi_codes:
+                    oxi_codes[connection['connected_to']] = len(species)
+                    species.append(connection['connected_to'])
+                    oxi_species.append(connection['connected_to'])
+            fields['oxi_species'] = oxi_species
+            fields['bond_fractional_ends'] = [connection['connected_fractional_position']
+                                              for connection in connections]
+            fields['bond_lengths'] = [np.nan if connection['bond_length'] is None else connection['bond_length']
+                                      for connection in connections]
+            fields['bond_site_indices'] = [connection['site_index'] for connection in connections]
+            fields['bond_species_codes'] = [oxi_codes[connection['connected_to']] for connection in connections]
+
+        return cls(**fields)
+
+    def to_atoms(self):
+        labels = self.species
+        oxi_labels = self.oxi_species
+        bond_labels = oxi_labels if oxi_labels is not None else labels
+        positions = self.positions.tolist()
+        bond_ends = self.bond_ends.tolist()
+        offsets = self.bond_offsets.tolist()
+        graph_bonds = self.bond_site_indices is not None
+
+        if graph_bonds:
+            bond_fractional_ends = self.bond_fractional_ends.tolist()
+            # Missing bond weights are stored as NaN
+            bond_lengths = [None if np.isnan(length) else length for length in self.bond_lengths.tolist()]
+            bond_site_indices = self.bond_site_indices.tolist()
+            bond_species_codes = self.bond_species_codes.tolist()
+        else:
+            bond_targets = self.bond_targets.tolist()
+
+        atoms = []
+        for i, code in enumerate(self.species_codes.tolist()):
+            atom = {"atom_label": labels[code]}
+            if oxi_labels is not None and oxi_labels[code] is not None:
+                atom["oxi_atom_label"] = oxi_labels[code]
+            if self.fractional_positions is not None:
+                atom["fractional_position"] = self.fractional_positions[i].tolist()
+            atom["cartesian_position"] = positions[i]
+
+            bond_range = range(offsets[i], offsets[i + 1])
+            if graph_bonds:
+                atom["connected_atoms"] = [
+                    {
+                        "connected_to": bond_labels[bond_species_codes[b]],
+                        "bond_length": bond_lengths[b],
+                        "connected_fractional_position": bond_fractional_ends[b],
+                        "connected_cartesian_position": bond_ends[b],
+                        "site_index": bond_site_indices[b]
+                    }
+                    for b in bond_range
+                ]
+            else:
+                atom["connected_atoms"] = [
+                    {'nearest_neighbor_index': bond_targets[b], 'connected_cartesian_position': bond_ends[b]}
+                    for b in bond_range
+                ]
+
+            if self.spins is not None:
+                direction = self.spins[i].tolist()
+                atom["magnetic_spin"] = {"direction": direction}
+            elif self.site_indices is not None:
+                atom["magnetic_spin"] = {}
+            if self.site_indices is not None:
+                atom["site_index"] = int(self.site_indices[i])
+            atoms.append(atom)
+        return atoms
+
+
+def as_frame(structure):
+    if isinstance(structure, StructureFrame):
+        return structure
+    return StructureFrame.from_atoms(structure)
+
+
+def _optional_array(values, dtype, shape):
+    if values is None:
+        return None
+    return np.ascontiguousarray(values, dtype=dtype).reshape(shape)
+
+
+def _take(values, index):
+    return None if values is None else values[index]
+
+
+def concatenated_ranges(starts, counts):
+    # Concatenation of range(start, start + count) for every pair, without a Python loop
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.cumsum(counts)
+    shifts = np.repeat(starts - (ends - counts), counts)
+    return np.arange(total, dtype=np.int64) + shifts
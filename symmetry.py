@@ -0,0 +1,41 @@
+import logging
+
+import numpy as np
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+logger = logging.getLogger(__name__)
+
+SYMPREC = 0.01
+# Bonds of one motif have the same length by symmetry; rounding only absorbs floating point noise
+LENGTH_DECIMALS = 4
+
+
+def equivalent_sites(structure, symprec=SYMPREC):
+    # Index of the symmetry-equivalence class of every site; each site is its own class if the analysis fails
+    classes = np.arange(len(structure), dtype=np.int64)
+    try:
+        symmetrized = SpacegroupAnalyzer(structure, symprec=symprec).get_symmetrized_structure()
+    except Exception as e:
+        logger.warning("Symmetry analysis failed, every site is treated as distinct: %s", e)
+        return classes
+    for class_index, indices in enumerate(symmetrized.equivalent_indices):
+        classes[indices] = class_index
+    return classes
+
+
+def bond_motifs(frame, site_classes):
+    # A bond motif is the unordered pair of site classes at its ends plus its length
+    sources = frame.bond_sources()
+    source_classes = site_classes[frame.site_indices[sources]]
+    if frame.bond_targets is not None and np.all(frame.bond_targets >= 0):
+        target_classes = site_classes[frame.site_indices[frame.bond_targets]]
+    elif frame.bond_site_indices is not None:
+        target_classes = site_classes[frame.bond_site_indices]
+    else:
+        target_classes = np.full(len(sources), -1, dtype=np.int64)
+
+    lengths = np.linalg.norm(frame.bond_ends - frame.positions[sources], axis=1)
+    keys = np.stack([np.minimum(source_classes, target_classes), np.maximum(source_classes, target_classes),
+                     np.round(lengths * 10 ** LENGTH_DECIMALS)], axis=1)
+    _, motifs = np.unique(keys, axis=0, return_inverse=True)
+    return motifs.reshape(-1)
@@ -0,0 +1,79 @@
+import numpy as np
+
+# (sphere subdivisions, cylinder sections), coarsest first
+LOD_LEVELS = ((0, 6), (1, 8), (1, 12), (2, 16), (2, 24), (3, 32), (4, 48))
+# Finest level each preset may use; "export" matches the original icosphere and 32-section cylinders
+LOD_PRESETS = {"preview": 2, "export": 5}
+DEFAULT_NOZZLE_DIAMETER = 0.4
+PREVIEW_TOLERANCE_FACTOR = 4.0
+MAX_SUBDIVISIONS = 5
+MIN_SECTIONS, MAX_SECTIONS = 6, 128
+# Edge length of an icosahedron inscribed in the unit sphere
+ICOSAHEDRON_EDGE = 1.0515
+
+
+def tessellation_params(lod="export", print_size=None, nozzle_diameter=DEFAULT_NOZZLE_DIAMETER, triangle_budget=None):
+    # print_size is the longest side of the printed model in mm; the model is then meshed only as finely as the
+    # nozzle can resolve. triangle_budget instead picks the finest preset level that fits the whole model.
+    lod = (lod or "export").lower()
+    if lod not in LOD_PRESETS:
+        raise ValueError(f"Unknown level of detail: {lod}")
+    if triangle_budget:
+        return {"lod": lod, "triangle_budget": int(triangle_budget)}
+    if print_size:
+        return {"lod": lod, "print_size": float(print_size), "nozzle_diameter": float(nozzle_diameter)}
+    subdivisions, sections = LOD_LEVELS[LOD_PRESETS[lod]]
+    return {"lod": lod, "subdivisions": subdivisions, "sections": sections}
+
+
+def sphere_triangles(subdivisions):
+    return 20 * 4 ** subdivisions
+
+
+def cylinder_triangles(sections):
+    return 4 * sections
+
+
+def resolve_tessellation(params, positions, radii, bond_count):
+    # Turns a policy into fixed template sizes, or into a model scale and surface tolerance in model units
+    params = params or tessellation_params()
+    if "triangle_budget" in params:
+        levels = LOD_LEVELS[:LOD_PRESETS[params["lod"]] + 1]
+        for subdivisions, sections in reversed(levels):
+            if len(radii) * sphere_triangles(subdivisions) + bond_count * cylinder_triangles(sections) <= \
+                    params["triangle_budget"]:
+                break
+        return {"lod": params["lod"], "subdivisions": subdivisions, "sections": sections}
+
+    if "print_size" in params:
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        radii = np.asarray(radii, dtype=np.float64)
+        extent = np.ptp(positions, axis=0).max() + 2 * np.nanmax(radii) if len(positions) else 0.0
+        scale = params["print_size"] / max(extent, 1e-9)
+        tolerance = params["nozzle_diameter"] / 2
+        if params["lod"] == "preview":
+            tolerance *= PREVIEW_TOLERANCE_FACTOR
+        return {"lod": params["lod"], "tolerance": float(tolerance / scale)}
+
+    return params
+
+
+def sphere_subdivisions(tessellation, radius):
+    tessellation = tessellation or tessellation_params()
+    if "tolerance" not in tessellation:
+        return tessellation["subdivisions"]
+    # Flat facets sag by about edge^2 / (8 r) below the sphere; the edge halves with each subdivision
+    sag_ratio = ICOSAHEDRON_EDGE * np.sqrt(radius / (8 * tessellation["tolerance"]))
+    return int(np.clip(np.ceil(np.log2(max(sag_ratio, 1.0))), 0, MAX_SUBDIVISIONS))
+
+
+def cylinder_sections(tessellation, radii):
+    # Vectorised over radii; a polygon with n sides sags r (1 - cos(pi / n)) inside its circle
+    tessellation = tessellation or tessellation_params()
+    radii = np.asarray(radii, dtype=np.float64)
+    if "tolerance" not in tessellation:
+        return np.full(radii.shape, tessellation["sections"], dtype=np.int64)
+    ratio = np.clip(1 - tessellation["tolerance"] / np.maximum(radii, 1e-12), -1.0, 1.0)
+    with np.errstate(divide="ignore"):
+        sections = np.ceil(np.pi / np.arccos(ratio))
+    return np.clip(np.nan_to_num(sections, posinf=MAX_SECTIONS), MIN_SECTIONS, MAX_SECTIONS).astype(np.int64)
@@ -1,10 +1,27 @@
+import logging
 import os
+from contextlib import contextmanager
+
 import numpy as np
-import trimesh
 from ase.io import read
 import pyvista as pv
-from cif_reader import get_structure_with_cif, bond_by_nearest_neighbors
-from geometry_processor import add_supports, rotate_structure, translate_structure
+from bond_set import canonical_bonds
+from cif_reader import get_structure_with_cif, bond_by_nearest_neighbors, load_cif_structure
+from geometry_processor import apply_transform, compose_transform, support_parts, transform_parts, transform_structure
+from instrumentation import run, stage
+from mesh_assembler import PARTS_EXTENSION, cylinder_parts, load_part_materials, load_parts, motif_cylinder_parts, save_parts, sphere_parts
+from mesh_export import export_extension, export_format, write_parts
+from mesh_preview import PREVIEW_EXTENSION, PREVIEW_MAX_TRIANGLES, merge_previews, preview_mesh, save_preview
+from stl_writer import write_binary_stl_stream
+from structure_file import CHUNK_ATOMS, STRUCTURE_EXTENSION, atom_chunks, read_structure_file, write_structure_file
+from structure_frame import StructureFrame, as_frame
+from solidify import SOLID_VOXEL_SIZE, solidify_parts
+from stage_cache import stage_cache, stage_key
+from structure_cache import structure_key
+from symmetry import bond_motifs, equivalent_sites
+from tessellation import resolve_tessellation, tessellation_params
+
+logger = logging.getLogger(__name__)
 
 atomic_radii = {
     "H": 53, "He": 31, "Li": 167, "Be": 112, "B": 87,
@@ -45,80 +62,309 @@ def scale_radius(radius):
 atomic_radii = {atom: scale_radius(radius) if radius is not None else None for atom, radius in atomic_radii.items()}
 bond_radius = 0.25
 
-def create_sphere(position, radius=0.5, color=(0, 0, 0)):
-    sphere = trimesh.creation.icosphere(radius=radius)
-    sphere.apply_translation(position)
-    sphere.visual.vertex_colors = np.array([color] * len(sphere.vertices), dtype=np.uint8)
-    return sphere
-
-def create_cylinder(start, end, radius=0.1):
-    vec = np.array(end) - np.array(start)
-    length = np.linalg.norm(vec)
-    direction = vec / length
-    cylinder = trimesh.creation.cylinder(radius=radius, height=length)
-    align_matrix = trimesh.geometry.align_vectors([0, 0, 1], direction)
-    cylinder.apply_transform(align_matrix)
-    midpoint = (np.array(start) + np.array(end)) / 2
-    cylinder.apply_translation(midpoint)
-    return cylinder
-
-def create_arrow(start, direction, length=2.0, shaft_radius=0.2, tip_radius=0.4, tip_length=0.8):
-    direction = np.array(direction, dtype=float)
-    direction /= np.linalg.norm(direction)
-
-    cylinder = trimesh.creation.cylinder(radius=shaft_radius, height=length)
-    cylinder.apply_translation([0, 0, length / 2])
-
-    cone = trimesh.creation.cone(radius=tip_radius, height=tip_length)
-    cone.apply_translation([0, 0, length * 0.9 + tip_length / 2])
-
-    arrow = trimesh.util.concatenate(cylinder, cone)
-    align_matrix = trimesh.geometry.align_vectors([0, 0, 1], direction)
-    arrow.apply_transform(align_matrix)
-    arrow.apply_translation(start)
-    return arrow
-
-def atoms_and_bonds_to_mesh(structure):
-    atoms_and_bonds_mesh = trimesh.Trimesh()
-    magnetic_spins = []
+def structure_tessellation(structure, tessellation=None):
+    # Resolved once per structure so atoms, bonds and supports share one scale and budget
+    frame = as_frame(structure)
+    radii = frame.species_values(atomic_radii)
+    valid = ~np.isnan(radii)
+    return resolve_tessellation(tessellation, frame.positions[valid], radii[valid], frame.bond_count)
+
+
+def atoms_and_bonds_to_parts(structure, tessellation=None, site_classes=None):
+    # With site_classes (symmetry-equivalence class per structure site) every bond motif is tessellated once
+    tessellation = structure_tessellation(structure, tessellation)
+    if isinstance(structure, StructureFrame):
+        structure = canonical_bonds(structure)
+        radii = structure.species_values(atomic_radii)
+        missing = np.isnan(radii)
+        for atom_label in sorted(set(structure.labels[missing])):
+            logger.warning("No radius found for atom %s", atom_label)
+        bonded = ~missing[structure.bond_sources()]
+        spheres = sphere_parts(structure.positions[~missing], radii[~missing], tessellation)
+        if site_classes is not None and structure.site_indices is not None:
+            motifs = bond_motifs(structure, site_classes)
+            return spheres + motif_cylinder_parts(structure.bond_starts()[bonded], structure.bond_ends[bonded],
+                                                  bond_radius, motifs[bonded], tessellation)
+        return spheres + cylinder_parts(structure.bond_starts()[bonded], structure.bond_ends[bonded], bond_radius,
+                                        tessellation)
+
+    centers, radii = [], []
+    bond_starts, bond_ends = [], []
 
     for atom in structure:
         atom_radius = atomic_radii[atom['atom_label']]
         if atom_radius is None:
-            print(f"Warning: No radius found for atom {atom['atom_label']}")
+            logger.warning("No radius found for atom %s", atom['atom_label'])
             continue
-        print(f"Creating sphere for atom {atom['atom_label']} at position {atom['cartesian_position']} with radius {atom_radius}")
-        atom_sphere = create_sphere(position=atom['cartesian_position'], radius=atom_radius)
-        atoms_and_bonds_mesh += atom_sphere
+        logger.debug("Creating sphere for atom %s at position %s with radius %s", atom['atom_label'], atom['cartesian_position'], atom_radius)
+        centers.append(atom['cartesian_position'])
+        radii.append(atom_radius)
 
         for connection in atom['connected_atoms']:
-            start = atom['cartesian_position']
-            end = connection['connected_cartesian_position']
-            bond_cylinder = create_cylinder(start, end, radius=bond_radius)
-            atoms_and_bonds_mesh += bond_cylinder
+            bond_starts.append(atom['cartesian_position'])
+            bond_ends.append(connection['connected_cartesian_position'])
+
+    return sphere_parts(centers, radii, tessellation) + cylinder_parts(bond_starts, bond_ends, bond_radius, tessellation)
+
+
+def part_materials(structure, parts):
+    # Material names for atom and bond parts: spheres are named after the species of their radius
+    frame = as_frame(structure)
+    species_radii = {label: atomic_radii[label] for label in frame.species if atomic_radii.get(label) is not None}
+    materials = []
+    for vertices, _, linear, _ in parts:
+        if linear is not None:
+            materials.append("bond")
+            continue
+        radius = float(np.linalg.norm(vertices, axis=1).max()) if len(vertices) else 0.0
+        labels = sorted(label for label, value in species_radii.items() if np.isclose(value, radius, rtol=1e-6))
+        materials.append("+".join(labels) or "atom")
+    return materials
+
+STL_STAGES = ("structure", "transform", "bonding", "meshing", "supports", "solidify", "export")
+
+
+def report_stage(progress, stage):
+    if progress is not None:
+        progress(stage, STL_STAGES.index(stage) / len(STL_STAGES))
+
+
+@contextmanager
+def pipeline_stage(progress, name, **counts):
+    # Reports the stage to the progress callback and times it when instrumentation is on
+    report_stage(progress, name)
+    with stage(name, **counts) as record:
+        yield record
+
+
+def structure_counts(structure):
+    if isinstance(structure, StructureFrame):
+        return {"atoms": len(structure), "bonds": structure.bond_count}
+    return {"atoms": len(structure), "bonds": sum(len(atom['connected_atoms']) for atom in structure)}
+
+
+def parts_triangles(parts):
+    return int(sum(len(part[1]) * len(part[3]) for part in parts))
+
+
+def prepare_structure_from_params(file_path, num_unit_cells, rotation_angles, translation_vector, is_primitive, target_atoms, site_index_spin, tolerance, bonding="nearest", bonding_options=None, boundary="keep", progress=None):
+    # "nearest" rebonds the expanded atoms below, so the periodic bonding graph is never built for it
+    with pipeline_stage(progress, "structure") as record:
+        structure_bonding = "none" if bonding == "nearest" else bonding
+        unique_atoms = get_structure_with_cif(file_path=file_path, num_unit_cells=num_unit_cells, is_primitive=is_primitive, target_atoms=target_atoms, site_index_spin=site_index_spin, as_frame=True, bonding=structure_bonding, bonding_options=bonding_options)
+        record.update(structure_counts(unique_atoms))
+
+    with pipeline_stage(progress, "transform"):
+        transform = compose_transform([("rotate", rotation_angles), ("translate", translation_vector)])
+        unique_atoms = transform_structure(unique_atoms, transform)
+
+    with pipeline_stage(progress, "bonding") as record:
+        if bonding == "nearest":
+            unique_atoms = bond_by_nearest_neighbors(unique_atoms, tolerance=tolerance)
+        # Each bond once, with bonds leaving the supercell handled by the boundary policy
+        unique_atoms = canonical_bonds(unique_atoms, boundary)
+        record.update(structure_counts(unique_atoms))
+
+    return unique_atoms
+
+
+def cached_structure_from_params(file_path, num_unit_cells, is_primitive, target_atoms, site_index_spin, tolerance, bonding="nearest", bonding_options=None, boundary="keep", progress=None):
+    # The prepared structure before the user's rotation and translation. Rigid transforms change neither bonds
+    # nor meshes, so one cached structure (and its parts) serves every orientation; returns it with its stage key
+    with open(file_path, "rb") as fp:
+        source_key = structure_key(fp.read(), is_primitive)
+    key = stage_key("structure", source_key, {
+        "num_unit_cells": list(num_unit_cells), "target_atoms": target_atoms, "site_index_spin": site_index_spin,
+        "tolerance": tolerance if bonding == "nearest" else None, "bonding": bonding,
+        "bonding_options": bonding_options, "boundary": boundary})
+
+    unique_atoms = stage_cache.frame(key)
+    if unique_atoms is None:
+        unique_atoms = prepare_structure_from_params(file_path, num_unit_cells, [0, 0, 0], [0, 0, 0], is_primitive, target_atoms, site_index_spin, tolerance, bonding=bonding, bonding_options=bonding_options, boundary=boundary, progress=progress)
+        unique_atoms = stage_cache.store_frame(key, unique_atoms)
+    else:
+        with pipeline_stage(progress, "structure") as record:
+            record.update(structure_counts(unique_atoms), cached=True)
+    return unique_atoms, key
+
 
-    return atoms_and_bonds_mesh
+def symmetry_site_classes(file_path, is_primitive):
+    with open(file_path, "rb") as fp:
+        key = stage_key("symmetry", structure_key(fp.read(), is_primitive))
+    site_classes = stage_cache.value(key)
+    if site_classes is None:
+        with stage("symmetry"):
+            structure, _ = load_cif_structure(file_path, is_primitive)
+            site_classes = stage_cache.store_value(key, equivalent_sites(structure))
+    return site_classes
 
 
-def export_to_stl(mesh, file_path):
-    mesh.export(file_path)
+def structure_to_parts(unique_atoms, base_level, add_supports_flag, tessellation=None, solidify_flag=False, voxel_size=SOLID_VOXEL_SIZE, site_classes=None, progress=None, transform=None, cache_key=None, with_materials=False):
+    # With cache_key, unique_atoms is the untransformed structure under that stage key: its atom and bond parts
+    # are memoized per tessellation and moved by transform, and only supports and solidify see the new placement.
+    # with_materials returns (parts, material name per part) for the multi-material exports
+    placed_atoms = unique_atoms if transform is None else transform_structure(unique_atoms, transform)
+    with pipeline_stage(progress, "meshing") as record:
+        tessellation = structure_tessellation(placed_atoms, tessellation)
+        parts = None
+        if cache_key is not None:
+            parts_key = stage_key("parts", cache_key, tessellation, site_classes)
+            parts = stage_cache.parts(parts_key)
+            record.update(cached=parts is not None)
+        if parts is None:
+            parts = atoms_and_bonds_to_parts(unique_atoms, tessellation, site_classes)
+            if cache_key is not None:
+                stage_cache.store_parts(parts_key, parts)
+        if transform is not None and cache_key is not None:
+            parts = transform_parts(parts, transform)
+        record.update(structure_counts(unique_atoms), triangles=parts_triangles(parts), parts=len(parts))
+    materials = part_materials(unique_atoms, parts) if with_materials else None
 
-def generate_stl_from_params(file_path, num_unit_cells, rotation_angles, translation_vector, base_level, is_primitive, target_atoms, site_index_spin, tolerance, add_supports_flag):
-    stl_file_path = file_path.replace('.cif', '.stl')
+    if add_supports_flag:
+        with pipeline_stage(progress, "supports") as record:
+            supports = support_parts(placed_atoms, atomic_radii, base_level=base_level, tessellation=tessellation)
+            record.update(triangles=parts_triangles(supports))
+            # A new list: without a transform, parts may be the list held by the stage cache
+            parts = parts + supports
+            if with_materials:
+                materials += ["support"] * len(supports)
+
+    # Optional remesh of the overlapping parts into one watertight surface
+    if solidify_flag:
+        with pipeline_stage(progress, "solidify") as record:
+            parts = solidify_parts(parts, voxel_size)
+            record.update(triangles=parts_triangles(parts), voxel_size=voxel_size)
+            if with_materials:
+                materials = ["solid"] * len(parts)
+
+    return (parts, materials) if with_materials else parts
+
+
+def generate_parts_from_params(file_path, num_unit_cells, rotation_angles, translation_vector, base_level, is_primitive, target_atoms, site_index_spin, tolerance, add_supports_flag, bonding="nearest", bonding_options=None, tessellation=None, solidify_flag=False, voxel_size=SOLID_VOXEL_SIZE, symmetry_flag=False, boundary="keep", progress=None, with_materials=False):
+    unique_atoms, cache_key = cached_structure_from_params(file_path, num_unit_cells, is_primitive, target_atoms, site_index_spin, tolerance, bonding=bonding, bonding_options=bonding_options, boundary=boundary, progress=progress)
+    transform = compose_transform([("rotate", rotation_angles), ("translate", translation_vector)])
+    site_classes = symmetry_site_classes(file_path, is_primitive) if symmetry_flag else None
+    return structure_to_parts(unique_atoms, base_level, add_supports_flag, tessellation=tessellation, solidify_flag=solidify_flag, voxel_size=voxel_size, site_classes=site_classes, progress=progress, transform=transform, cache_key=cache_key, with_materials=with_materials)
+
+
+def generate_stl_from_params(file_path, num_unit_cells, rotation_angles, translation_vector, base_level, is_primitive, target_atoms, site_index_spin, tolerance, add_supports_flag, bonding="nearest", bonding_options=None, tessellation=None, solidify_flag=False, voxel_size=SOLID_VOXEL_SIZE, symmetry_flag=False, boundary="keep", progress=None, output_path=None, output_format="stl", compress=False):
+    # output_format (stl, 3mf, ply or glb) and compress pick the default path; an output_path's own extension wins
+    stl_file_path = output_path or file_path.replace('.cif', export_extension(output_format, compress))
+    with run("generate_stl", file_path=file_path, num_unit_cells=list(num_unit_cells), bonding=bonding, solidify=solidify_flag, output_format=export_format(stl_file_path)[0]):
+        parts, materials = generate_parts_from_params(file_path, num_unit_cells, rotation_angles, translation_vector, base_level, is_primitive, target_atoms, site_index_spin, tolerance, add_supports_flag, bonding=bonding, bonding_options=bonding_options, tessellation=tessellation, solidify_flag=solidify_flag, voxel_size=voxel_size, symmetry_flag=symmetry_flag, boundary=boundary, progress=progress, with_materials=True)
 
-    unique_atoms = get_structure_with_cif(file_path=file_path, num_unit_cells=num_unit_cells, is_primitive=is_primitive, target_atoms=target_atoms, site_index_spin=site_index_spin)
-    unique_atoms = rotate_structure(unique_atoms, rotation_angles)
-    unique_atoms = translate_structure(unique_atoms, translation_vector)
-    unique_atoms = bond_by_nearest_neighbors(unique_atoms, tolerance=tolerance)
-    mesh = atoms_and_bonds_to_mesh(unique_atoms)
+        with pipeline_stage(progress, "export") as record:
+            record.update(triangles=write_parts(stl_file_path, parts, materials))
+            record.update(bytes=os.path.getsize(stl_file_path))
 
+    return stl_file_path
+
+
+def transform_preview(preview, matrix):
+    # Bounds become the box around the transformed corners, which may be slightly loose after a rotation
+    vertices, faces, bounds = preview
+    corners = np.array(np.meshgrid(*bounds.T)).reshape(3, -1).T
+    corners = apply_transform(corners, matrix)
+    return apply_transform(vertices, matrix).astype(np.float32), faces, np.array([corners.min(axis=0), corners.max(axis=0)])
+
+
+def placed_preview(unique_atoms, cache_key, transform, base_level, add_supports_flag):
+    # The decimated atoms and bonds are memoized with the structure and moved rigidly; only the supports,
+    # which depend on the placement, are decimated per request within a quarter of the triangle budget
+    placed_atoms = transform_structure(unique_atoms, transform)
+    support_budget = PREVIEW_MAX_TRIANGLES // 4 if add_supports_flag else 0
+    tessellation = structure_tessellation(placed_atoms, tessellation_params("preview", triangle_budget=PREVIEW_MAX_TRIANGLES))
+    key = stage_key("preview", cache_key, tessellation, PREVIEW_MAX_TRIANGLES - support_budget)
+    preview = stage_cache.preview(key)
+    if preview is None:
+        parts = structure_to_parts(unique_atoms, base_level, False, tessellation=tessellation, cache_key=cache_key)
+        preview = stage_cache.store_preview(key, preview_mesh(parts, PREVIEW_MAX_TRIANGLES - support_budget))
+    previews = [transform_preview(preview, transform)]
     if add_supports_flag:
-        mesh = add_supports(mesh, unique_atoms, atomic_radii, base_level=base_level)
+        supports = support_parts(placed_atoms, atomic_radii, base_level=base_level, tessellation=tessellation)
+        previews.append(preview_mesh(supports, support_budget))
+    return merge_previews(previews)
+
+
+def generate_preview_from_params(file_path, num_unit_cells, rotation_angles, translation_vector, base_level, is_primitive, target_atoms, site_index_spin, tolerance, add_supports_flag, bonding="nearest", bonding_options=None, tessellation=None, solidify_flag=False, voxel_size=SOLID_VOXEL_SIZE, symmetry_flag=False, boundary="keep", progress=None, output_path=None, preview_path=None):
+    # Saves the parts recipe at the export level of detail and a preview at the coarse one;
+    # the full STL is only written on download
+    parts_path = output_path or file_path.replace('.cif', PARTS_EXTENSION)
+    preview_path = preview_path or parts_path.replace(PARTS_EXTENSION, PREVIEW_EXTENSION)
+    with run("generate_preview", file_path=file_path, num_unit_cells=list(num_unit_cells), bonding=bonding, solidify=solidify_flag):
+        unique_atoms, cache_key = cached_structure_from_params(file_path, num_unit_cells, is_primitive, target_atoms, site_index_spin, tolerance, bonding=bonding, bonding_options=bonding_options, boundary=boundary, progress=progress)
+        transform = compose_transform([("rotate", rotation_angles), ("translate", translation_vector)])
+        site_classes = symmetry_site_classes(file_path, is_primitive) if symmetry_flag else None
+        parts, materials = structure_to_parts(unique_atoms, base_level, add_supports_flag, tessellation=tessellation, solidify_flag=solidify_flag, voxel_size=voxel_size, site_classes=site_classes, progress=progress, transform=transform, cache_key=cache_key, with_materials=True)
 
-    export_to_stl(mesh, stl_file_path)
+        with pipeline_stage(progress, "export") as record:
+            if solidify_flag:
+                # The solid is a single surface, so the preview is simply a decimated copy of it
+                vertices, faces, bounds = preview_mesh(parts)
+            else:
+                with stage("preview_meshing"):
+                    vertices, faces, bounds = placed_preview(unique_atoms, cache_key, transform, base_level, add_supports_flag)
+            save_preview(preview_path, vertices, faces, bounds)
+            save_parts(parts_path, parts, materials)
+            record.update(triangles=parts_triangles(parts), preview_triangles=len(faces))
+
+    return parts_path
+
+
+def export_structure_from_params(file_path, num_unit_cells, rotation_angles, translation_vector, is_primitive, target_atoms, site_index_spin, tolerance, bonding="nearest", bonding_options=None, boundary="keep", progress=None, output_path=None):
+    # Saves the transformed, bonded structure as a structure file for generate_stl_from_structure_file
+    structure_path = output_path or file_path.replace('.cif', STRUCTURE_EXTENSION)
+    unique_atoms = prepare_structure_from_params(file_path, num_unit_cells, rotation_angles, translation_vector, is_primitive, target_atoms, site_index_spin, tolerance, bonding=bonding, bonding_options=bonding_options, boundary=boundary, progress=progress)
+    write_structure_file(structure_path, unique_atoms, {"cif": file_path, "num_unit_cells": list(num_unit_cells), "bonding": bonding, "boundary": boundary})
+    return structure_path
+
+
+def structure_file_batches(frame, tessellation, supports, chunk_atoms, record):
+    for chunk in atom_chunks(frame, chunk_atoms):
+        record["chunks"] = record.get("chunks", 0) + 1
+        yield atoms_and_bonds_to_parts(chunk, tessellation)
+    yield supports
+
+
+def structure_file_materials(frame, tessellation, chunk_atoms, record):
+    # The chunks' parts with their materials, for the formats that are written in one piece
+    parts = []
+    for chunk_parts in structure_file_batches(frame, tessellation, [], chunk_atoms, record):
+        parts += chunk_parts
+    return parts, part_materials(frame, parts)
+
+
+def generate_stl_from_structure_file(structure_path, output_path=None, base_level=0.0, add_supports_flag=False, tessellation=None, chunk_atoms=CHUNK_ATOMS, progress=None):
+    # Meshes a memory-mapped structure file chunk by chunk and streams the triangles out, so neither the
+    # structure nor the mesh has to fit in memory at once
+    stl_file_path = output_path or structure_path.replace(STRUCTURE_EXTENSION, '.stl')
+    with run("generate_stl_from_structure_file", file_path=structure_path, chunk_atoms=chunk_atoms):
+        frame = read_structure_file(structure_path)
+        with pipeline_stage(progress, "meshing") as record:
+            tessellation = structure_tessellation(frame, tessellation)
+            record.update(structure_counts(frame))
+
+        supports = []
+        if add_supports_flag:
+            with pipeline_stage(progress, "supports") as record:
+                supports = support_parts(frame, atomic_radii, base_level=base_level, tessellation=tessellation)
+                record.update(triangles=parts_triangles(supports))
+
+        with pipeline_stage(progress, "export") as record:
+            if export_format(stl_file_path) == ("stl", False):
+                batches = structure_file_batches(frame, tessellation, supports, chunk_atoms, record)
+                record.update(triangles=write_binary_stl_stream(stl_file_path, batches))
+            else:
+                parts, materials = structure_file_materials(frame, tessellation, chunk_atoms, record)
+                record.update(triangles=write_parts(stl_file_path, parts + supports, materials + ["support"] * len(supports)))
 
     return stl_file_path
 
+
+def export_parts(parts_path, output_path):
+    # Any export format, with materials when the parts were saved with them
+    return write_parts(output_path, load_parts(parts_path), load_part_materials(parts_path))
+
 # Example usage
 if __name__ == "__main__":
     stl_path = generate_stl_from_params(